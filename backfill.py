@@ -0,0 +1,267 @@
+"""
+Historical backfill: seed data/ with daily cost rows for a range of past days.
+
+The range is split into one Cost Management query per subscription and
+calendar month. The chunks run in parallel on a bounded worker pool; every
+request goes through the throttle scheduler, so the pool never outruns the
+tenant's query quota and 429s are retried after their Retry-After.
+
+Each chunk is written as a CSV partition,
+<output>/query=<key>/subscription=<id>/month=<YYYY-MM>/costs.csv, where
+<key> identifies the query (filter and grouping, see
+cost_store.get_query_key). The rows are already filtered, so the CSV has
+no tags column; the query is written to <output>/query=<key>/query.json,
+which tells the export reader to skip its filter, so the folder is
+readable as an export (cost_data_source=export,
+cost_export_path=<output>/query=<key>). Service-level chunks are also saved
+to the local cost store, which the reports read by default. Finished chunks
+are recorded in a checkpoint file, so a rerun after a crash or an interrupt
+skips them and resumes with the rest.
+
+Usage:
+    python backfill.py --from 2025-10-01 --to 2026-09-30 --subscriptions <id> <id>
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from utils import config
+
+CSV_COLUMNS = ['date', 'ServiceName', 'SubscriptionId', 'cost', 'currency']
+
+def split_months(from_day, to_day):
+    """
+    Split a range of days into calendar-month chunks.
+
+    Args:
+        from_day (date): First day of the range.
+        to_day (date): Last day of the range (inclusive).
+
+    Returns:
+        list: (first day, last day) of each chunk, oldest first.
+    """
+    chunks = []
+    start = from_day
+    while start <= to_day:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        end = min(to_day, next_month - timedelta(days=1))
+        chunks.append((start, end))
+        start = next_month
+    return chunks
+
+class Checkpoint:
+    """
+    The finished chunks of a backfill, persisted after every chunk.
+    """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.chunks = {}
+        self._lock = threading.Lock()
+        if path and not restart and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.chunks = json.load(f).get('chunks', {})
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable backfill checkpoint {path}: {str(e)}")
+
+    @staticmethod
+    def get_key(subscription_id, start, end, grouping, filter_expression):
+        # A chunk is only reused for the same days and the same query
+        query = json.dumps([grouping, filter_expression], sort_keys=True)
+        return f"{subscription_id}/{start:%Y%m%d}-{end:%Y%m%d}/{query}"
+
+    def is_done(self, key):
+        return key in self.chunks
+
+    def mark_done(self, key, rows, path):
+        with self._lock:
+            self.chunks[key] = {'rows': rows, 'path': path, 'finished_at': datetime.now().isoformat(timespec='seconds')}
+            if not self.path:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'chunks': self.chunks}, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+def get_partition_path(output, query_key, subscription_id, start):
+    """
+    Return the CSV file of one query, subscription and month under the output directory.
+
+    Queries with a different filter or grouping get their own partitions, so
+    backfills of several queries never overwrite each other.
+    """
+    return os.path.join(output, f'query={query_key}', f'subscription={subscription_id}', f'month={start:%Y-%m}', 'costs.csv')
+
+def write_query_file(output, query_key, dataset):
+    """
+    Record the query of a query=<key> folder (see cost_exports.get_applied_filter).
+    """
+    from utils import cost_exports
+    path = os.path.join(output, f'query={query_key}', cost_exports.QUERY_FILE)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'filter': dataset.get('filter'), 'grouping': dataset.get('grouping', [])}, f, indent=1)
+    os.replace(tmp_path, path)
+
+def backfill_chunk(subscription_id, start, end, output, grouping=None, filter_expression=None, today=None):
+    """
+    Query one subscription's daily costs for one chunk of days and write its partition.
+
+    The file is written under a temporary name and moved into place once
+    complete, so a crash never leaves a partial partition behind. Without an
+    extra grouping the rows are also saved to the cost store (when enabled)
+    under the same query key as the reports' own queries, so reports,
+    month-to-date and baselines are served from them.
+
+    Returns:
+        tuple: (number of rows written, partition path).
+
+    Raises:
+        ValueError: If the query failed (e.g. it was still throttled after retries).
+    """
+    from utils import azure, azure_subscription_queries, cost_store, throttle
+
+    settings = config.get_settings()
+    today = today or datetime.now()
+    access_token = azure.authenticate_with_azure(settings.tenant_id, settings.client_id, settings.client_secret)
+    headers = {'Authorization': f'Bearer {access_token}'}
+    usage_url = azure_subscription_queries.get_query_url(f'/subscriptions/{subscription_id}', settings.azure_api_version)
+    payload = azure_subscription_queries.get_usage_data_window(
+        (today.date() - start).days, (today.date() - end).days, today=today,
+        grouping=grouping, filter_expression=filter_expression
+    )
+
+    def fetch_next(next_link):
+        return throttle.cost_management_request('POST', next_link, tenant_id=settings.tenant_id, headers=headers, json=payload)
+
+    dimensions = [name for name in (grouping or []) if name != 'ServiceName']
+    query_key = cost_store.get_query_key(payload)
+    # The cost store only holds service-level rows (see fetch_cost_data)
+    store_rows = [] if cost_store.is_enabled() and not dimensions else None
+    path = get_partition_path(output, query_key, subscription_id, start)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_query_file(output, query_key, payload['dataset'])
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    rows = 0
+    try:
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_COLUMNS + dimensions)
+            for row in azure_subscription_queries.iter_cost_data(fetch_next(usage_url), fetch_next):
+                writer.writerow([row['date'], row['service'], subscription_id, row['cost'], row['currency']] + [row.get(name) for name in dimensions])
+                rows += 1
+                if store_rows is not None:
+                    store_rows.append(row)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if store_rows is not None:
+        try:
+            cost_store.save_rows(subscription_id, query_key, cost_store.date_range(
+                datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time())
+            ), store_rows)
+        except sqlite3.Error as e:
+            raise ValueError(f"Could not save the rows to the cost store: {str(e)}")
+    return rows, path
+
+def run_backfill(subscription_ids, from_day, to_day, output, checkpoint, workers=None, grouping=None, filter_expression=None):
+    """
+    Backfill every subscription and month chunk of the range that the checkpoint does not have yet.
+
+    A failed chunk is logged and left out of the checkpoint, so the next run retries it.
+
+    Returns:
+        dict: Chunk counts (total, skipped, done, failed), rows written and elapsed seconds.
+    """
+    settings = config.get_settings()
+    workers = workers or settings.throttle_max_concurrency
+    chunks = [(sub_id, start, end) for sub_id in subscription_ids for start, end in split_months(from_day, to_day)]
+    keys = {chunk: Checkpoint.get_key(*chunk, grouping, filter_expression) for chunk in chunks}
+    pending = [chunk for chunk in chunks if not checkpoint.is_done(keys[chunk])]
+    summary = {'chunks': len(chunks), 'skipped': len(chunks) - len(pending), 'done': 0, 'failed': 0, 'rows': 0}
+    logging.info(f"Backfilling {len(pending)} of {len(chunks)} chunk(s) with {workers} worker(s)")
+
+    started = time.monotonic()
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending)), thread_name_prefix='backfill') as executor:
+            futures = {
+                executor.submit(backfill_chunk, sub_id, start, end, output, grouping, filter_expression): (sub_id, start, end)
+                for sub_id, start, end in pending
+            }
+            for future in as_completed(futures):
+                sub_id, start, end = chunk = futures[future]
+                try:
+                    rows, path = future.result()
+                except Exception as e:
+                    logging.error(f"Backfill of {sub_id} {start:%Y-%m-%d}..{end:%Y-%m-%d} failed: {str(e)}")
+                    summary['failed'] += 1
+                    continue
+                checkpoint.mark_done(keys[chunk], rows, path)
+                summary['done'] += 1
+                summary['rows'] += rows
+                logging.info(f"Backfilled {sub_id} {start:%Y-%m-%d}..{end:%Y-%m-%d}: {rows} row(s) ({summary['done'] + summary['failed']}/{len(pending)})")
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    return summary
+
+def resolve_subscription_ids(subscription_ids):
+    """
+    Return the subscriptions given on the command line, else the configured (or discovered) ones.
+    """
+    from utils import fanout
+    subscription_ids = list(dict.fromkeys(subscription_ids or fanout.get_subscription_ids()))
+    settings = config.get_settings()
+    if subscription_ids or not settings.subscription_discovery:
+        return subscription_ids
+    from utils import azure, subscription_cache
+    access_token = azure.authenticate_with_azure(settings.tenant_id, settings.client_id, settings.client_secret)
+    return subscription_cache.discover_subscription_ids(access_token, tag=settings.subscription_discovery_tag)
+
+def _day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def main(argv=None):
+    yesterday = (datetime.now() - timedelta(days=1)).date()
+    parser = argparse.ArgumentParser(description='Backfill daily Cost Management history into partitioned CSV files.')
+    parser.add_argument('--from', dest='from_day', type=_day, required=True, help='First day (YYYY-MM-DD).')
+    parser.add_argument('--to', dest='to_day', type=_day, default=yesterday, help='Last day (YYYY-MM-DD), defaults to yesterday.')
+    parser.add_argument('--subscriptions', nargs='+', help='Subscription IDs, defaults to the subscription_ids setting (or discovery).')
+    parser.add_argument('--workers', type=int, help='Chunks in flight at once, defaults to throttle_max_concurrency.')
+    parser.add_argument('--output', default=os.path.join(config.DATA_DIR, 'history'), help='Directory of the partitioned files.')
+    parser.add_argument('--checkpoint', default=os.path.join(config.DATA_DIR, 'backfill_checkpoint.json'), help='Checkpoint file of the finished chunks.')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and backfill every chunk again.')
+    parser.add_argument('--resources', action='store_true', help='Group by ResourceId as well as ServiceName.')
+    parser.add_argument('--all-services', action='store_true', help='Query every service instead of the report filter.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.from_day > args.to_day:
+        parser.error('--from must not be after --to')
+    subscription_ids = resolve_subscription_ids(args.subscriptions)
+    if not subscription_ids:
+        parser.error('no subscriptions given or configured')
+
+    from utils import azure_subscription_queries
+    summary = run_backfill(
+        subscription_ids, args.from_day, args.to_day, args.output,
+        Checkpoint(args.checkpoint, restart=args.restart),
+        workers=args.workers,
+        grouping=['ServiceName', 'ResourceId'] if args.resources else None,
+        filter_expression=None if args.all_services else azure_subscription_queries.DEFAULT_FILTER
+    )
+    print(json.dumps(summary))
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class FakeAzure:
+    """
+    Local stand-in for the Azure AD token endpoint, the subscription APIs and the
+    Cost Management query and forecast endpoints.
+
+    Point azure_login_url and azure_management_url at `url` to use it.
+
+    Attributes:
+        latency (float): Seconds slept before answering every request.
+        rows (int): Rows returned by each Cost Management query (spread over the
+            requested days and synthetic service names).
+        page_size (int): Rows per page; further pages are linked with nextLink.
+        throttle_every (int): Answer every Nth query with HTTP 429 (0 disables).
+        retry_after (float): Retry-After advertised on injected 429 responses.
+        subscriptions (list): Subscription IDs returned by the listing call.
+    """
+
+    def __init__(self, latency=0.0, rows=100, page_size=5000, throttle_every=0, retry_after=1, subscriptions=None):
+        self.latency = latency
+        self.rows = rows
+        self.page_size = page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.subscriptions = subscriptions or []
+        self.counters = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self, 'GET')
+
+            def do_POST(self):
+                fake._handle(self, 'POST')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.counters = {}
+            self.bytes_sent = 0
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            return self.counters[name]
+
+    def _send(self, handler, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+        with self._lock:
+            self.bytes_sent += len(payload)
+
+    def _handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        request_body = handler.rfile.read(length) if length else b''
+        if self.latency:
+            time.sleep(self.latency)
+
+        parsed = urlparse(handler.path)
+        path = parsed.path.rstrip('/')
+        query = parse_qs(parsed.query)
+
+        if path.endswith('/oauth2/token'):
+            self._count('token')
+            return self._send(handler, 200, {'access_token': 'fake-token', 'token_type': 'Bearer', 'expires_in': '3599'})
+
+        if path.endswith('/providers/Microsoft.CostManagement/query'):
+            return self._handle_query(handler, handler.path, json.loads(request_body or b'{}'), query)
+
+        if path.endswith('/providers/Microsoft.CostManagement/forecast'):
+            return self._handle_forecast(handler, json.loads(request_body or b'{}'))
+
+        if path == '/subscriptions':
+            self._count('subscription_list')
+            return self._send(handler, 200, {'value': [
+                {'subscriptionId': sub_id, 'displayName': f'Benchmark {sub_id[:8]}', 'state': 'Enabled', 'tags': {}}
+                for sub_id in self.subscriptions
+            ]})
+
+        if path.startswith('/subscriptions/') and path.count('/') == 2:
+            self._count('subscription_get')
+            sub_id = path.rsplit('/', 1)[-1]
+            return self._send(handler, 200, {'subscriptionId': sub_id, 'displayName': f'Benchmark {sub_id[:8]}'})
+
+        self._send(handler, 404, {'error': {'code': 'NotFound', 'message': handler.path}})
+
+    def _handle_forecast(self, handler, payload):
+        self._count('forecast')
+        period = payload.get('timePeriod', {})
+        start = datetime.strptime(period.get('from', '2000-01-01')[:10], '%Y-%m-%d')
+        end = datetime.strptime(period.get('to', '2000-01-01')[:10], '%Y-%m-%d')
+        rows = [
+            [50.0, int((start + timedelta(days=i)).strftime('%Y%m%d')), 'Forecast', 'BRL']
+            for i in range((end - start).days + 1)
+        ]
+        columns = [{'name': 'Cost', 'type': 'Number'}, {'name': 'UsageDate', 'type': 'Number'},
+                   {'name': 'CostStatus', 'type': 'String'}, {'name': 'Currency', 'type': 'String'}]
+        self._send(handler, 200, {'properties': {'nextLink': None, 'columns': columns, 'rows': rows}})
+
+    def _handle_query(self, handler, request_path, payload, query):
+        calls = self._count('query')
+        if self.throttle_every and calls % self.throttle_every == 0:
+            self._count('throttled')
+            return self._send(handler, 429, {'error': {'code': '429', 'message': 'Too many requests'}}, {
+                'Retry-After': str(self.retry_after),
+                'x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after': str(self.retry_after)
+            })
+
+        period = payload.get('timePeriod', {})
+        start = datetime.strptime(period.get('from', '2000-01-01')[:10], '%Y-%m-%d')
+        end = datetime.strptime(period.get('to', '2000-01-01')[:10], '%Y-%m-%d')
+        days = [int((start + timedelta(days=i)).strftime('%Y%m%d')) for i in range((end - start).days + 1)]
+        grouping = [g['name'] for g in payload.get('dataset', {}).get('grouping', [])] or ['ServiceName']
+
+        def build_row(i):
+            row = [round((i * 7919 % 10000) / 100, 2), days[i % len(days)]]
+            for name in grouping:
+                if name == 'ServiceName':
+                    row.append(f'Service {i // len(days)}')
+                elif name == 'SubscriptionId':
+                    row.append(self.subscriptions[i % len(self.subscriptions)] if self.subscriptions else 'sub')
+                else:
+                    row.append(f'/subscriptions/sub/resourceGroups/rg{i % 10}/providers/fake/{name}/{i % 1000}')
+            row.append('BRL')
+            return row
+
+        offset = int(query.get('$skiptoken', ['0'])[0])
+        stop = min(offset + self.page_size, self.rows)
+        sorting = [2 + grouping.index(s['name']) for s in payload.get('dataset', {}).get('sorting', []) if s['name'] in grouping]
+        if sorting:
+            # Sorted results page through the whole ordered result set
+            ordered = sorted((build_row(i) for i in range(self.rows)), key=lambda row: [row[p] for p in sorting])
+            rows = ordered[offset:stop]
+        else:
+            rows = [build_row(i) for i in range(offset, stop)]
+
+        next_link = None
+        if stop < self.rows:
+            base = request_path.split('&$skiptoken=')[0]
+            next_link = f'{self.url}{base}&$skiptoken={stop}'
+
+        columns = [{'name': 'Cost', 'type': 'Number'}, {'name': 'UsageDate', 'type': 'Number'}]
+        columns += [{'name': name, 'type': 'String'} for name in grouping]
+        columns.append({'name': 'Currency', 'type': 'String'})
+        self._send(handler, 200, {'properties': {'nextLink': next_link, 'columns': columns, 'rows': rows}}, {
+            'x-ms-ratelimit-microsoft.costmanagement-qpu-remaining': 'QueryResource:100'
+        })
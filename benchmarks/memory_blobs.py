@@ -0,0 +1,52 @@
+import itertools
+import threading
+
+class MemoryBlobs:
+    """
+    In-process stand-in for the blob operations of utils.blob_store.
+
+    Keeps (container, name) -> (content, etag) in a dict with the same
+    conditional semantics (create only if absent, write only on a matching
+    ETag), so the queue and job paths run without Azurite.
+    """
+
+    def __init__(self):
+        self.blobs = {}
+        self._etags = itertools.count(1)
+        self._lock = threading.Lock()
+        self._originals = {}
+
+    def create_blob(self, container_name, blob_name, data):
+        with self._lock:
+            if (container_name, blob_name) in self.blobs:
+                return False
+            self.blobs[(container_name, blob_name)] = (data, str(next(self._etags)))
+            return True
+
+    def read_blob(self, container_name, blob_name):
+        with self._lock:
+            return self.blobs.get((container_name, blob_name), (None, None))
+
+    def write_blob(self, container_name, blob_name, data, etag=None):
+        with self._lock:
+            if etag is not None and self.blobs.get((container_name, blob_name), (None, None))[1] != etag:
+                return False
+            self.blobs[(container_name, blob_name)] = (data, str(next(self._etags)))
+            return True
+
+    def delete_blob(self, container_name, blob_name):
+        with self._lock:
+            self.blobs.pop((container_name, blob_name), None)
+
+    def install(self):
+        from utils import blob_store
+        for name in ('create_blob', 'read_blob', 'write_blob', 'delete_blob'):
+            self._originals[name] = getattr(blob_store, name)
+            setattr(blob_store, name, getattr(self, name))
+        return self
+
+    def uninstall(self):
+        from utils import blob_store
+        for name, original in self._originals.items():
+            setattr(blob_store, name, original)
+        self._originals = {}
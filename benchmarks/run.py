@@ -0,0 +1,292 @@
+"""
+End-to-end benchmark of the cost report against local stand-ins.
+
+Starts a fake Azure (token, subscription and Cost Management query endpoints)
+and a local SMTP sink, then drives execute_cost_comparison, the timer and HTTP
+triggers or the queue fan-out for every requested scenario and reports
+per-stage latency, throughput and peak Python memory.
+
+Usage:
+    python -m benchmarks.run --subscriptions 1 5 --rows 10 10000 --latency 0.05 --throttle-every 7
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from benchmarks.fake_azure import FakeAzure
+from benchmarks.memory_blobs import MemoryBlobs
+from benchmarks.smtp_sink import SmtpSink
+from utils import config
+
+# Stages timed in every run: (label, module, function name)
+STAGES = [
+    ('authenticate', 'utils.azure', 'authenticate_with_azure'),
+    ('subscription_name', 'utils.subscription_cache', 'get_subscription_name'),
+    ('query_and_parse', 'utils.azure_subscription_queries', 'load_cost_table'),
+    ('compare', 'utils.azure_subscription_queries', 'build_comparison'),
+    ('print', 'utils.azure_subscription_queries', 'print_comparison'),
+    ('email', 'utils.email', 'send_email'),
+]
+
+class CollectingOut:
+    """
+    Stand-in for func.Out that keeps whatever the function sets.
+    """
+
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+class StageTimer:
+    """
+    Records the wall time of every call to the benchmarked stages.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._lock = threading.Lock()
+        self._originals = []
+
+    def wrap(self, label, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.durations[label].append(elapsed)
+        return timed
+
+    def install(self):
+        for label, module_name, attr in STAGES:
+            module = sys.modules[module_name]
+            original = getattr(module, attr)
+            self._originals.append((module, attr, original))
+            setattr(module, attr, self.wrap(label, original))
+
+    def uninstall(self):
+        for module, attr, original in self._originals:
+            setattr(module, attr, original)
+        self._originals = []
+
+    def reset(self):
+        with self._lock:
+            self.durations = defaultdict(list)
+
+    def summary(self):
+        result = {}
+        for label, _, _ in STAGES:
+            values = sorted(self.durations.get(label, []))
+            if not values:
+                continue
+            result[label] = {
+                'calls': len(values),
+                'total_ms': round(sum(values) * 1000, 2),
+                'p50_ms': round(values[len(values) // 2] * 1000, 2),
+                'max_ms': round(values[-1] * 1000, 2)
+            }
+        return result
+
+def configure_environment(fake, sink):
+    """
+    Point every setting the app reads at the local stand-ins.
+
+    Settings are frozen on the first config.get_settings() call, so this
+    must run before the app is first used.
+    """
+    os.environ.update({
+        'azure_login_url': fake.url,
+        'azure_management_url': fake.url,
+        'tenant_id': 'benchmark-tenant',
+        'client_id': 'benchmark-client',
+        'client_secret': 'benchmark-secret',
+        'cost_store_path': '',
+        'subscription_cache_path': '',
+        'report_specs_path': '',
+        'result_cache_enabled': 'false',
+        'anomaly_state_path': '',
+        'email_smtp_server': '127.0.0.1',
+        'email_smtp_port': str(sink.port),
+        'email_smtp_starttls': 'false',
+        'email_sender': 'benchmark@example.com',
+        'email_recipients': 'finops@example.com',
+        'email_password': 'benchmark',
+        'throttle_jitter': '0',
+        'DEBUG': 'false',
+    })
+
+def reset_caches():
+    """
+    Drop the process-wide token and subscription caches so every run starts cold.
+    """
+    from utils import azure, subscription_cache
+    azure.clear_token_cache()
+    subscription_cache.clear()
+
+def get_user_functions(function_app):
+    """
+    Map trigger names to their Python functions.
+
+    FunctionApp.get_functions() can only be called once per app, so this is
+    resolved once and reused for every run.
+    """
+    return {function.get_function_name(): function.get_user_function() for function in function_app.app.get_functions()}
+
+def run_once(mode, function_app, triggers, subscription_ids):
+    """
+    Drive the app once in the given mode.
+
+    Returns:
+        bool: True when every subscription reported successfully.
+    """
+    import azure.functions as func
+
+    if mode == 'execute':
+        results = [function_app.execute_cost_comparison(sub_id) for sub_id in subscription_ids]
+        return all(r['status'] == 'success' for r in results)
+    if mode == 'timer':
+        timer = type('BenchmarkTimer', (), {'past_due': False})()
+        triggers['schedule_cost_report_1'](timer, CollectingOut())
+        return True
+    if mode == 'queue':
+        # The timer enqueues, then each message is handed to the queue trigger
+        # as the host would (no Azurite needed)
+        os.environ['queue_mode'] = 'true'
+        config.reload_settings()
+        # Dedupe markers live in memory, fresh for every run
+        blobs = MemoryBlobs().install()
+        try:
+            queue = CollectingOut()
+            triggers['schedule_cost_report_1'](type('BenchmarkTimer', (), {'past_due': False})(), queue)
+            for i, body in enumerate(queue.get() or []):
+                message = func.QueueMessage(id=str(i), body=body.encode('utf-8'))
+                triggers['process_cost_report_message'](message)
+        finally:
+            blobs.uninstall()
+            os.environ['queue_mode'] = 'false'
+            config.reload_settings()
+        return True
+    if mode == 'http':
+        # Start the job, run its queued messages as the host would, then poll
+        # the status route until it finishes
+        blobs = MemoryBlobs().install()
+        try:
+            request = func.HttpRequest('GET', 'http://localhost/api/cost-report', body=b'')
+            queue = CollectingOut()
+            response = triggers['manual_cost_report_1'](request, queue)
+            if response.status_code != 202:
+                return False
+            job_id = json.loads(response.get_body())['job_id']
+            for i, body in enumerate(queue.get() or []):
+                triggers['process_cost_report_message'](func.QueueMessage(id=str(i), body=body.encode('utf-8')))
+            status = triggers['cost_report_status'](func.HttpRequest(
+                'GET', f'http://localhost/api/cost-report/{job_id}', body=b'', route_params={'job_id': job_id}
+            ))
+            return status.status_code == 200
+        finally:
+            blobs.uninstall()
+    raise ValueError(f"Unknown mode '{mode}'.")
+
+def run_scenario(args, fake, sink, function_app, triggers, timer, subscriptions, rows):
+    subscription_ids = [f'{i:08d}-0000-0000-0000-000000000000' for i in range(subscriptions)]
+    fake.rows = rows
+    fake.subscriptions = subscription_ids
+    os.environ['subscription_ids'] = ','.join(subscription_ids)
+    config.reload_settings()
+
+    results = []
+    for mode in args.mode:
+        for _ in range(args.repeat):
+            reset_caches()
+            fake.reset_counters()
+            timer.reset()
+            messages_before = sink.messages
+            tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ok = run_once(mode, function_app, triggers, subscription_ids)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append({
+                'mode': mode,
+                'subscriptions': subscriptions,
+                'rows_per_query': rows,
+                'ok': ok,
+                'elapsed_s': round(elapsed, 3),
+                'subscriptions_per_s': round(subscriptions / elapsed, 2),
+                'rows_per_s': round(rows * subscriptions / elapsed, 1),
+                'peak_memory_mb': round(peak / 1024 / 1024, 2),
+                'requests': dict(fake.counters),
+                'response_mb': round(fake.bytes_sent / 1024 / 1024, 2),
+                'emails': sink.messages - messages_before,
+                'stages': timer.summary()
+            })
+    return results
+
+def print_result(result):
+    status = 'ok' if result['ok'] else 'FAILED'
+    print(f"[{result['mode']}] {result['subscriptions']} subscription(s) x {result['rows_per_query']} rows: "
+          f"{result['elapsed_s']}s, {result['rows_per_s']} rows/s, {result['subscriptions_per_s']} subs/s, "
+          f"peak {result['peak_memory_mb']} MB, {result['emails']} email(s), requests {result['requests']} - {status}")
+    for label, stage in result['stages'].items():
+        print(f"    {label:<18} calls={stage['calls']:<4} total={stage['total_ms']}ms p50={stage['p50_ms']}ms max={stage['max_ms']}ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the cost report against local Azure and SMTP stand-ins.')
+    parser.add_argument('--subscriptions', type=int, nargs='+', default=[1, 5], help='Subscription counts to run.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 10000], help='Rows returned per cost query.')
+    parser.add_argument('--mode', nargs='+', choices=['execute', 'timer', 'http', 'queue'], default=['execute', 'timer', 'http'])
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added to every fake Azure call.')
+    parser.add_argument('--page-size', type=int, default=5000, help='Rows per Cost Management page.')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Answer every Nth query with HTTP 429.')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After seconds on injected 429s.')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per scenario and mode.')
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    fake = FakeAzure(
+        latency=args.latency, page_size=args.page_size,
+        throttle_every=args.throttle_every, retry_after=args.retry_after
+    ).start()
+    sink = SmtpSink().start()
+    all_results = []
+    try:
+        configure_environment(fake, sink)
+        import function_app
+        triggers = get_user_functions(function_app)
+
+        timer = StageTimer()
+        timer.install()
+        try:
+            for subscriptions in args.subscriptions:
+                for rows in args.rows:
+                    for result in run_scenario(args, fake, sink, function_app, triggers, timer, subscriptions, rows):
+                        print_result(result)
+                        all_results.append(result)
+        finally:
+            timer.uninstall()
+    finally:
+        sink.stop()
+        fake.stop()
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(all_results, f, indent=2)
+    return 0 if all(r['ok'] for r in all_results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import socketserver
+import threading
+
+class SmtpSink:
+    """
+    Minimal local SMTP server that accepts and discards every message.
+
+    Speaks just enough SMTP (EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for
+    smtplib; run the app with email_smtp_starttls=false against it.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.connections = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                with sink._lock:
+                    sink.connections += 1
+                self.reply('220 localhost benchmark SMTP sink')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode('ascii', 'replace').strip().upper()
+                    if command.startswith(('EHLO', 'HELO')):
+                        self.reply('250-localhost')
+                        self.reply('250 AUTH PLAIN LOGIN')
+                    elif command.startswith('AUTH'):
+                        self.reply('235 2.7.0 Authentication successful')
+                    elif command.startswith('DATA'):
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        size = 0
+                        for data_line in self.rfile:
+                            if data_line in (b'.\r\n', b'.\n'):
+                                break
+                            size += len(data_line)
+                        with sink._lock:
+                            sink.messages += 1
+                            sink.bytes_received += size
+                        self.reply('250 OK')
+                    elif command.startswith('QUIT'):
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('250 OK')
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
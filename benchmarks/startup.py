@@ -0,0 +1,115 @@
+"""
+Cold-start benchmark: import time and time to first execution of function_app.
+
+Every sample runs in a fresh interpreter. azure.functions is imported before
+the clock starts because the Functions Python worker has already loaded it
+when it imports the app; what is measured is the app's own startup cost.
+
+Exits with status 1 when the median import time exceeds --budget-ms (or the
+median time to first execution exceeds --first-execution-budget-ms).
+
+Usage:
+    python -m benchmarks.startup --runs 7 --budget-ms 60
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def child(first_execution):
+    """
+    Measure one cold start in this (fresh) interpreter and print it as JSON.
+    """
+    import time
+    import azure.functions  # noqa: F401  (already loaded by the worker)
+
+    result = {}
+    if first_execution:
+        from benchmarks.fake_azure import FakeAzure
+        from benchmarks.smtp_sink import SmtpSink
+        from benchmarks.run import configure_environment
+        fake = FakeAzure(rows=10, subscriptions=['00000000-0000-0000-0000-000000000000']).start()
+        sink = SmtpSink().start()
+        configure_environment(fake, sink)
+        os.environ['subscription_ids'] = fake.subscriptions[0]
+        os.environ['telemetry_enabled'] = 'false'
+
+    start = time.perf_counter()
+    import function_app
+    result['import_ms'] = (time.perf_counter() - start) * 1000
+    result['modules'] = sorted(name for name in ('requests', 'jinja2', 'dotenv', 'smtplib', 'urllib3') if name in sys.modules)
+
+    if first_execution:
+        import contextlib
+        import io
+        with contextlib.redirect_stdout(io.StringIO()):
+            outcome = function_app.execute_cost_comparison(fake.subscriptions[0])
+        result['first_execution_ms'] = (time.perf_counter() - start) * 1000
+        result['first_execution_status'] = outcome['status']
+        sink.stop()
+        fake.stop()
+
+    print(json.dumps(result))
+
+def sample(first_execution):
+    command = [sys.executable, '-m', 'benchmarks.startup', '--child']
+    if first_execution:
+        command.append('--first-execution')
+    output = subprocess.run(command, cwd=APP_DIR, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def slowest_imports(limit=10):
+    """
+    Return the modules imported by function_app with the highest cumulative
+    import time, from one `python -X importtime` run.
+    """
+    command = [sys.executable, '-X', 'importtime', '-c', 'import azure.functions; import function_app']
+    stderr = subprocess.run(command, cwd=APP_DIR, capture_output=True, text=True, check=True).stderr
+    lines = stderr.splitlines()
+    # Only the imports triggered after azure.functions is loaded belong to the app
+    start = max(i for i, line in enumerate(lines) if line.rstrip().endswith('| azure.functions')) + 1
+    timings = []
+    for line in lines[start:]:
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            timings.append((int(parts[1]) / 1000, parts[2].strip()))
+    return sorted(timings, reverse=True)[:limit]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the cold-start cost of function_app.')
+    parser.add_argument('--runs', type=int, default=7, help='Fresh interpreters sampled per measurement.')
+    parser.add_argument('--budget-ms', type=float, default=60, help='Maximum median import time of function_app.')
+    parser.add_argument('--first-execution-budget-ms', type=float, help='Maximum median import + first execute_cost_comparison time.')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--first-execution', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.first_execution)
+        return 0
+
+    imports = [sample(False) for _ in range(args.runs)]
+    import_ms = statistics.median(s['import_ms'] for s in imports)
+    print(f"function_app import: median {import_ms:.1f} ms over {args.runs} run(s) (budget {args.budget_ms:g} ms)")
+    print(f"heavy modules loaded at import: {', '.join(imports[0]['modules']) or 'none'}")
+    print("slowest imports (cumulative ms):")
+    for ms, name in slowest_imports():
+        print(f"    {ms:8.1f}  {name}")
+
+    executions = [sample(True) for _ in range(args.runs)]
+    first_ms = statistics.median(s['first_execution_ms'] for s in executions)
+    statuses = {s['first_execution_status'] for s in executions}
+    print(f"time to first execution (local stand-ins): median {first_ms:.1f} ms, status {', '.join(sorted(statuses))}")
+
+    ok = import_ms <= args.budget_ms and statuses == {'success'}
+    if args.first_execution_budget_ms is not None:
+        ok = ok and first_ms <= args.first_execution_budget_ms
+    print('within budget' if ok else 'OVER BUDGET')
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
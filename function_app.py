@@ -1,111 +1,675 @@
+import calendar
 import logging
+import os
+from functools import partial
 import azure.functions as func
-import requests
 import json
-import os
-import locale
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
+from typing import List
+from utils import config
 from utils import azure
 from utils import azure_subscription_queries
 from utils import email
+from utils import fanout
+from utils import throttle
+from utils import drilldown
+from utils import subscription_cache
+from utils import cost_exports
+from utils import telemetry
+from utils import result_cache
+# The binding decorators below need the queue names at import time;
+# work_queue itself only imports the standard library and config
+from utils import work_queue
 
-# Load environment variables and set locale
-load_dotenv()
-locale.setlocale(locale.LC_ALL, '')
-
+# Settings (.env, locale) are loaded on the first config.get_settings() call,
+# not at import time, to keep cold starts short. The cost store (sqlite3),
+# report definitions, month-to-date, anomaly and job modules are imported by
+# the functions that use them, so only code paths that need them pay for them
 app = func.FunctionApp()
 
-def execute_cost_comparison(subscription_id):
+def fetch_cost_data(subscription_id, tenant_id, usage_url, access_token, from_days_ago, to_days_ago, today, grouping=None,
+                    filter_expression=azure_subscription_queries.DEFAULT_FILTER):
     """
-    Core function that executes the cost comparison logic.
-    Can be called by both timer and HTTP triggers.
+    Fetch the daily cost rows for a window of days.
+
+    With cost_data_source=export the rows are aggregated from Cost Management
+    export files instead of the query API. Otherwise, when the local cost store
+    is enabled only the days that are missing or still unsettled are queried;
+    everything else is served from data/. Resource-level (non-default
+    grouping) queries always go to the API.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        tenant_id (str): Tenant whose Cost Management quota the queries count against.
+        usage_url (str): The Cost Management query URL for the subscription.
+        access_token (str): The access token for Azure API authentication.
+        from_days_ago (int): First (oldest) day of the window, as days before today.
+        to_days_ago (int): Last (newest) day of the window, as days before today.
+        today (datetime): Reference "now".
+        grouping (list): Dimensions to group by, defaults to ServiceName only.
+        filter_expression (dict): The dataset filter, see get_usage_data_window.
+
+    Returns:
+        iterable: Cost rows as yielded by iter_cost_data.
     """
+    import sqlite3
+    from utils import cost_store
+    headers = {'Authorization': f'Bearer {access_token}'}
+
+    def query(payload):
+        # Rows stream page by page; nextLink pages are POSTed with the same payload
+        def fetch_next(next_link):
+            return throttle.cost_management_request('POST', next_link, tenant_id=tenant_id, headers=headers, json=payload)
+        return azure_subscription_queries.iter_cost_data(fetch_next(usage_url), fetch_next)
+
+    usage_data = azure_subscription_queries.get_usage_data_window(from_days_ago, to_days_ago, today=today, grouping=grouping, filter_expression=filter_expression)
+
+    if cost_exports.is_enabled():
+        try:
+            return cost_exports.load_export_cost_data(
+                int((today - timedelta(days=from_days_ago)).strftime('%Y%m%d')),
+                int((today - timedelta(days=to_days_ago)).strftime('%Y%m%d')),
+                subscription_id=None if 'SubscriptionId' in (grouping or []) else subscription_id,
+                dataset=usage_data['dataset']
+            )
+        except KeyError as e:
+            # e.g. the export has no tags column for the filter: partial totals would be wrong
+            logging.warning(f"Cost exports cannot answer this query, using the query API: {str(e)}")
+            return query(usage_data)
+
+    if not cost_store.is_enabled() or grouping:
+        return query(usage_data)
+
+    try:
+        query_key = cost_store.get_query_key(usage_data)
+        dates = cost_store.date_range(today - timedelta(days=from_days_ago), today - timedelta(days=to_days_ago))
+        missing = cost_store.missing_dates(subscription_id, query_key, dates, today=today)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning(f"Cost store unavailable, querying the full window: {str(e)}")
+        return query(usage_data)
+
+    if missing:
+        # Delta query covering only the days the store does not have yet; the rows are
+        # fully downloaded before the store's write transaction starts
+        delta_from = (today.date() - datetime.strptime(str(missing[0]), '%Y%m%d').date()).days
+        delta_to = (today.date() - datetime.strptime(str(missing[-1]), '%Y%m%d').date()).days
+        delta_data = azure_subscription_queries.get_usage_data_window(delta_from, delta_to, today=today, filter_expression=filter_expression)
+        logging.info(f"Fetching {delta_from - delta_to + 1} day(s) of cost data for {subscription_id}")
+        delta_rows = list(query(delta_data))
+    else:
+        logging.info(f"Cost data for {subscription_id} served from the local store")
+
+    # A store failure never fails the report: the full window is queried instead
     try:
-        logging.info('Executing Azure cost comparison...')
-
-        # Retrieve environment variables
-        tenant_id = os.getenv('tenant_id')
-        client_id = os.getenv('client_id')
-        client_secret = os.getenv('client_secret')
-        email_sender = os.getenv('email_sender')
-        email_password = os.getenv('email_password')
-        email_smtp_server = os.getenv('email_smtp_server', 'smtp.sendgrid.net')
-        email_smtp_port = int(os.getenv('email_smtp_port', 587))
-        email_recipients = os.getenv('email_recipients', '').split(',')
-        azure_api_version = str(os.getenv('azure_api_version', '2024-08-01'))
-
-        usage_url = f'https://management.azure.com/subscriptions/{subscription_id}/providers/Microsoft.CostManagement/query?api-version={azure_api_version}'
-
-        # Authenticate
-        access_token = azure.authenticate_with_azure(tenant_id, client_id, client_secret)
-
-        # Get subscription name
-        subscription_name = azure.get_subscription_name(subscription_id, access_token)
-        logging.info(f"Processing subscription: {subscription_name}")
-
-        # Prepare payloads
-        usage_data_yesterday = azure_subscription_queries.get_usage_data(1)
-        usage_data_lastweek = azure_subscription_queries.get_usage_data(31)
-
-        # Make requests
-        usage_response_yesterday = requests.post(usage_url, headers={'Authorization': f'Bearer {access_token}'}, json=usage_data_yesterday)
-        usage_response_lastweek = requests.post(usage_url, headers={'Authorization': f'Bearer {access_token}'}, json=usage_data_lastweek)
-
-        # Process data
-        cost_data_yesterday = azure_subscription_queries.process_cost_data(usage_response_yesterday)
-        cost_data_lastweek = azure_subscription_queries.process_cost_data(usage_response_lastweek)
-
-        # Extract date from usage_data_yesterday
-        a_date_from = usage_data_yesterday['timePeriod']['from']
-        a_formatted_date = datetime.strptime(a_date_from, "%Y-%m-%dT%H:%M:%SZ").strftime("%d/%m/%Y")
+        if missing:
+            cost_store.save_rows(subscription_id, query_key, [d for d in dates if missing[0] <= d <= missing[-1]], delta_rows)
+        return cost_store.load_rows(subscription_id, query_key, dates[0], dates[-1])
+    except sqlite3.Error as e:
+        logging.warning(f"Cost store unavailable, querying the full window: {str(e)}")
+        return query(usage_data)
+
+def fetch_forecast(subscription_id, tenant_id, access_token, from_day, to_day, filter_expression=azure_subscription_queries.DEFAULT_FILTER):
+    """
+    Return the Cost Management forecast total for the days from_day to to_day.
+
+    Used to cross-check the locally computed end-of-month projection; the
+    forecast API shares the query API's throttling quota.
+
+    Returns:
+        float: The forecast cost, or None when the forecast is unavailable.
+    """
+    settings = config.get_settings()
+    headers = {'Authorization': f'Bearer {access_token}'}
+    forecast_url = azure_subscription_queries.get_forecast_url(f'/subscriptions/{subscription_id}', settings.azure_api_version)
+    payload = azure_subscription_queries.get_forecast_data(from_day, to_day, filter_expression)
+
+    def fetch_next(next_link):
+        return throttle.cost_management_request('POST', next_link, tenant_id=tenant_id, headers=headers, json=payload)
+    try:
+        return sum(row['cost'] for row in azure_subscription_queries.iter_cost_data(fetch_next(forecast_url), fetch_next))
+    except (KeyError, ValueError) as e:
+        logging.warning(f"Cost forecast unavailable for {subscription_id}: {str(e)}")
+        return None
+
+def build_month_to_date(subscription_id, spec, cost_data, today, available_from, fetch_table, fetch_remaining_forecast=None):
+    """
+    Update a report's month-to-date state and build its month-to-date section.
+
+    Only the days the state is missing (the report day and the still
+    unsettled days) are applied, taken from the comparison's rows; a query is
+    only made on the first run of a month when the comparison window does not
+    reach back to the 1st.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        spec (report_specs.ReportSpec): The report.
+        cost_data (CostTable): The report's daily rows of the comparison window.
+        today (datetime): Reference "now".
+        available_from (int): First usage date (YYYYMMDD) cost_data covers.
+        fetch_table (callable): Takes (from_date, to_date) and returns the report's CostTable for those days.
+        fetch_remaining_forecast (callable): Takes (from_day, to_day) and returns the forecast total, for the cross-check.
+
+    Returns:
+        dict: See month_to_date.MonthToDate.summary.
+    """
+    from utils import month_to_date
+    with telemetry.span('month_to_date', subscription_id=subscription_id, report=spec.name) as stage:
+        report_day = (today - timedelta(days=azure_subscription_queries.REPORT_DAYS_AGO)).date()
+
+        def get_day_totals(dates):
+            stage['days'] = len(dates)
+            totals, currency = month_to_date.get_day_totals(cost_data, [d for d in dates if d >= available_from])
+            older = [d for d in dates if d < available_from]
+            if older:
+                # First run of the month with a comparison window shorter than the month so far
+                older_totals, older_currency = month_to_date.get_day_totals(fetch_table(older[0], older[-1]), older)
+                totals.update(older_totals)
+                currency = currency or older_currency
+            return totals, currency
+
+        forecast = None
+        month_end = report_day.replace(day=calendar.monthrange(report_day.year, report_day.month)[1])
+        if fetch_remaining_forecast is not None:
+            forecast = fetch_remaining_forecast(report_day + timedelta(days=1), month_end) if report_day < month_end else 0.0
+
+        return month_to_date.update(spec.get_state_key(subscription_id), report_day, get_day_totals, available_from=available_from, budget=spec.monthly_budget, forecast=forecast)
+
+def resolve_subscription_ids():
+    """
+    Return the subscriptions to report on.
+
+    Uses the subscription_ids setting; when it is empty and
+    subscription_discovery is true, every enabled subscription visible to the
+    service principal (optionally filtered by subscription_discovery_tag,
+    "name" or "name=value") is reported on.
+
+    Returns:
+        list: Subscription IDs.
+    """
+    settings = config.get_settings()
+    subscription_ids = fanout.get_subscription_ids()
+    if subscription_ids or not settings.subscription_discovery:
+        return subscription_ids
+
+    access_token = azure.authenticate_with_azure(settings.tenant_id, settings.client_id, settings.client_secret)
+    subscription_ids = subscription_cache.discover_subscription_ids(access_token, tag=settings.subscription_discovery_tag)
+    logging.info(f"Discovered {len(subscription_ids)} subscription(s) to report on")
+    return subscription_ids
+
+def open_email_delivery():
+    """
+    Open the SMTP delivery shared by every subscription of one run.
+
+    Returns:
+        email.SmtpDelivery or email.DigestDelivery: The delivery, or None when the
+        email settings are incomplete (each subscription then reports the error).
+    """
+    settings = config.get_settings()
+    try:
+        return email.open_delivery(settings.email_smtp_server, settings.email_smtp_port, settings.email_password)
+    except ValueError as e:
+        logging.error(f"Email delivery unavailable: {str(e)}")
+        return None
+
+def run_cost_reports(subscription_ids, refresh=False):
+    """
+    Run the cost comparison for every subscription over one shared email session.
+
+    With the cost_scope setting, all subscriptions are served from a single
+    scope-level query instead of one query per subscription. `refresh`
+    bypasses the result cache.
+
+    Closing the delivery sends the digest (email_digest); if that fails, every
+    report that was queued for it is returned as an error.
+
+    Returns:
+        list: One result dict per subscription.
+    """
+    delivery = open_email_delivery()
+    results = None
+    try:
+        cost_scope = config.get_settings().cost_scope
+        if cost_scope:
+            results = execute_scope_comparison(cost_scope, subscription_ids, delivery=delivery)
+        else:
+            results = fanout.run_for_subscriptions(partial(execute_cost_comparison, delivery=delivery, refresh=refresh), subscription_ids)
+    finally:
+        if delivery is not None:
+            try:
+                delivery.close()
+            except Exception as e:
+                logging.error(f"Error sending the cost report email: {str(e)}")
+                if results is not None:
+                    results = [fail_queued_report(result, e) for result in results]
+    return results
+
+def fail_queued_report(result, error):
+    """
+    Turn a result whose report was queued for the digest into an error, since the digest was not sent.
+    """
+    if result.get('email') != 'queued':
+        return result
+    failed = dict(result, status="error", email="failed", message=f"Failed to send the digest email: {str(error)}")
+    if 'reports' in result:
+        failed['reports'] = [fail_queued_report(report, error) for report in result['reports']]
+    return failed
+
+def build_cost_comparison(subscription_id, cost_data, today, baseline_days, top_movers=None, highlight_threshold=10, report_name=None, anomaly_key=None):
+    """
+    Compare a subscription's report day against its baseline.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        cost_data (CostTable): Daily cost rows covering the report day and the baseline days.
+        today (datetime): Reference "now" the windows were computed from.
+        baseline_days (list): Days before today that make up the baseline.
+        top_movers (drilldown.TopMovers): Resource-level movers, when drill-down is enabled.
+        highlight_threshold (float): Percentage increase highlighted in the report.
+        report_name (str): Name of the report definition (see report_specs), kept in the comparison.
+        anomaly_key (str): Anomaly state of the report (see anomaly.score_day); rows are
+            highlighted by anomaly score when given and anomaly detection is enabled.
+
+    Returns:
+        dict: The comparison, see azure_subscription_queries.build_comparison.
+    """
+    from utils import anomaly
+    with telemetry.span('comparison', subscription_id=subscription_id, report=report_name) as stage:
+        a_formatted_date, cost_data_report_day = azure_subscription_queries.build_baseline(cost_data, [azure_subscription_queries.REPORT_DAYS_AGO], today=today)
         logging.info(f"Data extracted for comparison: {a_formatted_date}")
 
-        # Extract date from usage_data_lastweek
-        b_date_from = usage_data_lastweek['timePeriod']['from']
-        b_formatted_date = datetime.strptime(b_date_from, "%Y-%m-%dT%H:%M:%SZ").strftime("%d/%m/%Y")
+        b_formatted_date, cost_data_baseline = azure_subscription_queries.build_baseline(cost_data, baseline_days, today=today)
         logging.info(f"Data extracted for comparison: {b_formatted_date}")
 
+        # Score the report day's services (and resources) against their rolling history
+        scores = None
+        anomaly_threshold = None
+        if anomaly_key and anomaly.is_enabled():
+            report_date = int((today - timedelta(days=azure_subscription_queries.REPORT_DAYS_AGO)).strftime('%Y%m%d'))
+            # Services without cost on the report day are scored at zero
+            values = dict.fromkeys(filter(None, cost_data.services.values), 0.0)
+            values.update(cost_data.daily_service_totals({report_date}).get(report_date, {}))
+            if top_movers:
+                values.update(top_movers.report_costs())
+            with telemetry.span('anomaly', series=len(values)):
+                # A new state is seeded with the earlier days of the rows at hand
+                scores = anomaly.score_day(
+                    anomaly_key, report_date, values,
+                    lambda before: cost_data.daily_service_totals({d for d in cost_data.dates if d < before})
+                )
+            anomaly_threshold = config.get_settings().anomaly_threshold
+
         # Analytics and reporting
-        html_report = azure_subscription_queries.compare_service_costs(cost_data_yesterday, cost_data_lastweek, a_formatted_date, b_formatted_date)
+        comparison = azure_subscription_queries.build_comparison(
+            cost_data_report_day, cost_data_baseline, a_formatted_date, b_formatted_date,
+            highlight_threshold=highlight_threshold,
+            top_movers=top_movers.results() if top_movers else None,
+            scores=scores,
+            anomaly_threshold=anomaly_threshold
+        )
+        if report_name:
+            comparison['report'] = report_name
+        stage['rows'] = len(comparison['rows'])
+    return comparison
+
+def deliver_report(subscription_id, subscription_name, comparison, delivery=None, recipients=None):
+    """
+    Print a subscription's comparison and email it.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        subscription_name (str): The subscription display name.
+        comparison (dict): Result of build_cost_comparison.
+        delivery (email.SmtpDelivery or email.DigestDelivery): Shared email delivery of the run.
+        recipients (list): The report's own recipients, defaults to the email_recipients setting.
+
+    Returns:
+        dict: The success result for the subscription; 'email' is 'queued' when the
+        report waits for the digest (sent when the run's delivery is closed), else 'sent'.
+    """
+    with telemetry.span('print', subscription_id=subscription_id):
+        azure_subscription_queries.print_comparison(comparison, subscription_name)
 
-        # Set report date environment variable for email
-        os.environ['REPORT_DATE'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Report date for email (kept local so concurrent runs do not clash)
+    report_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Send email with proper parameters including subscription name
+    # Send email with proper parameters including subscription name
+    settings = config.get_settings()
+    with telemetry.span('email', subscription_id=subscription_id):
         email.send_email(
-            html_table_rows=html_report,
-            email_smtp_server=email_smtp_server,
-            email_smtp_port=email_smtp_port,
-            email_password=email_password,
-            label_a=a_formatted_date,
-            label_b=b_formatted_date,
-            subscription_name=subscription_name
+            comparison=comparison,
+            email_smtp_server=settings.email_smtp_server,
+            email_smtp_port=settings.email_smtp_port,
+            email_password=settings.email_password,
+            subscription_name=subscription_name,
+            report_date=report_date,
+            delivery=delivery,
+            recipients=recipients
         )
 
+    if isinstance(delivery, email.DigestDelivery):
+        logging.info("Azure Cost Comparison Report generated and queued for the digest email")
+        sent, message = 'queued', "Cost comparison report generated and queued for the digest email"
+    else:
         logging.info("Azure Cost Comparison Report generated and sent successfully")
-        return {
-            "status": "success",
-            "message": "Cost comparison report generated and sent successfully",
-            "report_date": os.environ.get('REPORT_DATE'),
-            "subscription_name": subscription_name,
-            "comparison_dates": {
-                "current": a_formatted_date,
-                "previous": b_formatted_date
-            }
+        sent, message = 'sent', "Cost comparison report generated and sent successfully"
+    return report_result(subscription_id, subscription_name, comparison, sent, message, report_date)
+
+def report_result(subscription_id, subscription_name, comparison, sent, message, report_date=None):
+    """
+    Build the success result of one subscription's report.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        subscription_name (str): The subscription display name.
+        comparison (dict): Result of build_cost_comparison.
+        sent (str): 'sent', 'queued' or 'cached' (served from the result cache, not emailed again).
+        message (str): Human readable outcome.
+        report_date (str): When the report was emailed, None when it was not.
+    """
+    from utils import report_specs
+    return {
+        "status": "success",
+        "message": message,
+        "email": sent,
+        "report": comparison.get('report', report_specs.DEFAULT_REPORT),
+        "report_date": report_date,
+        "subscription_id": subscription_id,
+        "subscription_name": subscription_name,
+        "comparison_dates": {
+            "current": comparison['label_a'],
+            "previous": comparison['label_b']
         }
+    }
+
+def report_cost_data(subscription_id, subscription_name, cost_data, today, baseline_days, top_movers=None, delivery=None, anomaly_key=None):
+    """
+    Compare a subscription's report day against its baseline and email the result.
+
+    See build_cost_comparison and deliver_report for the arguments.
+
+    Returns:
+        dict: The success result for the subscription.
+    """
+    comparison = build_cost_comparison(subscription_id, cost_data, today, baseline_days, top_movers=top_movers, anomaly_key=anomaly_key)
+    return deliver_report(subscription_id, subscription_name, comparison, delivery=delivery)
+
+def execute_cost_comparison(subscription_id, delivery=None, today=None, refresh=False, specs=None):
+    """
+    Core function that executes the cost comparison logic.
+    Can be called by the timer, HTTP and queue triggers.
+
+    Every report definition covering the subscription (see report_specs,
+    default: the built-in report) is produced from the fewest Cost Management
+    queries: reports whose queries are identical or subsumable share one query
+    and each report's view is projected from its rows locally.
+
+    When a shared email delivery is given the report is sent over it (or added
+    to the digest) instead of opening a new SMTP connection. Every stage is
+    timed as a telemetry span and, with the profile_mode setting, the whole
+    run is profiled. `today` pins the reference date (queued reports keep the
+    day they were scheduled for).
+
+    A comparison already computed for the same subscription, dates and query
+    is served from the result cache, skipping authentication, the queries and
+    the comparison; only the email is sent again. `refresh` bypasses the cache.
+
+    Returns:
+        dict: The subscription's result; with several reports each report's
+        own result is listed under 'reports'.
+    """
+    from utils import anomaly, month_to_date, report_specs
+    try:
+        with telemetry.profiled(subscription_id), telemetry.span('cost_comparison', subscription_id=subscription_id) as run:
+            logging.info('Executing Azure cost comparison...')
+
+            # Retrieve settings and the reports covering this subscription
+            settings = config.get_settings()
+            tenant_id = settings.tenant_id
+            specs = [spec for spec in (specs or report_specs.load_report_specs()) if spec.covers(subscription_id)]
+            if not specs:
+                logging.info(f"No report is configured for {subscription_id}")
+                return {
+                    "status": "success",
+                    "message": "No report is configured for this subscription",
+                    "subscription_id": subscription_id
+                }
+            run['reports'] = len(specs)
+
+            today = today or datetime.now()
+
+            def to_dates(days):
+                return [int((today - timedelta(days=d)).strftime('%Y%m%d')) for d in days]
+            report_dates = to_dates([azure_subscription_queries.REPORT_DAYS_AGO])
+
+            # Repeat runs for the same dates and query reuse the computed comparison
+            comparisons = {}
+            cache_keys = {}
+            subscription_name = None
+            if result_cache.is_enabled():
+                for spec in specs:
+                    usage_data = azure_subscription_queries.get_usage_data_window(
+                        spec.window_start, azure_subscription_queries.REPORT_DAYS_AGO, today=today,
+                        grouping=list(spec.dimensions), filter_expression=spec.filter
+                    )
+                    cache_keys[spec.name] = result_cache.get_cache_key(
+                        subscription_id, report_dates, to_dates(spec.baseline_days), usage_data,
+                        group_by=spec.group_by, highlight_threshold=spec.highlight_threshold,
+                        drilldown_top_k=settings.drilldown_top_k if 'ResourceId' in spec.dimensions else None,
+                        month_to_date=[spec.monthly_budget, settings.mtd_forecast_check] if month_to_date.is_enabled() else None,
+                        anomaly=[settings.anomaly_window, settings.anomaly_min_days, settings.anomaly_threshold, settings.anomaly_min_cost] if anomaly.is_enabled() else None
+                    )
+                    cached = None if refresh else result_cache.get(cache_keys[spec.name])
+                    if cached:
+                        subscription_name = cached['subscription_name']
+                        comparisons[spec.name] = cached['comparison']
+                run['cache'] = 'refresh' if refresh else ('hit' if len(comparisons) == len(specs) else 'partial' if comparisons else 'miss')
+            cached_names = set(comparisons)
+
+            missing = [spec for spec in specs if spec.name not in comparisons]
+            if missing:
+                usage_url = azure_subscription_queries.get_query_url(f'/subscriptions/{subscription_id}', settings.azure_api_version)
+
+                # Authenticate
+                with telemetry.span('authenticate'):
+                    access_token = azure.authenticate_with_azure(tenant_id, settings.client_id, settings.client_secret)
+
+                # Get subscription name
+                with telemetry.span('subscription_name'):
+                    subscription_name = subscription_cache.get_subscription_name(subscription_id, access_token)
+                logging.info(f"Processing subscription: {subscription_name}")
+
+                def fetch_table(spec, from_date, to_date):
+                    # One report's rows for other days than the comparison window
+                    query = report_specs.plan_queries([spec])[0]
+                    from_days_ago, to_days_ago = ((today.date() - datetime.strptime(str(d), '%Y%m%d').date()).days for d in (from_date, to_date))
+                    rows = fetch_cost_data(
+                        subscription_id, tenant_id, usage_url, access_token, from_days_ago, to_days_ago, today,
+                        grouping=query.grouping, filter_expression=query.filter
+                    )
+                    rows = query.project(spec, rows)
+                    if len(query.dimensions) > 1:
+                        rows = azure_subscription_queries.aggregate_by_service(rows)
+                    return azure_subscription_queries.load_cost_table(rows)
+
+                # One Daily-granularity query per distinct planned query, covering the
+                # report day and every baseline day of the reports it serves
+                for query in report_specs.plan_queries(missing):
+                    # Fetch data (served from the local store where possible) and split it
+                    # locally into the reports' views; rows stream, so the span covers
+                    # both the requests and the parsing
+                    with telemetry.span('cost_query', reports=len(query.specs)) as stage:
+                        cost_rows = fetch_cost_data(
+                            subscription_id, tenant_id, usage_url, access_token, query.window_start, query.window_end, today,
+                            grouping=query.grouping, filter_expression=query.filter
+                        )
+                        if len(query.specs) > 1:
+                            # Several reports read the same rows
+                            cost_rows = list(cost_rows)
+
+                        views = []
+                        for spec in query.specs:
+                            spec_rows = query.project(spec, cost_rows)
+                            # Resource-level top movers are ranked while the rows stream through;
+                            # the comparison itself only needs the rows summed per day and service
+                            top_movers = None
+                            if 'ResourceId' in spec.dimensions:
+                                top_movers = drilldown.TopMovers(report_dates, to_dates(spec.baseline_days), keep_report_costs=anomaly.is_enabled())
+                                spec_rows = azure_subscription_queries.aggregate_by_service(top_movers.observe(spec_rows))
+                            elif len(query.dimensions) > 1:
+                                # The query groups by more than this report needs (e.g. it also
+                                # serves a drill-down): one row per day and service
+                                spec_rows = azure_subscription_queries.aggregate_by_service(spec_rows)
+                            views.append((spec, azure_subscription_queries.load_cost_table(spec_rows), top_movers))
+                        stage['rows'] = sum(len(cost_data) for _, cost_data, _ in views)
+
+                    for spec, cost_data, top_movers in views:
+                        comparison = build_cost_comparison(
+                            subscription_id, cost_data, today, spec.baseline_days, top_movers=top_movers,
+                            highlight_threshold=spec.highlight_threshold, report_name=spec.name,
+                            anomaly_key=spec.get_state_key(subscription_id)
+                        )
+                        if month_to_date.is_enabled():
+                            comparison['month_to_date'] = build_month_to_date(
+                                subscription_id, spec, cost_data, today, to_dates([query.window_start])[0], partial(fetch_table, spec),
+                                partial(fetch_forecast, subscription_id, tenant_id, access_token, filter_expression=spec.filter)
+                                if settings.mtd_forecast_check else None
+                            )
+                        comparisons[spec.name] = comparison
+                        if spec.name in cache_keys:
+                            result_cache.put(cache_keys[spec.name], {
+                                'subscription_name': subscription_name,
+                                'comparison': comparison
+                            }, settings.result_cache_unsettled_ttl)
+            else:
+                logging.info(f"Serving the cost comparison of {subscription_name} from the result cache")
+
+            # A cached comparison was emailed by the run that computed it
+            results = [
+                report_result(subscription_id, subscription_name, comparisons[spec.name], 'cached',
+                              "Cost comparison report served from the result cache, already emailed")
+                if spec.name in cached_names else
+                deliver_report(subscription_id, subscription_name, comparisons[spec.name], delivery=delivery, recipients=spec.recipients)
+                for spec in specs
+            ]
+            if len(results) == 1:
+                return results[0]
+            emailed = [result for result in results if result['email'] != 'cached']
+            if not emailed:
+                message = f"{len(results)} cost comparison reports served from the result cache, already emailed"
+            else:
+                message = (f"{len(emailed)} of {len(results)} cost comparison reports generated and "
+                           f"{'queued for the digest email' if emailed[0]['email'] == 'queued' else 'sent successfully'}")
+            return dict(emailed[0] if emailed else results[0], message=message, reports=results)
 
     except Exception as e:
         logging.error(f"Error executing cost comparison: {str(e)}")
         return {
             "status": "error",
+            "subscription_id": subscription_id,
             "message": f"Failed to generate cost comparison report: {str(e)}"
         }
 
+# Set once the scope limitations were logged, see warn_scope_limitations
+_scope_limitations_logged = False
+
+def warn_scope_limitations(settings):
+    """
+    Log once per process the enabled features that cost_scope runs leave out.
+
+    A scope run produces the built-in report (with anomaly scoring) from one
+    query grouped by SubscriptionId and ServiceName; report definitions,
+    month-to-date and the resource-level drill-down need per-subscription
+    queries and only apply without cost_scope.
+    """
+    global _scope_limitations_logged
+    ignored = [name for name, enabled in (
+        (f'report definitions ({settings.report_specs_path})', bool(settings.report_specs_path) and os.path.exists(settings.report_specs_path)),
+        ('month-to-date (mtd_enabled)', settings.mtd_enabled),
+        ('drill-down (drilldown_enabled)', settings.drilldown_enabled)
+    ) if enabled]
+    if ignored and not _scope_limitations_logged:
+        _scope_limitations_logged = True
+        logging.warning(f"cost_scope runs only produce the built-in report; ignoring {', '.join(ignored)}")
+
+def execute_scope_comparison(scope, subscription_ids=None, delivery=None):
+    """
+    Run the cost comparison for many subscriptions from one scope-level query.
+
+    A single Cost Management query at management-group or billing-account scope,
+    grouped by SubscriptionId and ServiceName, is split in memory into one
+    comparison per subscription. Each uses the built-in report and shares its
+    anomaly state with the per-subscription runs; see warn_scope_limitations
+    for what is left out.
+
+    Args:
+        scope (str): The management-group or billing-account scope.
+        subscription_ids (list): Subscriptions to report on; all returned subscriptions when empty.
+        delivery (email.SmtpDelivery or email.DigestDelivery): Shared email delivery of the run.
+
+    Returns:
+        list: One result dict per subscription.
+    """
+    from utils import report_specs
+    try:
+        logging.info(f'Executing Azure cost comparison at scope {scope}...')
+
+        settings = config.get_settings()
+        tenant_id = settings.tenant_id
+        comparison_baseline = settings.comparison_baseline
+        if comparison_baseline not in azure_subscription_queries.BASELINES:
+            raise ValueError(f"Unknown comparison_baseline '{comparison_baseline}'.")
+        warn_scope_limitations(settings)
+        spec = report_specs.ReportSpec.from_dict({}, settings)
+
+        with telemetry.span('authenticate', scope=scope):
+            access_token = azure.authenticate_with_azure(tenant_id, settings.client_id, settings.client_secret)
+
+        today = datetime.now()
+        baseline_days = azure_subscription_queries.BASELINES[comparison_baseline]
+        window_start = azure_subscription_queries.get_comparison_window([comparison_baseline])
+        with telemetry.profiled(scope), telemetry.span('cost_query', scope=scope) as stage:
+            cost_rows = fetch_cost_data(
+                scope, tenant_id, azure_subscription_queries.get_query_url(scope, settings.azure_api_version), access_token,
+                window_start, azure_subscription_queries.REPORT_DAYS_AGO, today,
+                grouping=azure_subscription_queries.SCOPE_GROUPING
+            )
+            tables = azure_subscription_queries.split_by_subscription(cost_rows, subscription_ids)
+            stage['rows'] = sum(len(table) for table in tables.values())
+    except Exception as e:
+        logging.error(f"Error executing scope cost comparison: {str(e)}")
+        return [{
+            "status": "error",
+            "subscription_id": sub_id,
+            "message": f"Failed to generate cost comparison report: {str(e)}"
+        } for sub_id in (subscription_ids or [scope])]
+
+    results = []
+    for sub_id in (subscription_ids or sorted(tables)):
+        try:
+            with telemetry.span('subscription_name', subscription_id=sub_id):
+                subscription_name = subscription_cache.get_subscription_name(sub_id, access_token)
+            cost_data = tables.get(sub_id.lower()) or azure_subscription_queries.load_cost_table([])
+            results.append(report_cost_data(
+                sub_id, subscription_name, cost_data, today, baseline_days, delivery=delivery,
+                anomaly_key=spec.get_state_key(sub_id)
+            ))
+        except Exception as e:
+            logging.error(f"Error executing cost comparison for {sub_id}: {str(e)}")
+            results.append({
+                "status": "error",
+                "subscription_id": sub_id,
+                "message": f"Failed to generate cost comparison report: {str(e)}"
+            })
+    return results
+
 @app.timer_trigger(schedule="0 10 9 * * *", arg_name="daily6am", run_on_startup=False, use_monitor=False)
-def schedule_cost_report_1(daily6am: func.TimerRequest) -> None:
+@app.queue_output(arg_name="queue", queue_name=work_queue.QUEUE_NAME, connection=work_queue.STORAGE_CONNECTION)
+def schedule_cost_report_1(daily6am: func.TimerRequest, queue: func.Out[List[str]]) -> None:
     """
     Timer-triggered function that runs the cost comparison on schedule.
+
+    With the queue_mode setting it only enqueues one message per subscription
+    instead of running the reports itself.
     """
     if daily6am.past_due:
         logging.info('The timer is past due!')
@@ -113,58 +677,99 @@ def schedule_cost_report_1(daily6am: func.TimerRequest) -> None:
     logging.info('Timer triggered Azure cost comparison function executed.')
 
     try:
-        result_mvx_dev = execute_cost_comparison("bfb38ea5-2e52-42a4-86a8-b5ff06ef1178")
-    except Exception as e:
-        logging.error(f"Error processing DEV subscription: {str(e)}")
-        result_mvx_dev = {"status": "error", "message": str(e)}
+        subscription_ids = resolve_subscription_ids()
+    except ValueError as e:
+        logging.error(f"Subscription discovery failed: {str(e)}")
+        return
+    if not subscription_ids and not config.get_settings().cost_scope:
+        logging.error("No subscriptions configured. Set the subscription_ids setting.")
+        return
 
-    try:
-        result_mvx_prod = execute_cost_comparison("6e6145fd-2644-4673-96f0-a813a725ca4c")
-    except Exception as e:
-        logging.error(f"Error processing PROD subscription: {str(e)}")
-        result_mvx_prod = {"status": "error", "message": str(e)}
+    # Queue mode: fan the subscriptions out to process_cost_report_message,
+    # which the host scales across instances
+    if config.get_settings().queue_mode and not config.get_settings().cost_scope:
+        report_day = work_queue.get_report_day(datetime.now(), azure_subscription_queries.REPORT_DAYS_AGO)
+        messages = work_queue.build_messages(subscription_ids, report_day)
+        queue.set(messages)
+        logging.info(f"Enqueued {len(messages)} cost report(s) for {report_day} on {work_queue.QUEUE_NAME}")
+        return
 
-    logging.info(f"Timer trigger result: DEV {result_mvx_dev} | PROD {result_mvx_prod}")
+    results = run_cost_reports(subscription_ids)
+
+    for result in results:
+        logging.info(f"Timer trigger result: {result}")
+
+def get_refresh_flag(req):
+    """
+    Read the result-cache bypass flag from the query string (?refresh=true) or a JSON body ({"refresh": true}).
+    """
+    if req.params.get('refresh', '').lower() in ('true', '1'):
+        return True
+    try:
+        body = req.get_json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and str(body.get('refresh', '')).lower() in ('true', '1')
 
 @app.route(route="cost-report", methods=["GET", "POST"])
-def manual_cost_report_1(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="queue", queue_name=work_queue.QUEUE_NAME, connection=work_queue.STORAGE_CONNECTION)
+def manual_cost_report_1(req: func.HttpRequest, queue: func.Out[List[str]]) -> func.HttpResponse:
     """
     HTTP-triggered function to manually start the cost comparison report.
 
+    The reports are enqueued on the work queue and run by
+    process_cost_report_message, on whichever instance the host picks; the
+    response is returned immediately. The job and its outcome are kept in
+    blob storage (see jobs), so any instance can answer the status route. A
+    request for the same subscriptions and report day as a job that is still
+    running joins that job instead of starting another run.
+
     Usage:
     - GET /api/cost-report - Trigger the report generation
     - POST /api/cost-report - Trigger the report generation (supports JSON body for future parameters)
+    - GET /api/cost-report?refresh=true or POST {"refresh": true} - Recompute instead of using cached results
+    - GET /api/cost-report/{job_id} - Poll the job's status and results
 
     Returns:
-    - JSON response with status and details
+    - 202 with the job ID and its status URL (also in the Location header)
     """
+    from utils import jobs
     logging.info('HTTP trigger function processed a request for manual cost report.')
 
     try:
-        # List of subscription IDs to process
-        subscription_ids = [
-            "bfb38ea5-2e52-42a4-86a8-b5ff06ef1178",  # DEV
-            "6e6145fd-2644-4673-96f0-a813a725ca4c"   # PROD
-        ]
-
-        results = []
-        for sub_id in subscription_ids:
-            result = execute_cost_comparison(sub_id)
-            results.append(result)
-
-        # Check if all succeeded
-        if all(r["status"] == "success" for r in results):
-            return func.HttpResponse(
-            body=json.dumps(results, indent=2),
-            status_code=200,
-            headers={"Content-Type": "application/json"}
+        # Subscription IDs to process come from the subscription_ids setting
+        subscription_ids = resolve_subscription_ids()
+        settings = config.get_settings()
+        cost_scope = settings.cost_scope
+        if not subscription_ids and not cost_scope:
+            raise ValueError("No subscriptions configured. Set the subscription_ids setting.")
+
+        refresh = get_refresh_flag(req)
+        report_day = work_queue.get_report_day(datetime.now(), azure_subscription_queries.REPORT_DAYS_AGO)
+        key = [sorted(sub_id.lower() for sub_id in subscription_ids), cost_scope, report_day, refresh]
+        # A scope query or an email digest covers every subscription in one run
+        batch = bool(cost_scope) or settings.email_digest
+        parts = ['all'] if batch else list(dict.fromkeys(subscription_ids))
+        job_id, created = jobs.create_job(key, subscription_ids, report_day, parts)
+        if created:
+            queue.set(
+                [work_queue.build_batch_message(subscription_ids, report_day, job_id, refresh=refresh)] if batch
+                else work_queue.build_messages(subscription_ids, report_day, job_id=job_id, refresh=refresh)
             )
         else:
-                return func.HttpResponse(
-                body=json.dumps(results, indent=2),
-                status_code=500,
-                headers={"Content-Type": "application/json"}
-                )
+            logging.info(f"Request joined in-flight cost report job {job_id}")
+
+        status_url = f"{req.url.split('?', 1)[0].rstrip('/')}/{job_id}"
+        return func.HttpResponse(
+            body=json.dumps({
+                "job_id": job_id,
+                "status": 'queued' if created else jobs.get_job_status(job_id, include_results=False),
+                "coalesced": not created,
+                "status_url": status_url
+            }, indent=2),
+            status_code=202,
+            headers={"Content-Type": "application/json", "Location": status_url}
+        )
 
     except Exception as e:
         error_response = {
@@ -177,3 +782,100 @@ def manual_cost_report_1(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500,
             headers={"Content-Type": "application/json"}
         )
+
+@app.route(route="cost-report/{job_id}", methods=["GET"])
+def cost_report_status(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    HTTP-triggered function returning the status and results of a cost report job.
+
+    Returns:
+    - 202 while the job is queued or running, 200 once it succeeded, 500 if any
+      subscription failed or a part never reported (expired), and 404 for
+      unknown jobs or jobs past job_retention
+    """
+    from utils import jobs
+    job = jobs.get_job_status(req.route_params.get('job_id'))
+    if job is None:
+        return func.HttpResponse(
+            body=json.dumps({"status": "error", "message": "Unknown or expired job ID."}, indent=2),
+            status_code=404,
+            headers={"Content-Type": "application/json"}
+        )
+
+    status_code = {'succeeded': 200, 'failed': 500, 'expired': 500}.get(job['status'], 202)
+    return func.HttpResponse(
+        body=json.dumps(job, indent=2),
+        status_code=status_code,
+        headers={"Content-Type": "application/json"}
+    )
+
+@app.queue_trigger(arg_name="msg", queue_name=work_queue.QUEUE_NAME, connection=work_queue.STORAGE_CONNECTION)
+def process_cost_report_message(msg: func.QueueMessage) -> None:
+    """
+    Queue-triggered function running one subscription's cost comparison.
+
+    A marker blob per subscription and report day is claimed before the
+    report runs (see work_queue.claim_marker), so duplicate messages, even
+    delivered at the same time, send one email. A failed report releases the
+    marker and raises, so the host retries the message and, after
+    maxDequeueCount attempts (host.json), moves it to the poison queue.
+    """
+    from utils import jobs
+    try:
+        message = work_queue.parse_message(msg.get_body())
+    except ValueError as e:
+        # A malformed message will never succeed; do not retry it
+        logging.error(f"Discarding queue message {msg.id}: {str(e)}")
+        return
+
+    subscription_id = message.get('subscription_id')
+    report_day = message['report_day']
+    job_id = message.get('job_id')
+    part = work_queue.get_part(message)
+    marker_name = work_queue.get_marker_name(message)
+    if not work_queue.claim_marker(marker_name, msg.id):
+        logging.info(f"Cost report {part} on {report_day} was already sent or is being sent; skipping message {msg.id}")
+        return
+
+    logging.info(f"Processing queued cost report {part} on {report_day} (attempt {msg.dequeue_count})")
+    if job_id:
+        jobs.start_part(job_id, part)
+    try:
+        if subscription_id:
+            today = datetime.strptime(report_day, '%Y%m%d') + timedelta(days=azure_subscription_queries.REPORT_DAYS_AGO)
+            result = execute_cost_comparison(subscription_id, today=today, refresh=message.get('refresh', False))
+            if result["status"] != "success":
+                raise RuntimeError(result["message"])
+            results = [result]
+        else:
+            # A batch (scope or digest) reports its failures per subscription instead of
+            # raising: a retry would send the successful reports again
+            results = run_cost_reports(message['subscription_ids'], refresh=message.get('refresh', False))
+    except Exception:
+        work_queue.release_marker(marker_name)
+        raise
+
+    if job_id:
+        jobs.finish_part(job_id, part, results)
+    work_queue.complete_marker(marker_name, results[0] if subscription_id else {})
+    logging.info(f"Queue trigger result: {results}")
+
+@app.queue_trigger(arg_name="msg", queue_name=work_queue.POISON_QUEUE_NAME, connection=work_queue.STORAGE_CONNECTION)
+def process_cost_report_poison(msg: func.QueueMessage) -> None:
+    """
+    Log cost reports that failed every retry so they can be investigated and re-queued.
+
+    A manual job's part is recorded as failed, so its status route stops reporting it as running.
+    """
+    from utils import jobs
+    logging.error(f"Cost report message {msg.id} failed after every retry and was moved to {work_queue.POISON_QUEUE_NAME}: {msg.get_body().decode('utf-8', 'replace')}")
+    try:
+        message = work_queue.parse_message(msg.get_body())
+    except ValueError:
+        return
+    if message.get('job_id'):
+        subscription_ids = [message['subscription_id']] if message.get('subscription_id') else message['subscription_ids']
+        jobs.finish_part(message['job_id'], work_queue.get_part(message), [
+            {"status": "error", "subscription_id": sub_id, "message": "Failed to generate cost comparison report after every retry"}
+            for sub_id in subscription_ids or [message.get('subscription_id')]
+        ])
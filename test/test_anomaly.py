@@ -0,0 +1,80 @@
+import json
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+from utils import anomaly
+from utils import config
+
+class AnomalyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(os.environ, {
+            'anomaly_state_path': '', 'anomaly_window': '7', 'anomaly_min_days': '3', 'anomaly_min_cost': '1'
+        }))
+        config.reload_settings()
+        self.addCleanup(config.reload_settings)
+
+    def observe_days(self, state, costs, first=20261001):
+        for offset, cost in enumerate(costs):
+            state.observe(first + offset, {'Storage': cost})
+
+    def test_no_score_before_the_minimum_history(self):
+        state = anomaly.AnomalyState('key')
+        self.observe_days(state, [10.0, 11.0, 12.0])
+        self.assertIsNone(state.score('Storage', 50.0))
+        self.assertIsNone(state.score('Bandwidth', 50.0))
+
+    def test_spike_scores_above_normal_days(self):
+        state = anomaly.AnomalyState('key')
+        self.observe_days(state, [10.0, 11.0, 9.0, 10.0, 12.0, 10.0, 11.0])
+        self.assertGreater(state.score('Storage', 40.0), 3.5)
+        self.assertLess(state.score('Storage', 12.0), 3.5)
+        # Increases below anomaly_min_cost and decreases never score
+        self.assertEqual(state.score('Storage', 10.5), 0.0)
+        self.assertEqual(state.score('Storage', 2.0), 0.0)
+
+    def test_flat_history_makes_any_increase_stand_out(self):
+        state = anomaly.AnomalyState('key')
+        self.observe_days(state, [5.0] * 5)
+        self.assertEqual(state.score('Storage', 7.0), math.inf)
+
+    def test_same_day_replaces_and_earlier_day_is_ignored(self):
+        state = anomaly.AnomalyState('key')
+        self.assertTrue(state.observe(20261002, {'Storage': 1.0}))
+        self.assertTrue(state.observe(20261002, {'Storage': 2.0}))
+        self.assertFalse(state.observe(20261001, {'Storage': 3.0}))
+        self.assertEqual(state.pending, {'Storage': 2.0})
+        self.assertEqual(state.series, {})
+
+    def test_series_at_zero_for_a_window_is_forgotten(self):
+        state = anomaly.AnomalyState('key')
+        self.observe_days(state, [4.0] + [0.0] * 7 + [0.0])
+        self.assertNotIn('Storage', state.series)
+
+    def test_window_states_are_converted(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, 'key.json'), 'w', encoding='utf-8') as f:
+            json.dump({'pending_date': 20261008, 'pending': {}, 'series': {'Storage': [10.0, 1.0, 8, [9.0, 0.0, 11.0, 0.0, 0.0]]}}, f)
+        with mock.patch.dict(os.environ, {'anomaly_state_path': path}):
+            config.reload_settings()
+            state = anomaly.AnomalyState.load('key')
+        self.assertEqual(state.series['Storage'], [10.0, 1.0, 8, 2])
+        self.assertEqual(state.score('Storage', 13.0), 3.0)
+
+    def test_score_day_seeds_a_new_state_from_history(self):
+        history = {20261000 + day: {'Storage': 10.0 + day % 2} for day in range(1, 8)}
+        requested = []
+
+        def get_history(before):
+            requested.append(before)
+            return history
+
+        scores = anomaly.score_day('key', 20261008, {'Storage': 40.0, 'Bandwidth': 3.0}, get_history)
+        self.assertEqual(requested, [20261008])
+        self.assertGreater(scores['Storage'], 3.5)
+        self.assertIsNone(scores['Bandwidth'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from utils import azure_subscription_queries
+from utils import cost_table
+
+ROWS = [
+    {'cost': 1.5, 'date': 20261001, 'service': 'Storage', 'currency': 'EUR', 'ResourceId': '/r/a'},
+    {'cost': 2.0, 'date': 20261001, 'service': 'Storage', 'currency': 'EUR', 'ResourceId': '/r/b'},
+    {'cost': 4.0, 'date': 20261002, 'service': 'Virtual Machines', 'currency': 'EUR', 'ResourceId': '/r/c'},
+    {'cost': 0.5, 'date': 20261002, 'service': 'Storage', 'currency': 'EUR', 'ResourceId': '/r/a'},
+]
+
+class CostTableTest(unittest.TestCase):
+
+    def test_rows_round_trip(self):
+        table = cost_table.CostTable.from_rows(ROWS, dimensions=('ResourceId',))
+        self.assertEqual(len(table), 4)
+        self.assertEqual(list(table.iter_rows()), ROWS)
+        self.assertEqual(table.services.values, ['Storage', 'Virtual Machines'])
+
+    def test_service_totals(self):
+        table = cost_table.CostTable.from_rows(ROWS)
+        storage, machines = table.services.codes['Storage'], table.services.codes['Virtual Machines']
+        self.assertEqual(table.service_totals(), {storage: 4.0, machines: 4.0})
+        self.assertEqual(table.service_totals({20261001}), {storage: 3.5})
+        self.assertEqual(table.daily_service_totals({20261002, 20261003}), {20261002: {'Virtual Machines': 4.0, 'Storage': 0.5}})
+        self.assertEqual(table.service_currencies(), ['EUR', 'EUR'])
+
+    def test_as_cost_table(self):
+        table = cost_table.as_cost_table(ROWS)
+        self.assertIsInstance(table, cost_table.CostTable)
+        self.assertIs(cost_table.as_cost_table(table), table)
+
+    def test_column_indexes(self):
+        indexes = cost_table.get_column_indexes([{'name': 'PreTaxCost'}, {'name': 'UsageDate'}, {'name': 'ResourceId'}, {'name': 'Currency'}])
+        self.assertEqual(indexes, {'cost': 0, 'date': 1, 'ResourceId': 2, 'currency': 3})
+        self.assertEqual(cost_table.get_column_indexes(None)['service'], 2)
+        with self.assertRaises(KeyError):
+            cost_table.get_column_indexes([{'name': 'UsageDate'}])
+
+    def test_resource_rows_aggregate_per_service(self):
+        rows = azure_subscription_queries.aggregate_by_service(ROWS)
+        self.assertEqual(rows, [
+            {'cost': 3.5, 'date': 20261001, 'service': 'Storage', 'currency': 'EUR'},
+            {'cost': 4.0, 'date': 20261002, 'service': 'Virtual Machines', 'currency': 'EUR'},
+            {'cost': 0.5, 'date': 20261002, 'service': 'Storage', 'currency': 'EUR'},
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import unittest
+from datetime import date
+from unittest import mock
+from utils import config
+from utils import month_to_date
+
+class MonthToDateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(os.environ, {'mtd_state_path': '', 'cost_store_unsettled_days': '3'}))
+        config.reload_settings()
+        self.addCleanup(config.reload_settings)
+
+    def test_first_run_applies_every_day_of_the_month(self):
+        state = month_to_date.MonthToDate('key')
+        self.assertEqual(state.missing_dates(date(2026, 10, 4)), [20261001, 20261002, 20261003, 20261004])
+
+    def test_later_runs_apply_new_and_unsettled_days(self):
+        state = month_to_date.MonthToDate('key')
+        for day in state.missing_dates(date(2026, 10, 10)):
+            state.apply_day(day, {'Storage': 1.0})
+        state.fold(date(2026, 10, 10))
+        self.assertEqual(state.settled_through, 20261007)
+        self.assertEqual(state.missing_dates(date(2026, 10, 11)), [20261009, 20261010, 20261011])
+        # Rows from the 10th on are at hand: the 9th is not fetched again just to be restated
+        self.assertEqual(state.missing_dates(date(2026, 10, 11), available_from=20261010), [20261010, 20261011])
+
+    def test_restated_day_replaces_the_previous_totals(self):
+        state = month_to_date.MonthToDate('key')
+        state.apply_day(20261001, {'Storage': 1.0})
+        state.apply_day(20261001, {'Storage': 3.0})
+        self.assertEqual(state.totals(), {'Storage': 3.0})
+        self.assertEqual(state.ewma, {'Storage': 1.0})
+
+    def test_new_month_resets_the_state(self):
+        state = month_to_date.MonthToDate('key')
+        state.missing_dates(date(2026, 9, 30))
+        state.apply_day(20260930, {'Storage': 5.0})
+        self.assertEqual(state.missing_dates(date(2026, 10, 1)), [20261001])
+        self.assertEqual(state.totals(), {})
+
+    def test_summary_projects_and_burns_the_budget(self):
+        state = month_to_date.MonthToDate('key')
+        state.missing_dates(date(2026, 10, 10))
+        for day in range(20261001, 20261011):
+            state.apply_day(day, {'Storage': 2.0, 'Bandwidth': 1.0}, 'EUR')
+        summary = state.summary(date(2026, 10, 10), budget=100.0, forecast=60.0)
+        self.assertEqual((summary['mtd'], summary['projected']), (30.0, 93.0))
+        self.assertEqual([row['service'] for row in summary['rows']], ['Storage', 'Bandwidth'])
+        self.assertAlmostEqual(summary['burn_rate'], 0.3 / (10 / 31))
+        self.assertFalse(summary['over_budget'])
+        self.assertAlmostEqual(summary['forecast']['difference_percent'], (93.0 - 90.0) / 90.0 * 100)
+        self.assertEqual(summary['currency'], 'EUR')
+
+    def test_update_only_fetches_missing_days(self):
+        fetched = []
+
+        def get_day_totals(dates):
+            fetched.append(dates)
+            return {d: {'Storage': 1.0} for d in dates}, 'EUR'
+
+        summary = month_to_date.update('key', date(2026, 10, 3), get_day_totals)
+        self.assertEqual(fetched, [[20261001, 20261002, 20261003]])
+        self.assertEqual(summary['mtd'], 3.0)
+
+if __name__ == '__main__':
+    unittest.main()
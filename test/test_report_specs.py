@@ -0,0 +1,85 @@
+import os
+import unittest
+from unittest import mock
+from utils import config
+from utils import report_specs
+
+def dimension(name, *values):
+    return {'dimensions': {'name': name, 'operator': 'In', 'values': list(values)}}
+
+TAG = {'tags': {'name': 'env', 'operator': 'In', 'values': ['prod']}}
+
+class ReportSpecsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(os.environ, {'drilldown_enabled': 'false', 'comparison_baseline': 'previous_day'}))
+        config.reload_settings()
+        self.addCleanup(config.reload_settings)
+
+    def test_normalize_flattens_and_merges_in_filters(self):
+        expression = {'or': [
+            dimension('ServiceName', 'b', 'a'),
+            {'or': [dimension('ServiceName', 'a', 'c')]},
+            dimension('ResourceGroup', 'x')
+        ]}
+        self.assertEqual(report_specs.normalize_filter(expression), {'or': [
+            dimension('ResourceGroup', 'x'),
+            dimension('ServiceName', 'a', 'b', 'c')
+        ]})
+
+    def test_equivalent_filters_share_a_key(self):
+        written = {'and': [TAG, {'and': [dimension('ServiceName', 'a'), TAG]}]}
+        reordered = {'and': [dimension('ServiceName', 'a'), TAG]}
+        self.assertEqual(
+            report_specs.filter_key(report_specs.normalize_filter(written)),
+            report_specs.filter_key(report_specs.normalize_filter(reordered))
+        )
+
+    def test_split_keeps_tags_on_the_server(self):
+        expression = report_specs.normalize_filter({'and': [TAG, dimension('ServiceName', 'a')]})
+        server, local = report_specs.split_filter(expression, ('ServiceName',))
+        self.assertEqual(server, [TAG])
+        self.assertEqual(local, [dimension('ServiceName', 'a')])
+
+    def test_split_sends_dimensions_missing_from_the_rows(self):
+        expression = report_specs.normalize_filter({'and': [TAG, dimension('ResourceGroup', 'a')]})
+        server, local = report_specs.split_filter(expression, ('ServiceName',))
+        self.assertEqual(local, [])
+        self.assertIn(dimension('ResourceGroup', 'a'), server)
+        self.assertEqual(report_specs.split_filter(None, ('ServiceName',)), ([], []))
+
+    def test_plan_merges_reports_sharing_the_server_filter(self):
+        specs = [report_specs.ReportSpec.from_dict(d) for d in [
+            {'name': 'storage', 'filter': {'and': [TAG, dimension('ServiceName', 'Storage')]}},
+            {'name': 'compute', 'filter': {'and': [dimension('ServiceName', 'Virtual Machines', 'Storage'), TAG]}},
+            {'name': 'all', 'filter': {'or': [dimension('ServiceName', 'Bandwidth'), dimension('ServiceName', 'Storage')]}},
+        ]]
+        queries = report_specs.plan_queries(specs)
+        self.assertEqual([[spec.name for spec in query.specs] for query in queries], [['storage', 'compute'], ['all']])
+
+        rows = [{'service': service, 'cost': 1.0, 'date': 20261001} for service in ('Storage', 'Virtual Machines', 'SQL')]
+        merged = queries[0]
+        self.assertEqual([row['service'] for row in merged.project(specs[0], rows)], ['Storage'])
+        self.assertEqual([row['service'] for row in merged.project(specs[1], rows)], ['Storage', 'Virtual Machines'])
+
+    def test_plan_merges_drilldown_into_one_grouping(self):
+        service = report_specs.ReportSpec.from_dict({'name': 'service'})
+        resources = report_specs.ReportSpec.from_dict({'name': 'resources', 'drilldown': True, 'baseline': 'days_31_ago'})
+        queries = report_specs.plan_queries([service, resources])
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(queries[0].grouping, ['ServiceName', 'ResourceId'])
+        self.assertEqual(queries[0].window_start, resources.window_start)
+
+    def test_state_key_depends_on_drilldown_and_baseline(self):
+        base = report_specs.ReportSpec.from_dict({'name': 'a'})
+        self.assertEqual(base.get_state_key('SUB'), report_specs.ReportSpec.from_dict({'name': 'b'}).get_state_key('sub'))
+        self.assertNotEqual(base.get_state_key('sub'), report_specs.ReportSpec.from_dict({'drilldown': True}).get_state_key('sub'))
+        self.assertNotEqual(base.get_state_key('sub'), report_specs.ReportSpec.from_dict({'baseline': 'same_weekday_last_week'}).get_state_key('sub'))
+
+    def test_invalid_definitions_raise(self):
+        for definition in [{'foo': 1}, {'baseline': 'nope'}, {'filter': {'or': [dimension('ServiceName', 'a')]}}, {'baseline_days': [1]}]:
+            with self.assertRaises(ValueError):
+                report_specs.ReportSpec.from_dict(definition)
+
+if __name__ == '__main__':
+    unittest.main()
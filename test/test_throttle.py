@@ -0,0 +1,43 @@
+import time
+import unittest
+from email.utils import formatdate
+from types import SimpleNamespace
+from utils import throttle
+
+def response(headers, content=b'', raw=None):
+    return SimpleNamespace(headers=headers, content=content, raw=raw)
+
+class ThrottleHeadersTest(unittest.TestCase):
+
+    def test_retry_after_takes_the_longest_interval(self):
+        headers = {
+            'Retry-After': '5',
+            'x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after': '12',
+            'x-ms-ratelimit-microsoft.costmanagement-entity-retry-after': 'soon',
+        }
+        self.assertEqual(throttle.get_retry_after(response(headers)), 12.0)
+        self.assertIsNone(throttle.get_retry_after(response({'Content-Type': 'application/json'})))
+
+    def test_retry_after_http_date(self):
+        delay = throttle.get_retry_after(response({'Retry-After': formatdate(time.time() + 30, usegmt=True)}))
+        self.assertGreater(delay, 20)
+        self.assertLessEqual(delay, 30)
+
+    def test_remaining_quota_reads_every_format(self):
+        headers = {
+            'x-ms-ratelimit-microsoft.costmanagement-qpu-remaining': 'QueryQPU:25;EntityQPU:7',
+            'x-ms-ratelimit-microsoft.costmanagement-entity-remaining': '11',
+            'x-ms-ratelimit-remaining-subscription-reads': '1',
+        }
+        self.assertEqual(throttle.get_remaining_quota(response(headers)), 7)
+        self.assertIsNone(throttle.get_remaining_quota(response({})))
+
+    def test_transfer_size(self):
+        self.assertEqual(throttle.get_transfer_size(response({'Content-Length': '120'}, b'x' * 400)), 120)
+        self.assertEqual(throttle.get_transfer_size(response({}, b'x' * 400, SimpleNamespace(tell=lambda: 90))), 90)
+        # Chunked responses: urllib3 does not count the bytes read
+        self.assertEqual(throttle.get_transfer_size(response({}, b'x' * 400, SimpleNamespace(tell=lambda: 0))), 400)
+        self.assertEqual(throttle.get_transfer_size(response({}, b'x' * 400)), 400)
+
+if __name__ == '__main__':
+    unittest.main()
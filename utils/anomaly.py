@@ -0,0 +1,168 @@
+import json
+import logging
+import math
+import os
+import threading
+from utils import config
+
+_state_lock = threading.Lock()
+
+def is_enabled():
+    """
+    Return True when rows are highlighted by anomaly score instead of the percentage rule.
+    """
+    return config.get_settings().anomaly_enabled
+
+class AnomalyState:
+    """
+    Rolling statistics of every cost series (service or service|resource) of one report.
+
+    Each series keeps an exponentially weighted mean and variance (span
+    anomaly_window days), its number of days and its current run of zero-cost
+    days, as the compact record [mean, variance, days, zero_days]. A day's
+    costs stay pending until a later day arrives, so re-running or restating
+    the same day replaces it and a day is always scored against the days
+    before it. Adding and scoring a day costs O(1) per series, whatever the
+    window or the length of the history.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.series = {}
+        self.pending_date = None
+        self.pending = {}
+
+    @classmethod
+    def load(cls, key):
+        """
+        Read the state from anomaly_state_path (a fresh state when missing or unreadable).
+        """
+        state = cls(key)
+        path = state.path
+        if not path or not os.path.exists(path):
+            return state
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable anomaly state {path}: {str(e)}")
+            return state
+        state.series = data.get('series', {})
+        for record in state.series.values():
+            if isinstance(record[3], list):
+                # States written with the day window: keep its trailing run of zero days
+                zero_days = 0
+                for cost in reversed(record[3]):
+                    if cost:
+                        break
+                    zero_days += 1
+                record[3] = zero_days
+        state.pending_date = data.get('pending_date')
+        state.pending = data.get('pending', {})
+        return state
+
+    @property
+    def path(self):
+        state_path = config.get_settings().anomaly_state_path
+        return os.path.join(state_path, f'{self.key}.json') if state_path else None
+
+    def save(self):
+        path = self.path
+        if not path:
+            return
+        data = {'pending_date': self.pending_date, 'pending': self.pending, 'series': self.series}
+        try:
+            with _state_lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, separators=(',', ':'))
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write anomaly state: {str(e)}")
+
+    def _commit(self):
+        settings = config.get_settings()
+        alpha = 2 / (settings.anomaly_window + 1)
+        for name in set(self.series) | set(self.pending):
+            # Series without cost on the pending day count as zero
+            value = self.pending.get(name, 0.0)
+            record = self.series.get(name)
+            if record is None:
+                record = self.series[name] = [value, 0.0, 0, 0]
+            else:
+                diff = value - record[0]
+                increment = alpha * diff
+                record[0] += increment
+                record[1] = (1 - alpha) * (record[1] + diff * increment)
+            record[2] += 1
+            record[3] = record[3] + 1 if value == 0 else 0
+            # Series that stayed at zero for a whole window are forgotten
+            if record[3] >= settings.anomaly_window:
+                del self.series[name]
+        self.pending = {}
+
+    def observe(self, date, values):
+        """
+        Record one day's costs.
+
+        A later day first commits the pending one; the same day replaces it;
+        an earlier day is ignored.
+
+        Args:
+            date (int): Usage date (YYYYMMDD).
+            values (dict): Series -> cost of that day.
+
+        Returns:
+            bool: True when the day was recorded.
+        """
+        if self.pending_date is not None and date < self.pending_date:
+            return False
+        if self.pending_date is not None and date > self.pending_date:
+            self._commit()
+        self.pending_date = date
+        self.pending = {name: float(cost) for name, cost in values.items()}
+        return True
+
+    def score(self, name, value):
+        """
+        Score a cost against the series' history.
+
+        The score is the z-score against the weighted mean and variance. Only
+        increases score: costs less than anomaly_min_cost above the mean score 0.
+
+        Returns:
+            float: The score, or None while the series has fewer than anomaly_min_days days.
+        """
+        settings = config.get_settings()
+        record = self.series.get(name)
+        if record is None or record[2] < settings.anomaly_min_days:
+            return None
+        mean, variance = record[0], record[1]
+        if value - mean < settings.anomaly_min_cost:
+            return 0.0
+        # A flat history makes any increase above the minimum cost stand out
+        return (value - mean) / math.sqrt(variance) if variance > 0 else math.inf
+
+def score_day(key, date, values, get_history=None):
+    """
+    Add one day to a report's anomaly state and score its costs.
+
+    Args:
+        key (str): State key, see report_specs.ReportSpec.get_state_key.
+        date (int): The report's usage date (YYYYMMDD).
+        values (dict): Series -> cost on that day.
+        get_history (callable): Takes a usage date and returns date -> {series: cost}
+            for the earlier days at hand; only used to seed a new state.
+
+    Returns:
+        dict: Series -> score (None for series without enough history).
+    """
+    state = AnomalyState.load(key)
+    if get_history is not None and state.pending_date is None:
+        for day, day_values in sorted(get_history(date).items()):
+            state.observe(day, day_values)
+    state.observe(date, values)
+    scores = {name: state.score(name, value) for name, value in values.items()}
+    state.save()
+    return scores
@@ -1,29 +1,85 @@
-import requests
-import os
+import threading
+import time
+from utils import config
+from utils import http_client
 
-azure_api_version = str(os.getenv('azure_api_version', '2024-08-01'))
+# Process-wide token cache: (tenant_id, client_id, resource) -> (access_token, expires_at)
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+_token_refresh_locks = {}
 
-def authenticate_with_azure(tenant_id, client_id, client_secret):
+def _token_expiry(token_data):
+    """
+    Compute the absolute expiry (epoch seconds) of a token response.
+
+    Args:
+        token_data (dict): The JSON body returned by the token endpoint.
+
+    Returns:
+        float: Epoch timestamp at which the token expires.
+    """
+    if token_data.get('expires_on'):
+        return float(token_data['expires_on'])
+    return time.time() + float(token_data.get('expires_in', 0))
+
+def _get_refresh_lock(cache_key):
+    with _token_cache_lock:
+        return _token_refresh_locks.setdefault(cache_key, threading.Lock())
+
+def _cached_token(cache_key):
+    entry = _token_cache.get(cache_key)
+    # Refresh tokens token_refresh_margin seconds before they actually expire
+    if entry and entry[1] - config.get_settings().token_refresh_margin > time.time():
+        return entry[0]
+    return None
+
+def clear_token_cache():
+    """
+    Drop every cached access token, forcing the next call to re-authenticate.
+    """
+    with _token_cache_lock:
+        _token_cache.clear()
+
+def authenticate_with_azure(tenant_id, client_id, client_secret, resource='https://management.azure.com/'):
     """
     Authenticate with Azure AD and retrieve an access token.
 
+    Tokens are cached per (tenant_id, client_id, resource) for the lifetime of the
+    process and refreshed shortly before they expire. Concurrent callers for the
+    same key share a single refresh request.
+
     Returns:
         str: The access token for Azure API authentication.
 
     Raises:
         ValueError: If authentication fails or the response does not contain an access token.
     """
-    auth_url = f'https://login.microsoftonline.com/{tenant_id}/oauth2/token'  # tenant_id is now passed as a parameter
-    auth_data = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'resource': 'https://management.azure.com/'
-    }
-    auth_response = requests.post(auth_url, data=auth_data)
-    if auth_response.status_code != 200 or 'access_token' not in auth_response.json():
-        raise ValueError("Failed to authenticate with Azure. Check your credentials.")
-    return auth_response.json()['access_token']
+    cache_key = (tenant_id, client_id, resource)
+    access_token = _cached_token(cache_key)
+    if access_token:
+        return access_token
+
+    with _get_refresh_lock(cache_key):
+        # Another thread may have refreshed the token while we were waiting
+        access_token = _cached_token(cache_key)
+        if access_token:
+            return access_token
+
+        auth_url = f'{config.get_settings().azure_login_url}/{tenant_id}/oauth2/token'  # tenant_id is now passed as a parameter
+        auth_data = {
+            'grant_type': 'client_credentials',
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'resource': resource
+        }
+        auth_response = http_client.post(auth_url, data=auth_data)
+        token_data = auth_response.json() if auth_response.status_code == 200 else {}
+        if 'access_token' not in token_data:
+            raise ValueError("Failed to authenticate with Azure. Check your credentials.")
+
+        with _token_cache_lock:
+            _token_cache[cache_key] = (token_data['access_token'], _token_expiry(token_data))
+        return token_data['access_token']
 
 def get_subscription_name(subscription_id, access_token):
     """
@@ -40,10 +96,11 @@ def get_subscription_name(subscription_id, access_token):
         ValueError: If the API call fails or the response doesn't contain a display name.
     """
     
-    usage_url = f'https://management.azure.com/subscriptions/{subscription_id}/?api-version={azure_api_version}'
+    settings = config.get_settings()
+    usage_url = f'{settings.azure_management_url}/subscriptions/{subscription_id}/?api-version={settings.azure_api_version}'
     
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(usage_url, headers=headers)
+    response = http_client.get(usage_url, headers=headers)
     
     if response.status_code != 200:
         raise ValueError(f"Failed to retrieve subscription details. Status code: {response.status_code}")
@@ -54,4 +111,39 @@ def get_subscription_name(subscription_id, access_token):
     if not display_name:
         raise ValueError("Subscription display name not found in API response.")
     
-    return display_name
\ No newline at end of file
+    return display_name
+
+def list_subscriptions(access_token):
+    """
+    List every subscription the service principal can see, in one paged call.
+
+    Args:
+        access_token (str): The access token for Azure API authentication.
+
+    Returns:
+        list: Subscription dicts with 'subscriptionId', 'displayName', 'state' and 'tags'.
+
+    Raises:
+        ValueError: If the API call fails.
+    """
+    settings = config.get_settings()
+    url = f'{settings.azure_management_url}/subscriptions?api-version={settings.azure_api_version}'
+    headers = {'Authorization': f'Bearer {access_token}'}
+
+    subscriptions = []
+    while url:
+        response = http_client.get(url, headers=headers)
+        if response.status_code != 200:
+            raise ValueError(f"Failed to list subscriptions. Status code: {response.status_code}")
+        body = response.json()
+        subscriptions.extend(
+            {
+                'subscriptionId': item.get('subscriptionId'),
+                'displayName': item.get('displayName'),
+                'state': item.get('state'),
+                'tags': item.get('tags') or {}
+            }
+            for item in body.get('value', [])
+        )
+        url = body.get('nextLink')
+    return subscriptions
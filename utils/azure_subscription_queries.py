@@ -1,10 +1,72 @@
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
 import json
-import os
+import operator
+from array import array
+from utils import config
+from utils import report_render
+from utils.cost_table import CostTable, as_cost_table, get_column_indexes
 ######################## FUNCTIONS
 
 
+# Day being reported on, as days before today
+REPORT_DAYS_AGO = 1
+
+# Comparison baselines: name -> days before today averaged into the baseline
+BASELINES = {
+    'previous_day': [2],
+    'same_weekday_last_week': [8],
+    'days_31_ago': [31],
+    'trailing_7_day_avg': list(range(2, 9)),
+}
+
+# Services reported on by default: the core services plus anything tagged app=mongodb
+DEFAULT_FILTER = {
+    "or": [
+        {
+            "dimensions": {
+                "name": "ServiceName",
+                "operator": "In",
+                "values": [
+                    "Virtual Machines",
+                    "SQL Database",
+                    "Azure App Service",
+                    "Bandwidth",
+                    "Storage",
+                    "Log Analytics"
+                ]
+            }
+        },
+        {
+            "tags": {
+                "name": "app",
+                "operator": "In",
+                "values": [
+                    "mongodb"
+                ]
+            }
+        }
+    ]
+}
+
+# Grouping used when one query at management-group or billing scope covers many subscriptions
+SCOPE_GROUPING = ['SubscriptionId', 'ServiceName']
+
+
+def get_query_url(scope, api_version):
+    """
+    Build the Cost Management query URL for a scope.
+
+    Args:
+        scope (str): e.g. /subscriptions/<id>, /providers/Microsoft.Management/managementGroups/<id>
+            or /providers/Microsoft.Billing/billingAccounts/<id>.
+        api_version (str): Cost Management API version.
+
+    Returns:
+        str: The query URL.
+    """
+    return f'{config.get_settings().azure_management_url}/{scope.strip("/")}/providers/Microsoft.CostManagement/query?api-version={api_version}'
+
+
 def get_usage_data(days_ago):
     """
     Generate usage data payload for Azure Cost Management API.
@@ -15,41 +77,38 @@ def get_usage_data(days_ago):
     Returns:
         dict: The usage data payload.
     """
-    return {
+    return get_usage_data_window(days_ago, days_ago)
+
+
+def get_usage_data_window(from_days_ago, to_days_ago, today=None, grouping=None, filter_expression=DEFAULT_FILTER):
+    """
+    Generate a usage data payload covering a contiguous range of days.
+
+    With Daily granularity a single query over the window returns one row per
+    day and service, which can then be split locally into several baselines.
+
+    Args:
+        from_days_ago (int): First (oldest) day of the window, as days before today.
+        to_days_ago (int): Last (newest) day of the window, as days before today.
+        today (datetime): Reference "now", defaults to the current time.
+        grouping (list): Dimensions to group by, defaults to ['ServiceName'].
+        filter_expression (dict): The dataset filter, defaults to DEFAULT_FILTER;
+            None queries every service.
+
+    Returns:
+        dict: The usage data payload.
+    """
+    today = today or datetime.now()
+    grouping = grouping or ['ServiceName']
+    usage_data = {
         'type': 'Usage',
         'timeframe': 'Custom',
         'timePeriod': {
-            'from': (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%dT00:00:00Z'),
-            'to': (datetime.now() - timedelta(days=days_ago)).strftime('%Y-%m-%dT23:59:59Z')
+            'from': (today - timedelta(days=from_days_ago)).strftime('%Y-%m-%dT00:00:00Z'),
+            'to': (today - timedelta(days=to_days_ago)).strftime('%Y-%m-%dT23:59:59Z')
         },
-         'dataset': {
-            "filter": {
-                "or": [
-                    {
-                        "dimensions": {
-                            "name": "ServiceName",
-                            "operator": "In",
-                            "values": [
-                                "Virtual Machines",
-                                "SQL Database",
-                                "Azure App Service",
-                                "Bandwidth",
-                                "Storage",
-                                "Log Analytics"
-                            ]
-                        }
-                    },
-                    {
-                    "tags": {
-                        "name": "app",
-                        "operator": "In",
-                        "values": [
-                            "mongodb"
-                        ]
-                    }
-                    }
-                ]
-            },
+        'dataset': {
+            'filter': filter_expression,
             'granularity': 'Daily',
             'aggregation': {
                 'totalCost': {
@@ -60,63 +119,290 @@ def get_usage_data(days_ago):
             'grouping': [
                 {
                     'type': 'Dimension',
-                    'name': 'ServiceName'
+                    'name': name
                 }
+                for name in grouping
             ]
         }
     }
+    if filter_expression is None:
+        del usage_data['dataset']['filter']
+    if 'ResourceId' in grouping:
+        # Each resource's rows arrive together, so the drill-down ranks one resource at a time
+        usage_data['dataset']['sorting'] = [{'direction': 'ascending', 'name': 'ResourceId'}]
+    return usage_data
+
+
+def get_forecast_url(scope, api_version):
+    """
+    Build the Cost Management forecast URL for a scope (see get_query_url).
+    """
+    return get_query_url(scope, api_version).replace('/Microsoft.CostManagement/query?', '/Microsoft.CostManagement/forecast?', 1)
 
 
-def extract_cost_data(response):
+def get_forecast_data(from_day, to_day, filter_expression=DEFAULT_FILTER):
+    """
+    Generate a forecast payload for the days from_day to to_day.
+
+    Args:
+        from_day (date): First forecast day.
+        to_day (date): Last forecast day.
+        filter_expression (dict): The dataset filter, see get_usage_data_window.
+
+    Returns:
+        dict: The forecast payload, daily forecast cost only.
+    """
+    forecast_data = {
+        'type': 'Usage',
+        'timeframe': 'Custom',
+        'timePeriod': {
+            'from': from_day.strftime('%Y-%m-%dT00:00:00Z'),
+            'to': to_day.strftime('%Y-%m-%dT23:59:59Z')
+        },
+        'dataset': {
+            'filter': filter_expression,
+            'granularity': 'Daily',
+            'aggregation': {
+                'totalCost': {
+                    'name': 'Cost',
+                    'function': 'Sum'
+                }
+            }
+        },
+        'includeActualCost': False,
+        'includeFreshPartialCost': False
+    }
+    if filter_expression is None:
+        del forecast_data['dataset']['filter']
+    return forecast_data
+
+
+def iter_cost_pages(response, fetch_next=None):
+    """
+    Yield the `properties` of each page of a Cost Management query result.
+
+    Each page body is parsed exactly once. `properties.nextLink` is followed
+    lazily, so the next page is only requested once the previous one has been
+    consumed.
+
+    Args:
+        response (requests.Response): The response object for the first page.
+        fetch_next (callable): Function taking a nextLink URL and returning the next
+            page's response. When omitted only the first page is read.
+
+    Yields:
+        dict: The `properties` object of each page.
+
+    Raises:
+        ValueError: If the API call failed (e.g. it was still throttled after retries).
+        KeyError: If the response JSON does not contain the expected structure.
+    """
+    while response is not None:
+        if response.status_code != 200:
+            raise ValueError(f"Cost Management query failed. Status code: {response.status_code}. Response: {response.text[:500]}")
+
+        body = response.json()
+        if not (
+            isinstance(body, dict)
+            and isinstance(body.get('properties'), dict)
+            and 'rows' in body['properties']
+        ):
+            print("Unexpected response structure:")
+            print(json.dumps(body, indent=2))
+            raise KeyError("Response JSON does not contain 'properties' or 'rows' as expected.")
+
+        properties = body['properties']
+        yield properties
+
+        next_link = properties.get('nextLink')
+        response = fetch_next(next_link) if next_link and fetch_next else None
+
+def iter_cost_rows(response, fetch_next=None):
+    """
+    Yield raw cost rows from every page of a Cost Management query result.
+
+    Args:
+        response (requests.Response): The response object for the first page.
+        fetch_next (callable): See iter_cost_pages.
+
+    Yields:
+        list: One raw row per service and day.
+    """
+    for properties in iter_cost_pages(response, fetch_next):
+        yield from properties['rows']
+
+def extract_cost_data(response, fetch_next=None):
     """
     Extract cost data from the Azure API response.
 
     Args:
         response (requests.Response): The response object from the Azure API.
+        fetch_next (callable): See iter_cost_pages.
 
     Returns:
         list: A list of cost data rows.
 
     Raises:
+        ValueError: If the API call failed (e.g. it was still throttled after retries).
         KeyError: If the response JSON does not contain the expected structure.
     """
-    if (
-        isinstance(response.json(), dict)
-        and 'properties' in response.json()
-        and isinstance(response.json()['properties'], dict)
-        and 'rows' in response.json()['properties']
-    ):
-        return response.json()['properties']['rows']
-    else:
-        print("Unexpected response structure:")
-        print(json.dumps(response.json(), indent=2))
-        raise KeyError("Response JSON does not contain 'properties' or 'rows' as expected.")
+    return list(iter_cost_rows(response, fetch_next))
+
+def iter_cost_data(usage_response, fetch_next=None):
+    """
+    Yield cost data dictionaries as pages of the Azure API response arrive.
+
+    Rows are decoded by name from each page's `properties.columns`, so column
+    order does not matter and extra grouping dimensions are kept under their
+    column name (e.g. 'ResourceGroup').
 
-def process_cost_data(usage_response):
+    Args:
+        usage_response (requests.Response): The response object from the Azure API.
+        fetch_next (callable): See iter_cost_pages.
+
+    Yields:
+        dict: Cost data for one service and day.
+    """
+    for properties in iter_cost_pages(usage_response, fetch_next):
+        indexes = get_column_indexes(properties.get('columns'))
+        cost_index = indexes['cost']
+        date_index = indexes.get('date')
+        service_index = indexes.get('service')
+        currency_index = indexes.get('currency')
+        extra = [(name, index) for name, index in indexes.items() if name not in ('cost', 'date', 'service', 'currency')]
+        for row in properties['rows']:
+            cost_row = {
+                'cost': row[cost_index],
+                'date': row[date_index] if date_index is not None else None,
+                'service': row[service_index] if service_index is not None else None,
+                'currency': row[currency_index] if currency_index is not None else None
+            }
+            for name, index in extra:
+                cost_row[name] = row[index]
+            yield cost_row
+
+def process_cost_data(usage_response, fetch_next=None):
     """
     Process the cost data from the Azure API response.
 
     Args:
         usage_response (requests.Response): The response object from the Azure API.
+        fetch_next (callable): See iter_cost_pages.
 
     Returns:
         list: A list of dictionaries containing cost data.
     """
-    # Extract the cost data using the function
-    cost_data = extract_cost_data(usage_response)
+    return list(iter_cost_data(usage_response, fetch_next))
 
-    # Convert the list of lists to a list of dictionaries
-    cost_data = [
+def get_comparison_window(baselines=None):
+    """
+    Return the oldest day, as days before today, needed by the given baselines.
+
+    Args:
+        baselines (list): Baseline names from BASELINES, defaults to all of them.
+
+    Returns:
+        int: The number of days back the usage window has to start.
+    """
+    baselines = baselines or list(BASELINES)
+    return max(max(BASELINES[name]) for name in baselines)
+
+def load_cost_table(cost_data, dimensions=()):
+    """
+    Load cost data into a columnar CostTable.
+
+    Args:
+        cost_data (iterable): Cost data dictionaries, e.g. from iter_cost_data.
+        dimensions (tuple): Extra grouping dimensions to keep.
+
+    Returns:
+        CostTable: The populated table.
+    """
+    return CostTable.from_rows(cost_data, dimensions)
+
+def aggregate_by_service(cost_data):
+    """
+    Sum cost rows per day, service and currency, dropping every other dimension.
+
+    Resource-level rows are reduced to the service-level rows the comparison
+    reads, so the CostTable grows with days x services instead of resources.
+
+    Args:
+        cost_data (iterable): Cost data dictionaries, e.g. from iter_cost_data.
+
+    Returns:
+        list: One cost data dict per day, service and currency, in the order they first appear.
+    """
+    totals = {}
+    for row in cost_data:
+        key = (int(row.get('date') or 0), row.get('service'), row.get('currency'))
+        totals[key] = totals.get(key, 0.0) + row['cost']
+    return [
+        {'cost': cost, 'date': date, 'service': service, 'currency': currency}
+        for (date, service, currency), cost in totals.items()
+    ]
+
+def split_by_subscription(cost_data, subscription_ids=None):
+    """
+    Split scope-level cost rows into one CostTable per subscription.
+
+    Args:
+        cost_data (iterable): Cost data dictionaries carrying a 'SubscriptionId' key.
+        subscription_ids (list): Only keep these subscriptions (all when omitted).
+
+    Returns:
+        dict: Lower-cased subscription ID -> CostTable.
+    """
+    wanted = {sub_id.lower() for sub_id in subscription_ids} if subscription_ids else None
+    tables = {}
+    for row in cost_data:
+        sub_id = (row.get('SubscriptionId') or '').lower()
+        if wanted is not None and sub_id not in wanted:
+            continue
+        table = tables.get(sub_id)
+        if table is None:
+            table = tables[sub_id] = CostTable()
+        table.append(row)
+    return tables
+
+def build_baseline(cost_data, days_ago, today=None):
+    """
+    Build the per-service cost rows for one comparison baseline.
+
+    When the baseline spans several days the cost of each service is averaged
+    over those days (days without data count as zero).
+
+    Args:
+        cost_data (CostTable): Cost data covering at least the baseline days.
+        days_ago (list): Days before today that make up the baseline.
+        today (datetime): Reference "now", defaults to the current time.
+
+    Returns:
+        tuple: (label, cost rows) where label is the date or date range of the baseline.
+    """
+    today = today or datetime.now()
+    table = as_cost_table(cost_data)
+    dates = sorted(today - timedelta(days=d) for d in days_ago)
+
+    totals = table.service_totals({int(day.strftime('%Y%m%d')) for day in dates})
+    currencies = table.service_currencies()
+
+    date_value = int(dates[-1].strftime('%Y%m%d'))
+    rows = [
         {
-            'cost': row[0],
-            'date': row[1],
-            'service': row[2],
-            'currency': row[3]
+            'cost': cost / len(dates),
+            'date': date_value,
+            'service': table.services.values[code],
+            'currency': currencies[code]
         }
-        for row in cost_data
+        for code, cost in totals.items()
     ]
 
-    return cost_data
+    if len(dates) == 1:
+        label = dates[0].strftime('%d/%m/%Y')
+    else:
+        label = f"Avg {dates[0].strftime('%d/%m')}-{dates[-1].strftime('%d/%m/%Y')}"
+    return label, rows
 
 def calculate_and_display_costs(cost_data):
     """
@@ -145,19 +431,19 @@ def calculate_and_display_costs(cost_data):
     cost_data_sorted = sorted(cost_data, key=lambda k: k['cost'], reverse=True)
 
     # Print the total cost and its date
-    if os.getenv('DEBUG', 'false').lower() == 'true':
+    if config.get_settings().DEBUG:
         print(f'Total cost on {total_cost_date_1}: {total_cost_brls} {cost_data[0]["currency"]}')
 
     # Print the top 5 services by cost
 
-    if os.getenv('DEBUG', 'false').lower() == 'true':
+    if config.get_settings().DEBUG:
         print('Top 5 services by cost:')
         for i, row in enumerate(cost_data_sorted):
             print(f"{i+1}. ServiceName: {row['service']} - R${row['cost']} {row['currency']}")
 
     # Review
     list_items = [f"<li> ServiceName: {row['service']} - R${row['cost']} {row['currency']}</li>" for row in cost_data_sorted]
-    if os.getenv('DEBUG', 'false').lower() == 'true':
+    if config.get_settings().DEBUG:
         print(f'check: {list_items}')
 
     return {
@@ -166,79 +452,140 @@ def calculate_and_display_costs(cost_data):
         "top_services": cost_data_sorted[:7]
     }
 
-def compare_service_costs(cost_data_a, cost_data_b, label_a, label_b, highlight_threshold=10):
+def _percent_change(diff, cost_a, cost_b):
+    return (diff / cost_b * 100) if cost_b else float('inf') if cost_a else 0
+
+def is_highlighted(percent, score, highlight_threshold=10, anomaly_threshold=None):
     """
-    Compare two lists of service cost data and print a table with cost, difference, and percentage change.
-    Highlight significant changes (>highlight_threshold% increase).
-    Also returns a list of HTML rows for email reporting, sorted by absolute Diff (%).
+    Return True when a row's change stands out: its anomaly score reaches the
+    anomaly threshold or, without a score, its increase exceeds highlight_threshold percent.
+    """
+    if anomaly_threshold is not None and score is not None:
+        return score >= anomaly_threshold
+    return percent > highlight_threshold
+
+def compute_cost_comparison(cost_data_a, cost_data_b, highlight_threshold=10, scores=None, anomaly_threshold=None):
+    """
+    Compute per-service cost differences between two periods.
+
+    Both sides are reduced to per-service totals over their categorical service
+    codes, joined on service name and then diffed column-wise.
 
     Args:
-        cost_data_a (list): List of dicts for the first period.
-        cost_data_b (list): List of dicts for the second period.
-        label_a (str): Label for the first period.
-        label_b (str): Label for the second period.
+        cost_data_a (CostTable or list): Cost data for the first period.
+        cost_data_b (CostTable or list): Cost data for the second period.
         highlight_threshold (float): Percentage threshold for highlighting increases.
+        scores (dict): Optional service -> anomaly score of the first period (see anomaly.score_day).
+        anomaly_threshold (float): Score from which a row is highlighted; rows without
+            a score fall back to the percentage threshold.
 
     Returns:
-        str: HTML table rows for email body.
+        list: One dict per service (service, cost_a, cost_b, diff, percent, score, highlight),
+        sorted by absolute difference, descending.
     """
-
-
-    a_dict = {row['service']: row['cost'] for row in cost_data_a}
-    b_dict = {row['service']: row['cost'] for row in cost_data_b}
-    all_services = set(a_dict) | set(b_dict)
-
-    # Prepare all rows with calculated values
+    table_a = as_cost_table(cost_data_a)
+    table_b = as_cost_table(cost_data_b)
+    totals_a = table_a.service_totals()
+    totals_b = table_b.service_totals()
+
+    # Join both sides on service name into one aligned set of columns
+    services = []
+    service_index = {}
+    for table, totals in ((table_a, totals_a), (table_b, totals_b)):
+        for code in totals:
+            name = table.services.values[code]
+            if name not in service_index:
+                service_index[name] = len(services)
+                services.append(name)
+
+    cost_a = array('d', bytes(8 * len(services)))
+    cost_b = array('d', bytes(8 * len(services)))
+    for table, totals, costs in ((table_a, totals_a, cost_a), (table_b, totals_b, cost_b)):
+        for code, total in totals.items():
+            costs[service_index[table.services.values[code]]] = total
+
+    diff = array('d', map(operator.sub, cost_a, cost_b))
+    percent = array('d', map(_percent_change, diff, cost_a, cost_b))
+
+    # Sort rows by absolute value of the difference, descending
+    order = sorted(range(len(services)), key=lambda i: abs(diff[i]), reverse=True)
     rows = []
-    for service in all_services:
-        cost_a = a_dict.get(service, 0)
-        cost_b = b_dict.get(service, 0)
-        diff = cost_a - cost_b
-        try:
-            percent = (diff / cost_b * 100) if cost_b else float('inf') if cost_a else 0
-        except ZeroDivisionError:
-            percent = float('inf')
+    for i in order:
+        score = (scores or {}).get(services[i])
         rows.append({
-            "service": service,
-            "cost_a": cost_a,
-            "cost_b": cost_b,
-            "diff": diff,
-            "percent": percent
+            "service": services[i],
+            "cost_a": cost_a[i],
+            "cost_b": cost_b[i],
+            "diff": diff[i],
+            "percent": percent[i],
+            "score": score,
+            "highlight": is_highlighted(percent[i], score, highlight_threshold, anomaly_threshold)
         })
+    return rows
 
-    # Sort rows by absolute value of percent difference, descending
-    rows.sort(key=lambda x: abs(x["diff"]), reverse=True)
+def build_comparison(cost_data_a, cost_data_b, label_a, label_b, highlight_threshold=10, top_movers=None, scores=None, anomaly_threshold=None):
+    """
+    Build the comparison result rendered by every report format.
 
-    print(f"\n{'Service':<25} | {label_a:<15} | {label_b:<15} | Diff (R$)     | Diff (%)")
-    print("-" * 96)
+    Args:
+        cost_data_a (CostTable or list): Cost data for the first period.
+        cost_data_b (CostTable or list): Cost data for the second period.
+        label_a (str): Label for the first period.
+        label_b (str): Label for the second period.
+        highlight_threshold (float): Percentage threshold for highlighting increases.
+        top_movers (dict): Optional service -> top resource movers (see drilldown.TopMovers).
+        scores (dict): Optional anomaly scores of the services and of the movers
+            (keyed 'service|resource_id'), see anomaly.score_day.
+        anomaly_threshold (float): Score from which rows are highlighted, see compute_cost_comparison.
 
-    html_rows = []
+    Returns:
+        dict: label_a, label_b, highlight_threshold, anomaly_threshold and the
+        comparison rows, each with its resource-level 'movers' (empty without drill-down).
+    """
+    rows = compute_cost_comparison(cost_data_a, cost_data_b, highlight_threshold, scores, anomaly_threshold)
     for row in rows:
-        highlight = row["percent"] > highlight_threshold
-        marker = "**" if highlight else "  "
-        row_str = (
-            f"{marker} "
-            f"{row['service']:<25} | "
-            f"R${row['cost_a']:<13.2f} | "
-            f"R${row['cost_b']:<13.2f} | "
-            f"R${row['diff']:<11.2f} | "
-            f"{row['percent']:>7.2f}%"
-        )
-        print(row_str)
-
-        html_row = (
-            f"<tr style='background-color:#ffcccc;'>" if highlight else "<tr>"
-        )
-        html_row += (
-            f"<td>{row['service']}</td>"
-            f"<td>R${row['cost_a']:,.2f}</td>"
-            f"<td>R${row['cost_b']:,.2f}</td>"
-            f"<td>R${row['diff']:,.2f}</td>"
-            f"<td>{row['percent']:.2f}%</td>"
-            "</tr>"
-        )
-        html_rows.append(html_row)
-    return "\n".join(html_rows)
+        row['movers'] = (top_movers or {}).get(row['service'], [])
+        for mover in row['movers']:
+            mover['score'] = (scores or {}).get(f"{row['service']}|{mover['resource_id']}")
+            # Resources are only highlighted by score, they have no percentage rule of their own
+            mover['highlight'] = mover['score'] is not None and anomaly_threshold is not None and mover['score'] >= anomaly_threshold
+    return {
+        'label_a': label_a,
+        'label_b': label_b,
+        'highlight_threshold': highlight_threshold,
+        'anomaly_threshold': anomaly_threshold,
+        'rows': rows
+    }
+
+def print_comparison(comparison, subscription_name=None):
+    """
+    Print the comparison as a console table, streaming it line by line.
+    """
+    report = {'subscription_name': subscription_name, 'comparison': comparison}
+    for chunk in report_render.render_stream('text', [report]):
+        print(chunk, end='')
+
+def compare_service_costs(cost_data_a, cost_data_b, label_a, label_b, highlight_threshold=10, top_movers=None):
+    """
+    Compare two lists of service cost data and print a table with cost, difference, and percentage change.
+    Highlight significant changes (>highlight_threshold% increase).
+    Also returns a list of HTML rows for email reporting, sorted by absolute Diff (%).
+
+    Args:
+        cost_data_a (CostTable or list): Cost data for the first period.
+        cost_data_b (CostTable or list): Cost data for the second period.
+        label_a (str): Label for the first period.
+        label_b (str): Label for the second period.
+        highlight_threshold (float): Percentage threshold for highlighting increases.
+        top_movers (dict): Optional service -> top resource movers (see drilldown.TopMovers),
+            rendered as indented rows under each service.
+
+    Returns:
+        str: HTML table rows for email body.
+    """
+    comparison = build_comparison(cost_data_a, cost_data_b, label_a, label_b, highlight_threshold, top_movers)
+    print_comparison(comparison)
+    return report_render.render('html_rows', [{'subscription_name': None, 'comparison': comparison}])
 
 
 
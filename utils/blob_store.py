@@ -0,0 +1,91 @@
+import threading
+from utils import config
+
+_containers = {}
+_containers_lock = threading.Lock()
+
+def get_container(name):
+    """
+    Return a client for a blob container of the Functions storage account, creating the container on first use.
+
+    Uses the AzureWebJobsStorage connection string (UseDevelopmentStorage=true
+    for Azurite). azure-storage-blob is only imported here, keeping it out of
+    the cold-start path.
+
+    Args:
+        name (str): The container name.
+
+    Returns:
+        azure.storage.blob.ContainerClient: The shared container client.
+    """
+    container = _containers.get(name)
+    if container is None:
+        with _containers_lock:
+            container = _containers.get(name)
+            if container is None:
+                from azure.core.exceptions import ResourceExistsError
+                from azure.storage.blob import BlobServiceClient
+                connection_string = config.get_settings().AzureWebJobsStorage
+                if not connection_string:
+                    raise ValueError("The AzureWebJobsStorage setting is required for the storage queue and job status.")
+                container = BlobServiceClient.from_connection_string(connection_string).get_container_client(name)
+                try:
+                    container.create_container()
+                except ResourceExistsError:
+                    pass
+                _containers[name] = container
+    return container
+
+def create_blob(container_name, blob_name, data):
+    """
+    Create a blob only if it does not exist yet (If-None-Match: *).
+
+    Returns:
+        bool: True when the blob was created, False when it already existed.
+    """
+    from azure.core.exceptions import ResourceExistsError
+    try:
+        get_container(container_name).upload_blob(blob_name, data, overwrite=False)
+    except ResourceExistsError:
+        return False
+    return True
+
+def read_blob(container_name, blob_name):
+    """
+    Read a text blob.
+
+    Returns:
+        tuple: (content, etag), or (None, None) when the blob does not exist.
+    """
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        downloader = get_container(container_name).download_blob(blob_name, encoding='utf-8')
+    except ResourceNotFoundError:
+        return None, None
+    return downloader.readall(), downloader.properties.etag
+
+def write_blob(container_name, blob_name, data, etag=None):
+    """
+    Write a blob, optionally only if it still has the given ETag (If-Match).
+
+    Returns:
+        bool: False when the blob changed (or disappeared) since etag was read.
+    """
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+    kwargs = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+    try:
+        get_container(container_name).upload_blob(blob_name, data, overwrite=True, **kwargs)
+    except (ResourceModifiedError, ResourceNotFoundError):
+        return False
+    return True
+
+def delete_blob(container_name, blob_name):
+    """
+    Delete a blob; a missing blob is not an error.
+    """
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        get_container(container_name).delete_blob(blob_name)
+    except ResourceNotFoundError:
+        pass
@@ -0,0 +1,166 @@
+import locale
+import os
+from dataclasses import dataclass, fields
+from functools import lru_cache
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(APP_DIR, 'data')
+ENV_FILE = os.path.join(APP_DIR, '.env')
+
+def _bool(value):
+    return str(value).strip().lower() == 'true'
+
+def _list(value):
+    items = []
+    for item in str(value).split(','):
+        item = item.strip()
+        if item and item not in items:
+            items.append(item)
+    return tuple(items)
+
+def _url(value):
+    return str(value).rstrip('/')
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Every application setting, parsed once from the environment.
+
+    Field names match the app setting (environment variable) names. Use
+    get_settings() instead of reading os.environ directly.
+    """
+    # Azure AD / Azure Resource Manager
+    tenant_id: str = None
+    client_id: str = None
+    client_secret: str = None
+    azure_api_version: str = '2024-08-01'
+    azure_login_url: str = 'https://login.microsoftonline.com'
+    azure_management_url: str = 'https://management.azure.com'
+    token_refresh_margin: int = 300
+
+    # Subscriptions and report scope
+    subscription_id: str = ''
+    subscription_ids: tuple = ()
+    subscription_discovery: bool = False
+    subscription_discovery_tag: str = None
+    subscription_cache_ttl: float = 6 * 3600
+    subscription_cache_path: str = os.path.join(DATA_DIR, 'subscriptions.json')
+    cost_scope: str = None
+    comparison_baseline: str = 'days_31_ago'
+    report_specs_path: str = os.path.join(APP_DIR, 'reports.json')
+    queue_mode: bool = False
+    job_retention: float = 3600
+    max_concurrent_subscriptions: int = 8
+    subscription_timeout: float = 300
+
+    # Cost data sources
+    cost_data_source: str = 'query'
+    cost_export_path: str = ''
+    cost_store_path: str = os.path.join(DATA_DIR, 'cost_history.db')
+    cost_store_unsettled_days: int = 3
+    drilldown_enabled: bool = False
+    drilldown_top_k: int = 5
+    result_cache_enabled: bool = True
+    result_cache_path: str = os.path.join(DATA_DIR, 'results')
+    result_cache_unsettled_ttl: float = 1800
+    mtd_enabled: bool = False
+    mtd_state_path: str = os.path.join(DATA_DIR, 'mtd')
+    mtd_forecast_check: bool = False
+    monthly_budget: float = 0
+    anomaly_enabled: bool = False
+    anomaly_state_path: str = os.path.join(DATA_DIR, 'anomaly')
+    anomaly_window: int = 28
+    anomaly_min_days: int = 7
+    anomaly_threshold: float = 3.5
+    anomaly_min_cost: float = 1.0
+
+    # HTTP and Cost Management throttling
+    http_pool_connections: int = 10
+    http_pool_maxsize: int = 20
+    http_connect_timeout: float = 10
+    http_read_timeout: float = 120
+    throttle_max_retries: int = 5
+    throttle_initial_concurrency: int = 4
+    throttle_max_concurrency: int = 8
+    throttle_low_remaining: int = 2
+    throttle_jitter: float = 1.0
+    throttle_default_backoff: float = 5
+
+    # Email
+    email_sender: str = None
+    email_recipients: tuple = ()
+    email_password: str = None
+    email_smtp_server: str = 'smtp.sendgrid.net'
+    email_smtp_port: int = 587
+    email_smtp_starttls: bool = True
+    email_send_interval: float = 0
+    email_digest: bool = False
+
+    # Telemetry and debugging
+    telemetry_enabled: bool = True
+    telemetry_log_path: str = ''
+    profile_mode: str = ''
+    profile_path: str = os.path.join(DATA_DIR, 'profiles')
+    APPLICATIONINSIGHTS_CONNECTION_STRING: str = None
+    AzureWebJobsStorage: str = None
+    DEBUG: bool = False
+    REPORT_DATE: str = 'N/A'
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """
+        Build the settings from an environment mapping (os.environ by default).
+
+        Unset variables keep their default; set ones are converted to the
+        field's type.
+
+        Raises:
+            ValueError: If a numeric setting is not a number.
+        """
+        environ = os.environ if environ is None else environ
+        converters = {int: int, float: float, bool: _bool, tuple: _list, str: str}
+        values = {}
+        for field in fields(cls):
+            value = environ.get(field.name)
+            # Blank non-text settings (e.g. email_smtp_port="") keep their default
+            if value is None or (value.strip() == '' and field.type is not str):
+                continue
+            try:
+                values[field.name] = converters[field.type](value)
+            except ValueError:
+                raise ValueError(f"Invalid value '{value}' for the {field.name} setting.")
+
+        for name in ('azure_login_url', 'azure_management_url'):
+            if name in values:
+                values[name] = _url(values[name])
+        # subscription_ids falls back to the single subscription_id setting
+        if not values.get('subscription_ids') and values.get('subscription_id'):
+            values['subscription_ids'] = _list(values['subscription_id'])
+        return cls(**values)
+
+@lru_cache(maxsize=1)
+def get_settings():
+    """
+    Return the process-wide settings, loading them on first use.
+
+    The first call loads a local .env file (python-dotenv is only imported
+    then, and only if the file exists) and sets the locale, so none of that
+    runs at import time.
+
+    Returns:
+        Settings: The frozen settings.
+    """
+    if os.path.exists(ENV_FILE):
+        from dotenv import load_dotenv
+        load_dotenv(ENV_FILE)
+    try:
+        locale.setlocale(locale.LC_ALL, '')
+    except locale.Error:
+        pass
+    return Settings.from_env()
+
+def reload_settings():
+    """
+    Forget the cached settings so the next get_settings() re-reads the environment.
+    """
+    get_settings.cache_clear()
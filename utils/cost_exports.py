@@ -0,0 +1,331 @@
+import csv
+import glob
+import json
+import logging
+import mmap
+import os
+import threading
+from datetime import datetime
+from functools import lru_cache
+from utils import config
+
+# Export column names (case-insensitive) for each field, in order of preference
+EXPORT_COLUMNS = {
+    'date': ('date', 'usagedate', 'usagedatetime', 'chargeperiodstart'),
+    'cost': ('costinbillingcurrency', 'pretaxcost', 'cost', 'billedcost'),
+    'currency': ('billingcurrency', 'billingcurrencycode', 'currency'),
+    'ServiceName': ('metercategory', 'servicename'),
+    'SubscriptionId': ('subscriptionid', 'subscriptionguid'),
+    'ResourceId': ('resourceid', 'instanceid'),
+    'ResourceGroup': ('resourcegroup', 'resourcegroupname'),
+    'tags': ('tags',),
+}
+
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%Y%m%d')
+
+# Written by backfill.py next to its partitions: the query (filter) their rows were fetched with
+QUERY_FILE = 'query.json'
+
+def is_enabled():
+    """
+    Return True when cost data is read from export files instead of the query API.
+    """
+    return config.get_settings().cost_data_source.lower() == 'export'
+
+def get_export_files(export_path=None):
+    """
+    List the CSV export files under the export directory, oldest first.
+
+    The directory (local path or blob mount) defaults to the cost_export_path setting.
+    """
+    export_path = export_path or config.get_settings().cost_export_path
+    if not export_path or not os.path.isdir(export_path):
+        raise ValueError(f"Cost export directory '{export_path}' does not exist. Check the cost_export_path setting.")
+    return sorted(glob.glob(os.path.join(export_path, '**', '*.csv'), recursive=True))
+
+@lru_cache(maxsize=4096)
+def parse_export_date(value):
+    """
+    Convert an export date (YYYY-MM-DD, MM/DD/YYYY, ISO timestamp or YYYYMMDD) to a YYYYMMDD integer.
+    """
+    value = value.strip()[:10] if 'T' in value else value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return int(datetime.strptime(value, date_format).strftime('%Y%m%d'))
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised date '{value}' in cost export.")
+
+@lru_cache(maxsize=4096)
+def parse_tags(value):
+    """
+    Parse an export tags cell ('"app": "mongodb"' or '{"app": "mongodb"}') into a dict.
+    """
+    value = (value or '').strip()
+    if not value:
+        return {}
+    try:
+        tags = json.loads(value if value.startswith('{') else '{' + value + '}')
+    except ValueError:
+        return {}
+    return {str(k).lower(): str(v).lower() for k, v in tags.items()} if isinstance(tags, dict) else {}
+
+def iter_export_records(path, chunk_lines=10000):
+    """
+    Stream the records of one CSV export through a memory-mapped file.
+
+    The file is never read into memory as a whole: lines are pulled from the
+    mapping on demand and parsed in chunks of chunk_lines records.
+
+    Args:
+        path (str): Path of the CSV file.
+        chunk_lines (int): Number of records parsed per chunk.
+
+    Yields:
+        tuple: (header, list of records) for each chunk.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            lines = (line.decode('utf-8') for line in iter(mapped.readline, b''))
+            reader = csv.reader(lines)
+            header = next(reader, None)
+            if not header:
+                return
+            header[0] = header[0].lstrip('\ufeff')
+            chunk = []
+            for record in reader:
+                chunk.append(record)
+                if len(chunk) >= chunk_lines:
+                    yield header, chunk
+                    chunk = []
+            if chunk:
+                yield header, chunk
+
+def _column_positions(header):
+    lowered = {name.strip().lower(): i for i, name in enumerate(header)}
+    positions = {}
+    for field, aliases in EXPORT_COLUMNS.items():
+        for alias in aliases:
+            if alias in lowered:
+                positions[field] = lowered[alias]
+                break
+    missing = [field for field in ('date', 'cost') if field not in positions]
+    if missing:
+        raise KeyError(f"Cost export is missing the {', '.join(missing)} column(s).")
+    return positions
+
+def compile_filter(expression, positions):
+    """
+    Compile a Cost Management query filter into a predicate over export records.
+
+    Supports and/or/not, dimension "In" filters (on any mapped export column) and
+    tag "In" filters. The value sets are built once, not per record.
+
+    Raises KeyError when the export lacks a filtered column, since its totals
+    would silently leave out the matching rows.
+
+    Args:
+        expression (dict): The 'filter' part of the query dataset.
+        positions (dict): Field -> column position, see _column_positions.
+
+    Returns:
+        callable: Function taking a CSV record and returning True when it matches.
+    """
+    if not expression:
+        return lambda record: True
+    if 'and' in expression:
+        predicates = [compile_filter(e, positions) for e in expression['and']]
+        return lambda record: all(p(record) for p in predicates)
+    if 'or' in expression:
+        predicates = [compile_filter(e, positions) for e in expression['or']]
+        return lambda record: any(p(record) for p in predicates)
+    if 'not' in expression:
+        predicate = compile_filter(expression['not'], positions)
+        return lambda record: not predicate(record)
+    if 'dimensions' in expression:
+        position = positions.get(expression['dimensions']['name'])
+        values = frozenset(v.lower() for v in expression['dimensions']['values'])
+        if position is None:
+            raise KeyError(f"Cost export has no {expression['dimensions']['name']} column to filter on.")
+        return lambda record: record[position].strip().lower() in values
+    if 'tags' in expression:
+        position = positions.get('tags')
+        name = expression['tags']['name'].lower()
+        values = frozenset(v.lower() for v in expression['tags']['values'])
+        if position is None:
+            raise KeyError("Cost export has no tags column to filter on.")
+        return lambda record: parse_tags(record[position]).get(name) in values
+    return lambda record: True
+
+def get_applied_filter(path, export_path):
+    """
+    Return the filter already applied to a file's rows, or None.
+
+    Backfill partitions hold only the rows of their query and no tags
+    column; the query is recorded in a QUERY_FILE in the file's folder or one
+    of its parents up to the export directory.
+    """
+    root = os.path.abspath(export_path)
+    folder = os.path.dirname(os.path.abspath(path))
+    while True:
+        query_path = os.path.join(folder, QUERY_FILE)
+        if os.path.exists(query_path):
+            try:
+                with open(query_path, 'r', encoding='utf-8') as f:
+                    return json.load(f).get('filter')
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable query file {query_path}: {str(e)}")
+                return None
+        if folder == root or os.path.dirname(folder) == folder:
+            return None
+        folder = os.path.dirname(folder)
+
+def get_export_runs(paths):
+    """
+    Group export files into export runs.
+
+    A folder holding a manifest.json is one (partitioned) run; any other file
+    is a run of its own. Month-to-date exports write a new run every day that
+    repeats the days already exported, so runs are ranked by their newest
+    modification time.
+
+    Args:
+        paths (list): CSV files, see get_export_files.
+
+    Returns:
+        list: (modification time, list of files) of each run, oldest first.
+    """
+    runs = {}
+    for path in paths:
+        folder = os.path.dirname(path)
+        run_key = folder if os.path.exists(os.path.join(folder, 'manifest.json')) else path
+        mtime, files = runs.get(run_key, (0.0, []))
+        files.append(path)
+        runs[run_key] = (max(mtime, os.path.getmtime(path)), files)
+    return sorted(runs.values(), key=lambda run: run[0])
+
+def _aggregate_run(files, from_date, to_date, expression, extra_dimensions, export_path):
+    # (date, subscription) -> {(service, currency, dimensions): cost} for one run
+    totals = {}
+    for path in files:
+        logging.info(f"Reading cost export {path}")
+        positions = None
+        # Rows of a backfill partition already passed its query's filter
+        file_expression = expression
+        applied = get_applied_filter(path, export_path)
+        if applied is not None:
+            if json.dumps(applied, sort_keys=True) != json.dumps(expression, sort_keys=True):
+                raise KeyError(f"Cost export {path} only holds the rows of another filter.")
+            file_expression = None
+        for header, records in iter_export_records(path):
+            if positions is None:
+                positions = _column_positions(header)
+                date_position = positions['date']
+                cost_position = positions['cost']
+                currency_position = positions.get('currency')
+                service_position = positions.get('ServiceName')
+                subscription_position = positions.get('SubscriptionId')
+                dimension_positions = [positions.get(name) for name in extra_dimensions]
+                matches = compile_filter(file_expression, positions)
+                # Truncated records (e.g. a partial last line) lack some of the columns read below
+                last_position = max(positions.values())
+            for record in records:
+                if len(record) <= last_position:
+                    continue
+                date = parse_export_date(record[date_position])
+                if date < from_date or date > to_date:
+                    continue
+                if not matches(record):
+                    continue
+                day = totals.setdefault((date, record[subscription_position].lower() if subscription_position is not None else None), {})
+                key = (
+                    record[service_position] if service_position is not None else None,
+                    record[currency_position] if currency_position is not None else None,
+                    tuple(record[p] if p is not None else None for p in dimension_positions)
+                )
+                day[key] = day.get(key, 0.0) + float(record[cost_position] or 0)
+    return totals
+
+_aggregates = {}
+_aggregates_lock = threading.Lock()
+
+def _get_aggregate(export_path, from_date, to_date, dataset, extra_dimensions):
+    """
+    Aggregate every export run once per set of files and query.
+
+    Each (date, subscription) is taken from the newest run covering it, so
+    overlapping month-to-date runs are not summed. The result is shared by
+    every subscription of an invocation; it is recomputed when a file is
+    added or changes.
+    """
+    export_path = export_path or config.get_settings().cost_export_path
+    paths = get_export_files(export_path)
+    signature = tuple((path, os.path.getmtime(path), os.path.getsize(path)) for path in paths)
+    key = (signature, from_date, to_date, json.dumps(dataset, sort_keys=True))
+    with _aggregates_lock:
+        aggregate = _aggregates.get(key)
+        if aggregate is None:
+            aggregate = {}
+            for _, files in get_export_runs(paths):
+                # Newer runs replace the days (and subscriptions) they cover
+                aggregate.update(_aggregate_run(files, from_date, to_date, dataset.get('filter'), extra_dimensions, export_path))
+            _aggregates.clear()
+            _aggregates[key] = aggregate
+    return aggregate
+
+def load_export_cost_data(from_date, to_date, subscription_id=None, dataset=None, export_path=None):
+    """
+    Aggregate Cost Management export files into daily cost rows.
+
+    Records are streamed and summed on the fly per day and grouping key, so
+    memory grows with the number of distinct groups, not with the file size.
+    The files are parsed once for every subscription of the same window and
+    query, and days repeated by several export runs are only counted from the
+    newest one (see get_export_runs).
+
+    Args:
+        from_date (int): First usage date (YYYYMMDD) to include.
+        to_date (int): Last usage date (YYYYMMDD) to include.
+        subscription_id (str): Only include this subscription, when the export has the column.
+        dataset (dict): The query 'dataset' (filter and grouping) to reproduce, see get_usage_data_window.
+        export_path (str): Directory holding the exports, defaults to cost_export_path.
+
+    Returns:
+        list: Rows in the same shape as process_cost_data returns, plus any extra
+        grouping dimension (e.g. 'ResourceId', 'SubscriptionId').
+
+    Raises:
+        KeyError: When an export lacks the date or cost column or a filtered column,
+            or is a backfill partition of another filter (see get_applied_filter).
+    """
+    dataset = dataset or {}
+    grouping = [g['name'] for g in dataset.get('grouping', [])] or ['ServiceName']
+    extra_dimensions = [name for name in grouping if name != 'ServiceName']
+    subscription_id = subscription_id.lower() if subscription_id else None
+
+    totals = {}
+    for (date, subscription), day in _get_aggregate(export_path, from_date, to_date, dataset, extra_dimensions).items():
+        # Exports without a subscription column are not filtered
+        if subscription_id and subscription is not None and subscription != subscription_id:
+            continue
+        for (service, currency, dimensions), cost in day.items():
+            key = (date, service, currency, dimensions)
+            totals[key] = totals.get(key, 0.0) + cost
+
+    # Rows are ordered by day and service, or first by the dimensions the query sorts on
+    sort_positions = [extra_dimensions.index(s['name']) for s in dataset.get('sorting', []) if s.get('name') in extra_dimensions]
+    rows = []
+    for (date, service, currency, dimensions), cost in sorted(totals.items(), key=lambda item: (
+        tuple((item[0][3][i] or '').lower() for i in sort_positions), item[0][0], item[0][1] or ''
+    )):
+        row = {
+            'cost': cost,
+            'date': date,
+            'service': service,
+            'currency': currency
+        }
+        row.update(zip(extra_dimensions, dimensions))
+        rows.append(row)
+    return rows
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from utils import config
+
+_schema_lock = threading.Lock()
+_initialized_paths = set()
+
+def is_enabled():
+    """
+    Return True when the local cost history store is configured.
+
+    Set the cost_store_path setting to an empty string to disable it.
+    """
+    return bool(config.get_settings().cost_store_path)
+
+def get_query_key(usage_data):
+    """
+    Build a stable key for the dataset part of a usage payload.
+
+    Rows fetched with different filters or groupings must not be mixed, so the
+    key covers everything except the time period.
+
+    Args:
+        usage_data (dict): The usage data payload.
+
+    Returns:
+        str: A short hash identifying the query definition.
+    """
+    definition = {k: v for k, v in usage_data.items() if k not in ('timeframe', 'timePeriod')}
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+@contextmanager
+def _connect():
+    cost_store_path = config.get_settings().cost_store_path
+    if cost_store_path not in _initialized_paths:
+        with _schema_lock:
+            if cost_store_path not in _initialized_paths:
+                os.makedirs(os.path.dirname(cost_store_path) or '.', exist_ok=True)
+                conn = sqlite3.connect(cost_store_path, timeout=30)
+                try:
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS cost_rows ('
+                        'subscription_id TEXT, query_key TEXT, date INTEGER, service TEXT, cost REAL, currency TEXT, '
+                        'PRIMARY KEY (subscription_id, query_key, date, service))'
+                    )
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS fetched_days ('
+                        'subscription_id TEXT, query_key TEXT, date INTEGER, fetched_at TEXT, '
+                        'PRIMARY KEY (subscription_id, query_key, date))'
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+                _initialized_paths.add(cost_store_path)
+    conn = sqlite3.connect(cost_store_path, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def date_range(from_date, to_date):
+    """
+    List every day between two dates, inclusive.
+
+    Args:
+        from_date (datetime): First day.
+        to_date (datetime): Last day.
+
+    Returns:
+        list: Usage dates as YYYYMMDD integers.
+    """
+    days = (to_date.date() - from_date.date()).days
+    return [int((from_date + timedelta(days=i)).strftime('%Y%m%d')) for i in range(days + 1)]
+
+def missing_dates(subscription_id, query_key, dates, today=None):
+    """
+    Return the days that still have to be fetched from Cost Management.
+
+    A day is missing when it was never fetched, or when it falls within the
+    unsettled window and was last fetched before today.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        query_key (str): Key returned by get_query_key.
+        dates (list): Usage dates (YYYYMMDD integers) the report needs.
+        today (datetime): Reference "now", defaults to the current time.
+
+    Returns:
+        list: Sorted usage dates that must be (re)fetched.
+    """
+    today = today or datetime.now()
+    # Azure restates the most recent days, so they are re-fetched until they settle
+    settled_before = int((today - timedelta(days=config.get_settings().cost_store_unsettled_days)).strftime('%Y%m%d'))
+    today_str = today.strftime('%Y-%m-%d')
+
+    with _connect() as conn:
+        fetched = dict(conn.execute(
+            'SELECT date, fetched_at FROM fetched_days WHERE subscription_id = ? AND query_key = ? AND date BETWEEN ? AND ?',
+            (subscription_id, query_key, min(dates), max(dates))
+        ).fetchall())
+
+    missing = []
+    for date in dates:
+        fetched_at = fetched.get(date)
+        if fetched_at is None or (date >= settled_before and fetched_at[:10] < today_str):
+            missing.append(date)
+    return sorted(missing)
+
+def save_rows(subscription_id, query_key, dates, cost_data):
+    """
+    Replace the stored rows for the given days with freshly fetched ones.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        query_key (str): Key returned by get_query_key.
+        dates (list): Usage dates covered by the fetch, including days without rows.
+        cost_data (iterable): Rows as returned by process_cost_data or iter_cost_data.
+    """
+    # Drain the rows before opening the write transaction: a streamed query would
+    # otherwise hold the database lock across every page fetch and throttling sleep
+    records = [(subscription_id, query_key, int(row['date']), row['service'], row['cost'], row['currency']) for row in cost_data]
+    fetched_at = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    with _connect() as conn:
+        conn.execute(
+            'DELETE FROM cost_rows WHERE subscription_id = ? AND query_key = ? AND date BETWEEN ? AND ?',
+            (subscription_id, query_key, min(dates), max(dates))
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO cost_rows (subscription_id, query_key, date, service, cost, currency) VALUES (?, ?, ?, ?, ?, ?)',
+            records
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO fetched_days (subscription_id, query_key, date, fetched_at) VALUES (?, ?, ?, ?)',
+            [(subscription_id, query_key, date, fetched_at) for date in dates]
+        )
+
+def load_rows(subscription_id, query_key, from_date, to_date):
+    """
+    Load stored cost rows for a range of days.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        query_key (str): Key returned by get_query_key.
+        from_date (int): First usage date (YYYYMMDD).
+        to_date (int): Last usage date (YYYYMMDD).
+
+    Returns:
+        list: Rows in the same shape as process_cost_data returns.
+    """
+    with _connect() as conn:
+        rows = conn.execute(
+            'SELECT cost, date, service, currency FROM cost_rows '
+            'WHERE subscription_id = ? AND query_key = ? AND date BETWEEN ? AND ? ORDER BY date, service',
+            (subscription_id, query_key, from_date, to_date)
+        ).fetchall()
+    return [
+        {
+            'cost': row[0],
+            'date': row[1],
+            'service': row[2],
+            'currency': row[3]
+        }
+        for row in rows
+    ]
@@ -0,0 +1,176 @@
+from array import array
+
+# Cost Management column names mapped to the fields used throughout the reports
+COLUMN_ALIASES = {
+    'cost': ('Cost', 'PreTaxCost', 'CostUSD', 'PreTaxCostUSD', 'totalCost'),
+    'date': ('UsageDate', 'BillingMonth'),
+    'service': ('ServiceName',),
+    'currency': ('Currency',),
+}
+
+# Positional layout of the default ServiceName query, used when a page has no column metadata
+DEFAULT_COLUMNS = [{'name': 'Cost'}, {'name': 'UsageDate'}, {'name': 'ServiceName'}, {'name': 'Currency'}]
+
+def get_column_indexes(columns):
+    """
+    Map the response's `properties.columns` metadata to row positions.
+
+    Args:
+        columns (list): Column descriptors ({'name': ..., 'type': ...}) from the response.
+
+    Returns:
+        dict: 'cost', 'date', 'service' and 'currency' (when present) plus every
+        other column by its own name, mapped to its position in each row.
+
+    Raises:
+        KeyError: If the columns do not include a cost column.
+    """
+    indexes = {}
+    for position, column in enumerate(columns or DEFAULT_COLUMNS):
+        name = column['name']
+        for field, aliases in COLUMN_ALIASES.items():
+            if name in aliases and field not in indexes:
+                indexes[field] = position
+                break
+        else:
+            indexes[name] = position
+    if 'cost' not in indexes:
+        raise KeyError("Response columns do not include a cost column.")
+    return indexes
+
+class Categories:
+    """
+    Categorical encoding of a string column: each distinct value gets an integer code.
+    """
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+class CostTable:
+    """
+    Compact columnar store of cost rows.
+
+    Costs and dates live in typed arrays, service names, currencies and any
+    extra grouping dimensions are stored as categorical codes.
+    """
+    __slots__ = ('costs', 'dates', 'service_codes', 'services', 'currency_codes', 'currencies', 'dimensions')
+
+    def __init__(self, dimensions=()):
+        self.costs = array('d')
+        self.dates = array('l')
+        self.service_codes = array('l')
+        self.services = Categories()
+        self.currency_codes = array('l')
+        self.currencies = Categories()
+        self.dimensions = {name: (array('l'), Categories()) for name in dimensions}
+
+    @classmethod
+    def from_rows(cls, cost_data, dimensions=()):
+        """
+        Build a table from cost data dictionaries.
+
+        Args:
+            cost_data (iterable): Dicts with 'cost', 'date', 'service', 'currency' and the extra dimensions.
+            dimensions (tuple): Names of extra grouping dimensions to keep.
+
+        Returns:
+            CostTable: The populated table.
+        """
+        table = cls(dimensions)
+        for row in cost_data:
+            table.append(row)
+        return table
+
+    def append(self, row):
+        self.costs.append(float(row['cost']))
+        self.dates.append(int(row.get('date') or 0))
+        self.service_codes.append(self.services.encode(row.get('service')))
+        self.currency_codes.append(self.currencies.encode(row.get('currency')))
+        for name, (codes, categories) in self.dimensions.items():
+            codes.append(categories.encode(row.get(name)))
+
+    def __len__(self):
+        return len(self.costs)
+
+    def iter_rows(self):
+        """
+        Yield the rows back as cost data dictionaries.
+        """
+        for i in range(len(self.costs)):
+            row = {
+                'cost': self.costs[i],
+                'date': self.dates[i],
+                'service': self.services.values[self.service_codes[i]],
+                'currency': self.currencies.values[self.currency_codes[i]]
+            }
+            for name, (codes, categories) in self.dimensions.items():
+                row[name] = categories.values[codes[i]]
+            yield row
+
+    def service_totals(self, dates=None):
+        """
+        Sum costs per service, optionally restricted to some usage dates.
+
+        Args:
+            dates (set): Usage dates (YYYYMMDD integers) to include, defaults to all.
+
+        Returns:
+            dict: Service code -> total cost, for services with at least one matching row.
+        """
+        totals = {}
+        if dates is None:
+            for code, cost in zip(self.service_codes, self.costs):
+                totals[code] = totals.get(code, 0.0) + cost
+        else:
+            for code, cost, date in zip(self.service_codes, self.costs, self.dates):
+                if date in dates:
+                    totals[code] = totals.get(code, 0.0) + cost
+        return totals
+
+    def daily_service_totals(self, dates):
+        """
+        Sum costs per usage date and service name, in one pass.
+
+        Args:
+            dates (set): Usage dates (YYYYMMDD integers) to include.
+
+        Returns:
+            dict: Date -> {service name: total cost}, for dates with at least one row.
+        """
+        totals = {}
+        for code, cost, date in zip(self.service_codes, self.costs, self.dates):
+            if date in dates:
+                day = totals.setdefault(date, {})
+                service = self.services.values[code]
+                day[service] = day.get(service, 0.0) + cost
+        return totals
+
+    def service_currencies(self):
+        """
+        Return the currency of each service, indexed by service code.
+        """
+        currencies = [None] * len(self.services)
+        for code, currency_code in zip(self.service_codes, self.currency_codes):
+            if currencies[code] is None:
+                currencies[code] = self.currencies.values[currency_code]
+        return currencies
+
+def as_cost_table(cost_data):
+    """
+    Return cost_data as a CostTable, converting lists of dictionaries.
+    """
+    if isinstance(cost_data, CostTable):
+        return cost_data
+    return CostTable.from_rows(cost_data)
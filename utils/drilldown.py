@@ -0,0 +1,163 @@
+import heapq
+import logging
+from utils import config
+
+# Cost Management accepts at most two grouping dimensions; the resource group is
+# recovered from the ResourceId path instead of being grouped on separately
+DRILLDOWN_GROUPING = ['ServiceName', 'ResourceId']
+
+def is_enabled():
+    """
+    Return True when the resource-level drill-down report is switched on.
+    """
+    return config.get_settings().drilldown_enabled
+
+def get_resource_group(resource_id):
+    """
+    Extract the resource group name from an Azure resource ID.
+
+    Args:
+        resource_id (str): e.g. /subscriptions/.../resourceGroups/<rg>/providers/...
+
+    Returns:
+        str: The resource group name, or an empty string if the ID has none.
+    """
+    parts = (resource_id or '').split('/')
+    for i, part in enumerate(parts[:-1]):
+        if part.lower() == 'resourcegroups':
+            return parts[i + 1]
+    return ''
+
+def get_resource_name(resource_id):
+    """
+    Return the last segment of an Azure resource ID (the resource name).
+    """
+    return (resource_id or '').rstrip('/').rsplit('/', 1)[-1]
+
+class TopMovers:
+    """
+    Streaming top-K of the resources whose cost changed most, per service.
+
+    Drill-down queries return their rows ordered by ResourceId (see
+    get_usage_data_window), so the rows of one resource arrive together. Only
+    the resource being read is accumulated (its report-day and baseline
+    costs); once the next resource starts it is ranked in a bounded heap of K
+    entries per service. Memory stays at O(K) per service, not O(resources).
+
+    A resource whose rows come back out of order is merged into its heap
+    entry when it still holds one, and a warning is logged, since the
+    movers may then be incomplete.
+    """
+
+    def __init__(self, report_dates, baseline_dates, k=None, keep_report_costs=False):
+        """
+        Args:
+            report_dates (set): Usage dates (YYYYMMDD) of the report period.
+            baseline_dates (set): Usage dates (YYYYMMDD) averaged into the baseline.
+            k (int): Number of movers kept per service.
+            keep_report_costs (bool): Also keep every resource's report-period
+                cost, for anomaly scoring (see report_costs).
+        """
+        self.report_dates = set(report_dates)
+        self.baseline_dates = set(baseline_dates)
+        self.k = k or config.get_settings().drilldown_top_k
+        self._heaps = {}
+        self._report_costs = {} if keep_report_costs else None
+        self._resource_id = None
+        self._current = {}
+        self._unordered = False
+
+    def add(self, row):
+        date = int(row.get('date') or 0)
+        if date in self.report_dates:
+            side = 0
+            cost = row['cost'] / len(self.report_dates)
+        elif date in self.baseline_dates:
+            side = 1
+            cost = row['cost'] / len(self.baseline_dates)
+        else:
+            return
+        resource_id = row.get('ResourceId') or ''
+        if resource_id != self._resource_id:
+            if self._current and resource_id.lower() < self._resource_id.lower() and not self._unordered:
+                logging.warning("Drill-down rows are not ordered by ResourceId; the top movers may be incomplete")
+                self._unordered = True
+            self._rank_current()
+            self._resource_id = resource_id
+        costs = self._current.get(row.get('service'))
+        if costs is None:
+            costs = self._current[row.get('service')] = [0.0, 0.0]
+        costs[side] += cost
+
+    def _rank_current(self):
+        # The resource read so far is complete: rank it and forget it
+        resource_id = self._resource_id
+        for service, (cost_a, cost_b) in self._current.items():
+            heap = self._heaps.setdefault(service, [])
+            if self._unordered:
+                for i, (_, other_id, other_a, other_b) in enumerate(heap):
+                    if other_id == resource_id:
+                        cost_a, cost_b = cost_a + other_a, cost_b + other_b
+                        heap[i] = heap[-1]
+                        heap.pop()
+                        heapq.heapify(heap)
+                        break
+            entry = (abs(cost_a - cost_b), resource_id, cost_a, cost_b)
+            if len(heap) < self.k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            if self._report_costs is not None:
+                name = f"{service}|{resource_id}"
+                self._report_costs[name] = self._report_costs.get(name, 0.0) + self._current[service][0]
+        self._current = {}
+
+    def observe(self, cost_data):
+        """
+        Pass cost rows through unchanged while ranking them.
+
+        Args:
+            cost_data (iterable): Cost data dictionaries with a 'ResourceId' key.
+
+        Yields:
+            dict: The same rows.
+        """
+        for row in cost_data:
+            self.add(row)
+            yield row
+        self._rank_current()
+
+    def report_costs(self):
+        """
+        Return the report-period cost of every resource, keyed 'service|resource_id'
+        (the resource series scored by anomaly.score_day).
+
+        Empty unless the movers were created with keep_report_costs.
+        """
+        self._rank_current()
+        return dict(self._report_costs or {})
+
+    def results(self):
+        """
+        Return the top movers of every service.
+
+        Returns:
+            dict: Service name -> list of mover dicts (resource_id, resource_group,
+            resource_name, cost_a, cost_b, diff, percent), largest absolute diff first.
+        """
+        self._rank_current()
+        movers = {}
+        for service, heap in self._heaps.items():
+            movers[service] = [
+                {
+                    'resource_id': resource_id,
+                    'resource_group': get_resource_group(resource_id),
+                    'resource_name': get_resource_name(resource_id),
+                    'cost_a': cost_a,
+                    'cost_b': cost_b,
+                    'diff': cost_a - cost_b,
+                    'percent': (cost_a - cost_b) / cost_b * 100 if cost_b else float('inf') if cost_a else 0
+                }
+                for _, resource_id, cost_a, cost_b in sorted(heap, reverse=True)
+            ]
+        return movers
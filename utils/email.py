@@ -1,102 +1,280 @@
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from jinja2 import Template
-import os
-
-def send_email(html_table_rows, email_smtp_server, email_smtp_port, email_password, label_a="Current", label_b="Previous", subscription_name="Unknown Subscription"):
-    email_sender = os.getenv('email_sender')
-    email_recipients = os.getenv('email_recipients', '').split(',')
-    if not email_sender:
+import logging
+import threading
+import time
+from utils import config
+from utils import report_render
+
+def get_email_addresses():
+    """
+    Read the sender and default recipient addresses from the settings.
+
+    Returns:
+        tuple: (email_sender, email_recipients list). The recipients may be
+        empty when every report has its own (see get_recipients).
+
+    Raises:
+        ValueError: If the sender is missing.
+    """
+    settings = config.get_settings()
+    if not settings.email_sender:
         raise ValueError("email_sender environment variable is not set.")
-    if not email_recipients or email_recipients == ['']:
-        raise ValueError("email_recipients environment variable is not set.")
+    return settings.email_sender, list(settings.email_recipients)
+
+def get_recipients(recipients, default_recipients):
+    """
+    Return a report's own recipients, else the email_recipients setting.
 
-    # Create the email message
-    msg = MIMEMultipart()
+    Raises:
+        ValueError: If the report has no recipients and the setting is empty.
+    """
+    recipients = list(recipients or default_recipients)
+    if not recipients:
+        raise ValueError("email_recipients environment variable is not set and the report has no recipients.")
+    return recipients
+
+def build_message(subject, reports, report_date, email_sender, email_recipients):
+    """
+    Create the MIME message for one or more subscription reports.
+
+    The HTML and plain-text bodies are both rendered from the same comparison
+    results.
+
+    Args:
+        subject (str): The email subject.
+        reports (list): Dicts with 'subscription_name' and 'comparison'.
+        report_date (str): Generation timestamp shown in the report.
+        email_sender (str): The From address.
+        email_recipients (list): The To addresses.
+
+    Returns:
+        MIMEMultipart: The message.
+    """
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    msg = MIMEMultipart('alternative')
     msg['From'] = email_sender
     msg['To'] = ', '.join(email_recipients)
-    msg['Subject'] = f'Azure Cost Comparison Report - {subscription_name}'
-
-    # Create the HTML email body with the comparison table
-    html_body = f"""
-    <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; margin: 20px; }}
-                h1 {{ color: #0078d4; margin-bottom: 20px; }}
-                h2 {{ color: #106ebe; margin-top: 30px; margin-bottom: 15px; }}
-                table {{ border-collapse: collapse; width: 100%; margin-top: 20px; }}
-                th {{ background-color: #0078d4; color: white; padding: 12px; text-align: left; border: 1px solid #ddd; }}
-                td {{ padding: 10px; border: 1px solid #ddd; text-align: left; }}
-                tr:nth-child(even) {{ background-color: #f9f9f9; }}
-                tr:hover {{ background-color: #e8f4fd; }}
-                .increase {{ background-color: #ffcccc !important; }}
-                .summary {{ background-color: #e8f4fd; padding: 15px; border-radius: 5px; margin-bottom: 20px; }}
-                .footer {{ margin-top: 30px; font-size: 12px; color: #666; }}
-                .highlight-note {{ color: #d13438; font-weight: bold; margin-top: 10px; }}
-                .subscription-info {{ background-color: #f0f8ff; padding: 10px; border-radius: 5px; margin-bottom: 20px; border-left: 4px solid #0078d4; }}
-            </style>
-        </head>
-        <body>
-            <h1>Azure Cost Comparison Report</h1>
-            
-            <div class="subscription-info">
-                <h3>Subscription: {subscription_name}</h3>
-            </div>
-            
-            <div class="summary">
-                <h2>Cost Comparison: {label_a} vs {label_b}</h2>
-                <p>This report shows the cost comparison between two periods for your Azure services.</p>
-            </div>
-
-            <h2>Service Cost Comparison</h2>
-            <table>
-                <thead>
-                    <tr>
-                        <th>Service</th>
-                        <th>{label_a}</th>
-                        <th>{label_b}</th>
-                        <th>Difference (R$)</th>
-                        <th>Difference (%)</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {html_table_rows}
-                </tbody>
-            </table>
-            
-            <p class="highlight-note">
-                * Services highlighted in red indicate cost increases greater than 10%
-            </p>
-
-            <div class="footer">
-                <p>Generated on: {os.environ.get('REPORT_DATE', 'N/A')}</p>
-                <p>Subscription: {subscription_name}</p>
-                <p>This is an automated report from Azure Cost Management</p>
-            </div>
-        </body>
-    </html>
-    """
-
-    msg.attach(MIMEText(html_body, 'html'))
-
-    if os.getenv('DEBUG', 'false').lower() == 'true':
-        print("Email content:")
-        print("From:", msg['From'])
-        print("To:", msg['To'])
-        print("Subject:", msg['Subject'])
-        print("Body:")
-        print(html_body)
-        return  # Don't send email in debug mode
-
-    # Send the email
-    with smtplib.SMTP(email_smtp_server, email_smtp_port) as smtp:
-        smtp.ehlo()
-        smtp.starttls()
-        smtp.ehlo()
-        if not email_password:
+    msg['Subject'] = subject
+    msg.attach(MIMEText(report_render.render('text', reports, report_date), 'plain'))
+    msg.attach(MIMEText(report_render.render('html', reports, report_date), 'html'))
+    return msg
+
+def get_subject(comparison, subscription_name):
+    """
+    Return the email subject of one report; named reports (see report_specs) carry their name.
+    """
+    report_name = comparison.get('report')
+    if report_name and report_name != 'default':
+        return f'Azure Cost Comparison Report - {subscription_name} - {report_name}'
+    return f'Azure Cost Comparison Report - {subscription_name}'
+
+class SmtpDelivery:
+    """
+    One authenticated SMTP session shared by every report of a run.
+
+    The connection is opened on the first message, reused for the following
+    ones, re-established once if the server drops it, and rate limited to one
+    message every email_send_interval seconds. Safe to share between threads.
+    smtplib is only imported once the first message is sent. Once closed it
+    refuses to send, so a worker that outlived its subscription_timeout cannot
+    email after the run has ended.
+    """
+
+    def __init__(self, email_smtp_server, email_smtp_port, email_password, send_interval=None):
+        self.email_smtp_server = email_smtp_server
+        self.email_smtp_port = email_smtp_port
+        self.email_password = email_password
+        self.send_interval = config.get_settings().email_send_interval if send_interval is None else send_interval
+        self.email_sender, self.email_recipients = get_email_addresses()
+        self._smtp = None
+        self._last_send = 0.0
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+        if not self.email_password:
             raise ValueError("Email password is not set. Please check your environment variables.")
-        smtp.login("apikey", email_password)  # Use "apikey" as the login name and the API key as the password
-        smtp.send_message(msg)
+        import smtplib
+        smtp = smtplib.SMTP(self.email_smtp_server, self.email_smtp_port)
+        try:
+            smtp.ehlo()
+            # STARTTLS can only be turned off for local SMTP stand-ins
+            if config.get_settings().email_smtp_starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            smtp.login("apikey", self.email_password)  # Use "apikey" as the login name and the API key as the password
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+
+    def _disconnect(self):
+        import smtplib
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                self._smtp.close()
+            except OSError:
+                pass
+            self._smtp = None
+
+    def send_message(self, msg):
+        """
+        Send a message over the shared session.
+
+        Args:
+            msg (email.message.Message): The message to send.
+
+        Raises:
+            ValueError: If the delivery was closed.
+        """
+        if config.get_settings().DEBUG:
+            print("Email content:")
+            print("From:", msg['From'])
+            print("To:", msg['To'])
+            print("Subject:", msg['Subject'])
+            print("Body:")
+            print(msg.get_payload()[-1].get_payload())
+            return  # Don't send email in debug mode
+
+        import smtplib
+        with self._lock:
+            if self.closed:
+                logging.warning(f"Not sending '{msg['Subject']}': the run's email delivery is already closed")
+                raise ValueError("Email delivery is closed; the report finished after the run ended and was not sent.")
+            wait = self._last_send + self.send_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if self._smtp is None:
+                    self._connect()
+                self._smtp.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # The server dropped the idle session; reconnect once and retry
+                self._smtp = None
+                self._connect()
+                self._smtp.send_message(msg)
+            self._last_send = time.monotonic()
         print('Email sent successfully using SendGrid.')
+
+    def send_report(self, comparison, subscription_name, report_date, recipients=None):
+        """
+        Send one subscription's cost comparison report.
+
+        Args:
+            recipients (list): The report's own recipients, defaults to email_recipients.
+        """
+        self.send_message(build_message(
+            get_subject(comparison, subscription_name),
+            [{'subscription_name': subscription_name, 'comparison': comparison}],
+            report_date,
+            self.email_sender,
+            get_recipients(recipients, self.email_recipients)
+        ))
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._disconnect()
+
+class DigestDelivery:
+    """
+    Collects every subscription's report and sends them as a single message on close.
+
+    Reports arriving after close (from workers that outlived their
+    subscription_timeout) are refused rather than added to a digest that
+    was already sent.
+    """
+
+    def __init__(self, delivery):
+        """
+        Args:
+            delivery (SmtpDelivery): Session used to send the digest.
+        """
+        self.delivery = delivery
+        self.reports = {}
+        self.report_date = None
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def send_report(self, comparison, subscription_name, report_date, recipients=None):
+        recipients = tuple(get_recipients(recipients, self.delivery.email_recipients))
+        with self._lock:
+            if self.closed:
+                logging.warning(f"Not adding the report of {subscription_name} to the digest: it was already sent")
+                raise ValueError("Digest email already sent; the report finished after the run ended and was not sent.")
+            self.reports.setdefault(recipients, []).append({'subscription_name': subscription_name, 'comparison': comparison})
+            self.report_date = report_date
+
+    def close(self):
+        """
+        Send the digest (one per distinct recipient list, if any report was
+        collected) and close the session.
+        """
+        with self._lock:
+            self.closed = True
+        try:
+            for recipients, reports in self.reports.items():
+                reports.sort(key=lambda report: (report['subscription_name'], report['comparison'].get('report') or ''))
+                named = any(report['comparison'].get('report') not in (None, 'default') for report in reports)
+                self.delivery.send_message(build_message(
+                    f"Azure Cost Comparison Report - {len(reports)} {'report' if named else 'subscription'}(s)",
+                    reports,
+                    self.report_date,
+                    self.delivery.email_sender,
+                    list(recipients)
+                ))
+            self.reports = {}
+        finally:
+            self.delivery.close()
+
+def open_delivery(email_smtp_server, email_smtp_port, email_password):
+    """
+    Open the delivery used for a whole run.
+
+    Returns a DigestDelivery when the email_digest setting is true, otherwise a
+    plain SmtpDelivery sending one message per subscription. Use it as a
+    context manager so the session is closed (and the digest sent) at the end.
+    """
+    delivery = SmtpDelivery(email_smtp_server, email_smtp_port, email_password)
+    if config.get_settings().email_digest:
+        return DigestDelivery(delivery)
+    return delivery
+
+def send_email(comparison, email_smtp_server, email_smtp_port, email_password, subscription_name="Unknown Subscription", report_date=None, delivery=None, recipients=None):
+    """
+    Send a subscription's cost comparison report by email.
+
+    Args:
+        comparison (dict): Result of azure_subscription_queries.build_comparison.
+        email_smtp_server (str): SMTP server host.
+        email_smtp_port (int): SMTP server port.
+        email_password (str): SendGrid API key.
+        subscription_name (str): Subscription display name.
+        report_date (str): Generation timestamp shown in the report.
+        delivery (SmtpDelivery or DigestDelivery): Shared delivery of the current run, if any.
+        recipients (list): The report's own recipients, defaults to the email_recipients setting.
+    """
+    report_date = report_date or config.get_settings().REPORT_DATE
+
+    if delivery is not None:
+        delivery.send_report(comparison, subscription_name, report_date, recipients=recipients)
+        return
+
+    # No shared session: open a one-off connection for this report
+    with SmtpDelivery(email_smtp_server, email_smtp_port, email_password) as one_off:
+        one_off.send_report(comparison, subscription_name, report_date, recipients=recipients)
@@ -0,0 +1,73 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import config
+
+def get_subscription_ids():
+    """
+    Read the list of subscriptions to report on from configuration.
+
+    Uses the comma-separated `subscription_ids` setting, falling back to the
+    single `subscription_id` setting.
+
+    Returns:
+        list: The subscription IDs, without duplicates, in configured order.
+    """
+    return list(config.get_settings().subscription_ids)
+
+def run_for_subscriptions(task, subscription_ids, max_workers=None, timeout=None):
+    """
+    Run a per-subscription task concurrently with a bounded worker pool.
+
+    A failure or timeout in one subscription never affects the others; it is
+    reported as an error result for that subscription.
+
+    Args:
+        task (callable): Function taking a subscription ID and returning a result dict.
+        subscription_ids (list): Subscription IDs to process.
+        max_workers (int): Maximum number of subscriptions in flight at once.
+        timeout (float): Seconds a single subscription may run before it is reported as timed out.
+
+    Returns:
+        list: One result dict per subscription, in the same order as subscription_ids.
+    """
+    settings = config.get_settings()
+    max_workers = max_workers or settings.max_concurrent_subscriptions
+    timeout = timeout or settings.subscription_timeout
+    subscription_ids = list(dict.fromkeys(subscription_ids))
+    if not subscription_ids:
+        return []
+
+    started = {}
+    results = {}
+
+    def run(sub_id):
+        started[sub_id] = time.monotonic()
+        return task(sub_id)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(subscription_ids)), thread_name_prefix='cost-report')
+    try:
+        futures = {executor.submit(run, sub_id): sub_id for sub_id in subscription_ids}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                sub_id = futures[future]
+                try:
+                    results[sub_id] = future.result()
+                except Exception as e:
+                    logging.error(f"Error processing subscription {sub_id}: {str(e)}")
+                    results[sub_id] = {"status": "error", "subscription_id": sub_id, "message": str(e)}
+
+            now = time.monotonic()
+            for future in list(pending):
+                sub_id = futures[future]
+                if sub_id in started and now - started[sub_id] > timeout:
+                    logging.error(f"Subscription {sub_id} timed out after {timeout:g}s")
+                    results[sub_id] = {"status": "error", "subscription_id": sub_id, "message": f"Timed out after {timeout:g}s"}
+                    pending.discard(future)
+    finally:
+        # Do not block on timed-out workers; they finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return [results[sub_id] for sub_id in subscription_ids]
@@ -0,0 +1,59 @@
+import threading
+from utils import config
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Return the process-wide pooled HTTP session, creating it on first use.
+
+    The session keeps connections to login.microsoftonline.com and
+    management.azure.com alive between calls and asks for gzip-encoded responses.
+    requests is only imported here, keeping it out of the cold-start path.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                settings = config.get_settings()
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=settings.http_pool_connections, pool_maxsize=settings.http_pool_maxsize)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+                _session = session
+    return _session
+
+def request(method, url, **kwargs):
+    """
+    Send an HTTP request through the shared session with the default timeouts.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The request URL.
+        **kwargs: Passed through to requests.Session.request.
+
+    Returns:
+        requests.Response: The response object.
+    """
+    settings = config.get_settings()
+    kwargs.setdefault('timeout', (settings.http_connect_timeout, settings.http_read_timeout))
+    return get_session().request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    """
+    Send a GET request through the shared session.
+    """
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    """
+    Send a POST request through the shared session.
+    """
+    return request('POST', url, **kwargs)
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+from utils import blob_store
+from utils import config
+from utils import work_queue
+
+# Blob container holding the manual report jobs: {job_id}.json describes the
+# job, {job_id}/{part}.json holds the outcome of each queued part and
+# keys/{hash}.json points at the job currently serving a coalescing key
+JOB_CONTAINER = 'cost-report-jobs'
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+def _read_json(blob_name):
+    data, etag = blob_store.read_blob(JOB_CONTAINER, blob_name)
+    if data is None:
+        return None, None
+    try:
+        return json.loads(data), etag
+    except ValueError:
+        logging.warning(f"Ignoring unreadable job blob {blob_name}")
+        return None, etag
+
+def get_key_name(key):
+    """
+    Return the blob name of a coalescing key (subscriptions, scope, report day, refresh).
+    """
+    return f"keys/{hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()}.json"
+
+def get_deadline(job):
+    """
+    Return when an unfinished job is given up on.
+
+    Each part may take subscription_timeout seconds per attempt and is tried
+    MAX_DEQUEUE_COUNT times; a part that never reports by then (e.g. its
+    message was lost) would otherwise keep the job running forever.
+    """
+    timeout = config.get_settings().subscription_timeout * work_queue.MAX_DEQUEUE_COUNT
+    return datetime.fromisoformat(job['created_at']) + timedelta(seconds=timeout)
+
+def create_job(key, subscription_ids, report_day, parts):
+    """
+    Record a new job, or join the unfinished job already serving the same key.
+
+    The job blob is written first, then the key blob is claimed with a
+    conditional write; of two requests racing for the same key only one
+    creates the job, the other joins it. A job past its deadline (see
+    get_deadline) is expired and not joined.
+
+    Args:
+        key (list): Coalescing key of the job (JSON-serialisable).
+        subscription_ids (list): Subscriptions covered, for the status output.
+        report_day (str): The report day as YYYYMMDD.
+        parts (list): Names of the queued parts whose outcomes make up the job
+            (a subscription ID, or 'all' for a single batch message).
+
+    Returns:
+        tuple: (job ID, created) where created is False when the request was coalesced.
+    """
+    key_name = get_key_name(key)
+    current, etag = _read_json(key_name)
+    if current and get_job_status(current['job_id'], include_results=False) in ('queued', 'running'):
+        return current['job_id'], False
+
+    job_id = uuid.uuid4().hex
+    blob_store.write_blob(JOB_CONTAINER, f'{job_id}.json', json.dumps({
+        'job_id': job_id,
+        'subscription_ids': list(subscription_ids),
+        'report_day': report_day,
+        'parts': list(parts),
+        'created_at': _now()
+    }))
+    pointer = json.dumps({'job_id': job_id})
+    claimed = blob_store.write_blob(JOB_CONTAINER, key_name, pointer, etag=etag) if etag else blob_store.create_blob(JOB_CONTAINER, key_name, pointer)
+    if not claimed:
+        # Another request started a job for the same key in the meantime
+        blob_store.delete_blob(JOB_CONTAINER, f'{job_id}.json')
+        current, _ = _read_json(key_name)
+        if current:
+            return current['job_id'], False
+        raise RuntimeError("Could not start the cost report job, please retry.")
+    return job_id, True
+
+def start_part(job_id, part):
+    """
+    Mark one part of a job as running.
+    """
+    blob_store.write_blob(JOB_CONTAINER, f'{job_id}/{part}.json', json.dumps({'status': 'running', 'started_at': _now()}))
+
+def finish_part(job_id, part, results):
+    """
+    Record the per-subscription results of one part of a job.
+    """
+    blob_store.write_blob(JOB_CONTAINER, f'{job_id}/{part}.json', json.dumps({
+        'status': 'succeeded' if all(r.get('status') == 'success' for r in results) else 'failed',
+        'finished_at': _now(),
+        'results': results
+    }))
+
+def get_job_status(job_id, include_results=True):
+    """
+    Read a job and the outcome of its parts from storage.
+
+    Any instance can answer: nothing about the job is kept in memory. A job
+    is 'queued' until a part starts, 'running' until every part finished,
+    then 'succeeded' or 'failed'; an unfinished job past its deadline (see
+    get_deadline) is 'expired'. Jobs finished or expired more than
+    job_retention seconds ago are reported as unknown.
+
+    Returns:
+        dict or str: The job's status document (job_id, status, subscription_ids,
+        report_day, created_at, finished_at, results), only the status string
+        when include_results is False, or None for unknown or expired jobs.
+    """
+    job, _ = _read_json(f'{job_id}.json') if job_id and job_id.isalnum() else (None, None)
+    if job is None:
+        return None
+    parts = {}
+    for part in job['parts']:
+        outcome, _ = _read_json(f'{job_id}/{part}.json')
+        if outcome:
+            parts[part] = outcome
+
+    finished = [outcome for outcome in parts.values() if 'finished_at' in outcome]
+    retention = config.get_settings().job_retention
+    if len(finished) == len(job['parts']):
+        status = 'succeeded' if all(outcome['status'] == 'succeeded' for outcome in finished) else 'failed'
+        finished_at = max(outcome['finished_at'] for outcome in finished)
+        age = (datetime.now() - datetime.fromisoformat(finished_at)).total_seconds()
+        if age > retention:
+            return None
+    else:
+        status = 'running' if parts else 'queued'
+        finished_at = None
+        overdue = (datetime.now() - get_deadline(job)).total_seconds()
+        if overdue > retention:
+            return None
+        if overdue > 0:
+            status = 'expired'
+    if not include_results:
+        return status
+    return {
+        'job_id': job_id,
+        'status': status,
+        'subscription_ids': job['subscription_ids'],
+        'report_day': job['report_day'],
+        'created_at': job['created_at'],
+        'finished_at': finished_at,
+        'results': [result for outcome in finished for result in outcome['results']] if finished else None
+    }
@@ -0,0 +1,270 @@
+import calendar
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from utils import config
+
+# Span of the exponentially weighted daily average used for the projection
+EWMA_SPAN = 7
+EWMA_ALPHA = 2 / (EWMA_SPAN + 1)
+
+_state_lock = threading.Lock()
+
+def is_enabled():
+    """
+    Return True when month-to-date and forecast figures are added to the reports.
+    """
+    return config.get_settings().mtd_enabled
+
+def _to_date(value):
+    return datetime.strptime(str(value), '%Y%m%d').date()
+
+def _to_int(day):
+    return int(day.strftime('%Y%m%d'))
+
+class MonthToDate:
+    """
+    Running month-to-date cost of one report, per service.
+
+    Each day's per-service totals are applied once; the state holds the
+    folded (settled) sums, the per-day totals of the last
+    cost_store_unsettled_days days (Azure may still restate them, so they can
+    be replaced) and an exponentially weighted average of each service's daily
+    cost. Updating it costs one day of rows, whatever the day of the month.
+    """
+
+    def __init__(self, key, month=None):
+        self.key = key
+        self.month = month
+        self.settled = {}
+        self.settled_through = None
+        self.recent = {}
+        self.ewma = {}
+        self.currency = None
+
+    @classmethod
+    def load(cls, key):
+        """
+        Read the state from mtd_state_path (a fresh state when missing or unreadable).
+        """
+        state = cls(key)
+        path = state.path
+        if not path or not os.path.exists(path):
+            return state
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable month-to-date state {path}: {str(e)}")
+            return state
+        state.month = data.get('month')
+        state.settled = data.get('settled', {})
+        state.settled_through = data.get('settled_through')
+        state.recent = {int(date): totals for date, totals in data.get('recent', {}).items()}
+        state.ewma = data.get('ewma', {})
+        state.currency = data.get('currency')
+        return state
+
+    @property
+    def path(self):
+        state_path = config.get_settings().mtd_state_path
+        return os.path.join(state_path, f'{self.key}.json') if state_path else None
+
+    def save(self):
+        path = self.path
+        if not path:
+            return
+        data = {
+            'month': self.month,
+            'settled': self.settled,
+            'settled_through': self.settled_through,
+            'recent': {str(date): totals for date, totals in self.recent.items()},
+            'ewma': self.ewma,
+            'currency': self.currency
+        }
+        try:
+            with _state_lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write month-to-date state: {str(e)}")
+
+    def start_month(self, report_day):
+        """
+        Reset the state when the report day belongs to a new month.
+        """
+        month = report_day.strftime('%Y%m')
+        if self.month != month:
+            self.month = month
+            self.settled = {}
+            self.settled_through = None
+            self.recent = {}
+            self.ewma = {}
+
+    def missing_dates(self, report_day, available_from=None, unsettled_days=None):
+        """
+        Return the days (YYYYMMDD) that have to be (re)applied to bring the state to report_day.
+
+        On the first run of a month this is every day since the 1st; afterwards
+        only the new days plus the still-unsettled ones. Unsettled days before
+        available_from (the first day of rows at hand) are not fetched again
+        just to be restated.
+        """
+        unsettled_days = config.get_settings().cost_store_unsettled_days if unsettled_days is None else unsettled_days
+        self.start_month(report_day)
+        day = report_day.replace(day=1)
+        if self.settled_through:
+            day = max(day, _to_date(self.settled_through) + timedelta(days=1))
+        restate_from = report_day - timedelta(days=max(unsettled_days, 1) - 1)
+        dates = []
+        while day <= report_day:
+            date = _to_int(day)
+            if date not in self.recent or (day >= restate_from and date >= (available_from or 0)):
+                dates.append(date)
+            day += timedelta(days=1)
+        return dates
+
+    def apply_day(self, date, totals, currency=None):
+        """
+        Apply one day's per-service totals, replacing the day if it was applied before.
+
+        Args:
+            date (int): The usage date (YYYYMMDD), in the state's month.
+            totals (dict): Service -> cost of that day.
+            currency (str): Currency of the costs.
+        """
+        new_day = date not in self.recent and (self.settled_through is None or date > self.settled_through)
+        self.recent[date] = {service: float(cost) for service, cost in totals.items()}
+        self.currency = currency or self.currency
+        if new_day:
+            # Days are applied in order; services without cost that day count as zero
+            for service in set(self.ewma) | set(totals):
+                cost = float(totals.get(service, 0.0))
+                previous = self.ewma.get(service)
+                self.ewma[service] = cost if previous is None else EWMA_ALPHA * cost + (1 - EWMA_ALPHA) * previous
+
+    def fold(self, report_day, unsettled_days=None):
+        """
+        Fold the days Azure no longer restates into the settled sums.
+        """
+        unsettled_days = config.get_settings().cost_store_unsettled_days if unsettled_days is None else unsettled_days
+        settled_before = _to_int(report_day - timedelta(days=max(unsettled_days, 1) - 1))
+        for date in sorted(d for d in self.recent if d < settled_before):
+            for service, cost in self.recent.pop(date).items():
+                self.settled[service] = self.settled.get(service, 0.0) + cost
+            self.settled_through = max(self.settled_through or 0, date)
+
+    def totals(self):
+        """
+        Return the month-to-date cost of every service.
+        """
+        totals = dict(self.settled)
+        for day in self.recent.values():
+            for service, cost in day.items():
+                totals[service] = totals.get(service, 0.0) + cost
+        return totals
+
+    def summary(self, report_day, budget=None, forecast=None):
+        """
+        Build the month-to-date section of the report.
+
+        The end-of-month projection is the month-to-date cost plus each
+        service's weighted daily average for every remaining day.
+
+        Args:
+            report_day (date): Last day included in the figures.
+            budget (float): Monthly budget; no burn figures when empty.
+            forecast (float): Cost Management forecast of the remaining days, when cross-checked.
+
+        Returns:
+            dict: month, days_elapsed, days_in_month, mtd, projected, per-service
+            rows (service, mtd, daily_average, projected) and the budget-burn figures.
+        """
+        days_in_month = calendar.monthrange(report_day.year, report_day.month)[1]
+        remaining = days_in_month - report_day.day
+        totals = self.totals()
+        rows = [
+            {
+                'service': service,
+                'mtd': cost,
+                'daily_average': self.ewma.get(service, 0.0),
+                'projected': cost + self.ewma.get(service, 0.0) * remaining
+            }
+            for service, cost in totals.items()
+        ]
+        rows.sort(key=lambda row: row['projected'], reverse=True)
+        mtd = sum(row['mtd'] for row in rows)
+        projected = sum(row['projected'] for row in rows)
+        section = {
+            'month': report_day.strftime('%m/%Y'),
+            'days_elapsed': report_day.day,
+            'days_in_month': days_in_month,
+            'currency': self.currency,
+            'mtd': mtd,
+            'projected': projected,
+            'rows': rows,
+            'budget': budget or None,
+            'forecast': None
+        }
+        if budget:
+            elapsed = report_day.day / days_in_month
+            section.update({
+                'budget_used_percent': mtd / budget * 100,
+                'projected_budget_percent': projected / budget * 100,
+                # Above 1 the month spends faster than an even burn of the budget
+                'burn_rate': (mtd / budget) / elapsed,
+                'over_budget': projected > budget
+            })
+        if forecast is not None:
+            forecast_total = mtd + forecast
+            section['forecast'] = {
+                'projected': forecast_total,
+                'difference_percent': (projected - forecast_total) / forecast_total * 100 if forecast_total else 0
+            }
+        return section
+
+def get_day_totals(cost_data, dates):
+    """
+    Sum a CostTable per day and service for some usage dates, in one pass.
+
+    Args:
+        cost_data (CostTable): Daily cost rows.
+        dates (list): Usage dates (YYYYMMDD) to sum.
+
+    Returns:
+        tuple: (date -> {service: cost}, currency of the rows).
+    """
+    totals = cost_data.daily_service_totals(set(dates))
+    currencies = [c for c in cost_data.currencies.values if c]
+    return totals, currencies[0] if currencies else None
+
+def update(key, report_day, get_day_totals, available_from=None, budget=None, forecast=None):
+    """
+    Bring one report's month-to-date state up to report_day and summarise it.
+
+    Args:
+        key (str): State key, see report_specs.ReportSpec.get_state_key.
+        report_day (date): The day being reported on.
+        get_day_totals (callable): Takes the list of missing dates (YYYYMMDD) and
+            returns (date -> {service: cost}, currency) for them.
+        available_from (int): First usage date (YYYYMMDD) of the rows at hand, see missing_dates.
+        budget (float): Monthly budget for the burn figures.
+        forecast (float): Forecast of the remaining days, see summary.
+
+    Returns:
+        dict: The month-to-date section, see MonthToDate.summary.
+    """
+    state = MonthToDate.load(key)
+    dates = state.missing_dates(report_day, available_from)
+    if dates:
+        day_totals, currency = get_day_totals(dates)
+        for date in dates:
+            state.apply_day(date, day_totals.get(date, {}), currency)
+        state.fold(report_day)
+        state.save()
+    return state.summary(report_day, budget=budget, forecast=forecast)
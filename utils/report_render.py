@@ -0,0 +1,90 @@
+import json
+import math
+import os
+import threading
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Output format -> template file; 'json' is serialised directly from the comparison
+TEMPLATES = {
+    'html': 'report.html.j2',
+    'html_rows': 'report_rows.html.j2',
+    'text': 'report.txt.j2',
+}
+
+_environment = None
+_environment_lock = threading.Lock()
+
+def _money(value):
+    return f"R${value:,.2f}"
+
+def _fmt(value, spec):
+    return format(value, spec)
+
+def get_environment():
+    """
+    Return the process-wide Jinja2 environment.
+
+    Templates are compiled on first use and kept in the environment's cache for
+    the lifetime of the process (auto_reload is off, the files never change
+    after deployment). Jinja2 itself is only imported here, on first render.
+    """
+    global _environment
+    if _environment is None:
+        with _environment_lock:
+            if _environment is None:
+                from jinja2 import Environment, FileSystemLoader, select_autoescape
+                environment = Environment(
+                    loader=FileSystemLoader(TEMPLATE_DIR),
+                    autoescape=select_autoescape(['html', 'html.j2']),
+                    auto_reload=False,
+                    keep_trailing_newline=True
+                )
+                environment.filters['money'] = _money
+                environment.filters['fmt'] = _fmt
+                _environment = environment
+    return _environment
+
+def _json_safe(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(v) for v in value]
+    return value
+
+def render_stream(output_format, reports, report_date=None):
+    """
+    Render one or more comparison results, yielding the output in chunks.
+
+    Args:
+        output_format (str): 'html', 'html_rows', 'text' or 'json'.
+        reports (list): Dicts with 'subscription_name' and 'comparison' (see
+            azure_subscription_queries.build_comparison).
+        report_date (str): Generation timestamp shown in the report.
+
+    Yields:
+        str: Chunks of the rendered document.
+
+    Raises:
+        ValueError: If the output format is unknown.
+    """
+    if output_format == 'json':
+        document = {'report_date': report_date, 'reports': _json_safe(reports)}
+        yield from json.JSONEncoder(indent=2).iterencode(document)
+        return
+    if output_format not in TEMPLATES:
+        raise ValueError(f"Unknown report format '{output_format}'.")
+
+    template = get_environment().get_template(TEMPLATES[output_format])
+    context = {'reports': reports, 'report_date': report_date}
+    if output_format == 'html_rows':
+        context['comparison'] = reports[0]['comparison']
+    yield from template.generate(**context)
+
+def render(output_format, reports, report_date=None):
+    """
+    Render one or more comparison results into a single string.
+    """
+    return ''.join(render_stream(output_format, reports, report_date))
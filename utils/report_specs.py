@@ -0,0 +1,393 @@
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field, fields
+from utils import config
+from utils import azure_subscription_queries
+from utils import drilldown
+
+# Name of the report used when no report definition file exists
+DEFAULT_REPORT = 'default'
+
+# Cost Management accepts at most two grouping dimensions per query
+MAX_GROUPING = 2
+
+@dataclass(frozen=True)
+class ReportSpec:
+    """
+    One report definition: which costs to compare, how, and who receives it.
+
+    Every field can be set in the report definition file (report_specs_path);
+    omitted fields reproduce the built-in report.
+    """
+    name: str = DEFAULT_REPORT
+    # Subscriptions the report covers; empty means every subscription of the run
+    subscription_ids: tuple = ()
+    # Cost Management dataset filter; null reports on every service
+    filter: dict = field(default_factory=lambda: azure_subscription_queries.DEFAULT_FILTER)
+    # Dimension the costs are compared by (ServiceName, ResourceGroup, ...)
+    group_by: str = 'ServiceName'
+    # Baseline name from BASELINES (the comparison_baseline setting when omitted)
+    baseline: str = None
+    # Days before today averaged into the baseline, resolved from `baseline` when omitted
+    baseline_days: tuple = ()
+    highlight_threshold: float = 10
+    # Email recipients; empty means the email_recipients setting
+    recipients: tuple = ()
+    # Resource-level top movers (the drilldown_enabled setting when omitted)
+    drilldown: bool = None
+    # Budget of the month-to-date section (the monthly_budget setting when omitted)
+    monthly_budget: float = None
+
+    @classmethod
+    def from_dict(cls, data, settings=None):
+        """
+        Build a spec from one entry of the report definition file.
+
+        Raises:
+            ValueError: If the entry has unknown keys, an unknown baseline or an invalid filter.
+        """
+        settings = settings or config.get_settings()
+        if not isinstance(data, dict):
+            raise ValueError(f"Report definition must be an object, got {data!r}.")
+        name = str(data.get('name') or DEFAULT_REPORT)
+        unknown = set(data) - {f.name for f in fields(cls)}
+        if unknown:
+            raise ValueError(f"Report '{name}' has unknown key(s): {', '.join(sorted(unknown))}.")
+
+        values = dict(data, name=name)
+        for key in ('subscription_ids', 'recipients', 'baseline_days'):
+            if key in values:
+                value = values[key]
+                values[key] = tuple(value) if isinstance(value, (list, tuple)) else tuple(v.strip() for v in str(value).split(',') if v.strip())
+
+        baseline = values.get('baseline')
+        if not values.get('baseline_days'):
+            baseline = baseline or settings.comparison_baseline
+            if baseline not in azure_subscription_queries.BASELINES:
+                raise ValueError(f"Report '{name}' has an unknown baseline '{baseline}'.")
+            values['baseline_days'] = tuple(azure_subscription_queries.BASELINES[baseline])
+        try:
+            values['baseline_days'] = tuple(sorted({int(d) for d in values['baseline_days']}))
+        except (TypeError, ValueError):
+            raise ValueError(f"Report '{name}' has invalid baseline_days {values['baseline_days']!r}.")
+        if min(values['baseline_days']) <= azure_subscription_queries.REPORT_DAYS_AGO:
+            raise ValueError(f"Report '{name}' has baseline days overlapping the report day.")
+        values['baseline'] = baseline or 'custom'
+
+        if values.get('filter') is not None:
+            validate_filter(values['filter'], name)
+        if 'highlight_threshold' in values:
+            values['highlight_threshold'] = float(values['highlight_threshold'])
+        if values.get('drilldown') is None:
+            values['drilldown'] = settings.drilldown_enabled
+        try:
+            values['monthly_budget'] = float(settings.monthly_budget if values.get('monthly_budget') is None else values['monthly_budget'])
+        except (TypeError, ValueError):
+            raise ValueError(f"Report '{name}' has an invalid monthly_budget {values['monthly_budget']!r}.")
+        return cls(**values)
+
+    @property
+    def dimensions(self):
+        """
+        Grouping dimensions the report needs, in query order.
+        """
+        if self.drilldown and self.group_by == 'ServiceName':
+            return tuple(drilldown.DRILLDOWN_GROUPING)
+        return (self.group_by,)
+
+    @property
+    def window_start(self):
+        """
+        Oldest day the report needs, as days before today.
+        """
+        return max(self.baseline_days)
+
+    def get_state_key(self, subscription_id):
+        """
+        Return the name of the incremental state (month to date, anomalies) of
+        this report for one subscription; reports reading the same rows, with
+        the same drill-down and baseline, share it.
+        """
+        definition = json.dumps([self.filter, self.group_by, self.drilldown, list(self.baseline_days)], sort_keys=True)
+        return f"{subscription_id.lower()}-{hashlib.sha1(definition.encode('utf-8')).hexdigest()[:12]}"
+
+    def covers(self, subscription_id):
+        """
+        Return True when the report applies to the subscription.
+        """
+        return not self.subscription_ids or subscription_id.lower() in {s.lower() for s in self.subscription_ids}
+
+def validate_filter(expression, name=DEFAULT_REPORT):
+    """
+    Check that a filter is a Cost Management query filter expression.
+
+    Raises:
+        ValueError: If the expression is malformed.
+    """
+    if not isinstance(expression, dict) or len(expression) != 1:
+        raise ValueError(f"Report '{name}' has an invalid filter expression {expression!r}.")
+    (kind, value), = expression.items()
+    if kind in ('and', 'or'):
+        if not isinstance(value, list) or len(value) < 2:
+            raise ValueError(f"Report '{name}': '{kind}' needs a list of at least two expressions.")
+        for child in value:
+            validate_filter(child, name)
+    elif kind == 'not':
+        validate_filter(value, name)
+    elif kind in ('dimensions', 'tags'):
+        if not isinstance(value, dict) or not value.get('name') or not isinstance(value.get('values'), list):
+            raise ValueError(f"Report '{name}': '{kind}' needs a name and a list of values.")
+    else:
+        raise ValueError(f"Report '{name}' has an unsupported filter '{kind}'.")
+
+def normalize_filter(expression):
+    """
+    Return a canonical form of a filter expression.
+
+    Nested and/or of the same kind are flattened, "In" filters on the same
+    dimension under an "or" are merged, and operands and value lists are
+    de-duplicated and sorted, so equivalent filters written differently
+    compare equal.
+    """
+    if expression is None:
+        return None
+    (kind, value), = expression.items()
+    if kind in ('and', 'or'):
+        operands = {}
+        merged_values = {}
+        for child in value:
+            child = normalize_filter(child)
+            for operand in (child[kind] if kind in child else [child]):
+                dimension = operand.get('dimensions')
+                if kind == 'or' and dimension and dimension['operator'] == 'In':
+                    # A In x or A In y == A In (x + y)
+                    merged_values.setdefault(dimension['name'], set()).update(dimension['values'])
+                    continue
+                operands[filter_key(operand)] = operand
+        for name, values in merged_values.items():
+            operand = {'dimensions': {'name': name, 'operator': 'In', 'values': sorted(values)}}
+            operands[filter_key(operand)] = operand
+        if len(operands) == 1:
+            return next(iter(operands.values()))
+        return {kind: [operands[key] for key in sorted(operands)]}
+    if kind == 'not':
+        return {'not': normalize_filter(value)}
+    return {kind: {
+        'name': value['name'],
+        'operator': value.get('operator', 'In'),
+        'values': sorted(set(value['values']))
+    }}
+
+def filter_key(expression):
+    """
+    Return a string identifying a normalized filter.
+    """
+    return json.dumps(expression, sort_keys=True)
+
+def _local_dimensions(expression):
+    """
+    Return the dimensions a filter reads if it can be evaluated on result rows,
+    or None when it needs data the rows do not carry (tags, other operators).
+    """
+    (kind, value), = expression.items()
+    if kind in ('and', 'or'):
+        names = set()
+        for child in value:
+            child_names = _local_dimensions(child)
+            if child_names is None:
+                return None
+            names |= child_names
+        return names
+    if kind == 'not':
+        return _local_dimensions(value)
+    if kind == 'dimensions' and value.get('operator', 'In') == 'In':
+        return {value['name']}
+    return None
+
+def split_filter(expression, dimensions):
+    """
+    Split a filter into the part the API must apply and the part that can be
+    applied locally on rows grouped by `dimensions`.
+
+    Args:
+        expression (dict): Normalized filter, or None.
+        dimensions (tuple): Grouping dimensions of the rows.
+
+    Returns:
+        tuple: (server clauses, local clauses), two lists whose conjunction is the filter.
+    """
+    if expression is None:
+        return [], []
+    server, local = [], []
+    for clause in (expression['and'] if 'and' in expression else [expression]):
+        names = _local_dimensions(clause)
+        (local if names is not None and names <= set(dimensions) else server).append(clause)
+    return server, local
+
+def _combine(kind, clauses):
+    clauses = [clause for clause in clauses if clause is not None]
+    if not clauses:
+        return None
+    return normalize_filter({kind: clauses}) if len(clauses) > 1 else clauses[0]
+
+def _row_value(row, dimension):
+    return row.get('service') if dimension == 'ServiceName' else row.get(dimension)
+
+def compile_row_filter(expression):
+    """
+    Compile a dimension-only filter into a predicate over cost data dictionaries.
+
+    Same semantics as cost_exports.compile_filter (case-insensitive "In"), for
+    rows that already carry the filtered dimensions.
+    """
+    if not expression:
+        return lambda row: True
+    (kind, value), = expression.items()
+    if kind in ('and', 'or'):
+        predicates = [compile_row_filter(e) for e in value]
+        combine = all if kind == 'and' else any
+        return lambda row: combine(p(row) for p in predicates)
+    if kind == 'not':
+        predicate = compile_row_filter(value)
+        return lambda row: not predicate(row)
+    name = value['name']
+    values = frozenset(str(v).lower() for v in value['values'])
+    return lambda row: str(_row_value(row, name) or '').lower() in values
+
+class PlannedQuery:
+    """
+    One Cost Management query serving one or more reports.
+
+    The query's filter is the reports' shared server-side filter, narrowed by
+    the union of their local filters; its grouping is the union of their
+    dimensions and its window covers every report's baseline. Each report's
+    view is projected from the rows locally.
+    """
+
+    def __init__(self, server_key, server, dimensions):
+        self.server_key = server_key
+        self.server = server
+        self.dimensions = list(dimensions)
+        self.window_start = azure_subscription_queries.REPORT_DAYS_AGO
+        self.window_end = azure_subscription_queries.REPORT_DAYS_AGO
+        self.specs = []
+        self._local = {}
+        self._filters = {}
+
+    def accepts(self, server_key, dimensions):
+        return server_key == self.server_key and len(set(self.dimensions) | set(dimensions)) <= MAX_GROUPING
+
+    def add(self, spec, normalized, local):
+        for dimension in spec.dimensions:
+            if dimension not in self.dimensions:
+                self.dimensions.append(dimension)
+        self.window_start = max(self.window_start, spec.window_start)
+        self.specs.append(spec)
+        self._filters[spec.name] = normalized
+        self._local[spec.name] = _combine('and', local)
+
+    @property
+    def grouping(self):
+        """
+        Grouping passed to the query, None for the default ServiceName grouping.
+        """
+        return None if self.dimensions == ['ServiceName'] else self.dimensions
+
+    @property
+    def shared_filter(self):
+        """
+        True when every report of the query has the same filter.
+        """
+        return len({filter_key(f) for f in self._filters.values()}) == 1
+
+    @property
+    def filter(self):
+        """
+        The query's filter expression.
+        """
+        if self.shared_filter:
+            # Every report asks for the same rows: send the filter as written
+            return self.specs[0].filter
+        locals_ = list(self._local.values())
+        narrowing = _combine('or', locals_) if all(locals_) else None
+        return _combine('and', self.server + [narrowing])
+
+    def project(self, spec, cost_data):
+        """
+        Yield the rows of one report from the query's rows.
+
+        Rows are filtered by the report's local filter (unless the query already
+        applied exactly that filter) and keyed by the report's group_by dimension.
+        """
+        matches = compile_row_filter(None if self.shared_filter else self._local[spec.name])
+        for row in cost_data:
+            if not matches(row):
+                continue
+            if spec.group_by != 'ServiceName':
+                row = dict(row, service=row.get(spec.group_by))
+            yield row
+
+def plan_queries(specs):
+    """
+    Merge reports into the fewest Cost Management queries.
+
+    Reports whose filters share the part that must run server-side, and whose
+    dimensions fit in one grouping, are served by a single query; the rest of
+    each filter is applied locally. Identical reports always share a query.
+
+    Args:
+        specs (list): ReportSpec objects for one subscription.
+
+    Returns:
+        list: PlannedQuery objects, each with its specs.
+    """
+    queries = []
+    for spec in specs:
+        normalized = normalize_filter(spec.filter)
+        server, local = split_filter(normalized, spec.dimensions)
+        server_key = filter_key(server)
+        for query in queries:
+            if query.accepts(server_key, spec.dimensions):
+                break
+        else:
+            query = PlannedQuery(server_key, server, spec.dimensions)
+            queries.append(query)
+        query.add(spec, normalized, local)
+    logging.info(f"Planned {len(queries)} cost quer{'y' if len(queries) == 1 else 'ies'} for {len(specs)} report(s)")
+    return queries
+
+def load_report_specs(path=None):
+    """
+    Read the report definitions.
+
+    The file (the report_specs_path setting) holds a JSON list of report
+    objects, or an object with a "reports" list. Without the file the single
+    built-in report is used.
+
+    Returns:
+        list: ReportSpec objects.
+
+    Raises:
+        ValueError: If the file is not valid JSON or a definition is invalid.
+    """
+    settings = config.get_settings()
+    path = settings.report_specs_path if path is None else path
+    if not path or not os.path.exists(path):
+        return [ReportSpec.from_dict({}, settings)]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except ValueError as e:
+        raise ValueError(f"Report definition file {path} is not valid JSON: {str(e)}")
+
+    entries = data.get('reports') if isinstance(data, dict) else data
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Report definition file {path} must hold a non-empty list of reports.")
+    specs = [ReportSpec.from_dict(entry, settings) for entry in entries]
+    names = [spec.name for spec in specs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Report definition file {path} repeats report name(s): {', '.join(duplicates)}.")
+    return specs
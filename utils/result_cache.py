@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from utils import config
+
+# Most recent entries kept in memory; the disk copy has no size limit
+MAX_MEMORY_ENTRIES = 256
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+def is_enabled():
+    """
+    Return True when computed reports are cached (the result_cache_enabled setting).
+    """
+    return config.get_settings().result_cache_enabled
+
+def get_cache_key(subscription_id, report_dates, baseline_dates, usage_data, **extra):
+    """
+    Build the cache key of one subscription's comparison.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        report_dates (list): Usage dates (YYYYMMDD) of the report side.
+        baseline_dates (list): Usage dates (YYYYMMDD) of the baseline side.
+        usage_data (dict): The Cost Management query payload; its time period is
+            covered by the dates, everything else (filter, grouping) is hashed.
+        **extra: Other settings that change the output, e.g. drilldown_top_k.
+
+    Returns:
+        str: A hex digest.
+    """
+    definition = {k: v for k, v in usage_data.items() if k not in ('timeframe', 'timePeriod')}
+    key = {
+        'subscription_id': subscription_id.lower(),
+        'report_dates': sorted(report_dates),
+        'baseline_dates': sorted(baseline_dates),
+        'query': definition,
+        'extra': extra
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _disk_path(key):
+    cache_path = config.get_settings().result_cache_path
+    return os.path.join(cache_path, f'{key}.json') if cache_path else None
+
+def get(key):
+    """
+    Return the cached entry for a key, or None when it is missing or expired.
+
+    Looks in memory first, then in the on-disk copy.
+    """
+    now = time.time()
+    with _memory_lock:
+        entry = _memory.get(key)
+        if entry is not None:
+            if entry['expires_at'] > now:
+                _memory.move_to_end(key)
+                return entry['value']
+            del _memory[key]
+
+    path = _disk_path(key)
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable cached result {path}: {str(e)}")
+        return None
+    if entry.get('expires_at', 0) <= now:
+        return None
+    _remember(key, entry)
+    return entry['value']
+
+def put(key, value, ttl):
+    """
+    Cache a value for ttl seconds in memory and, when result_cache_path is set, on disk.
+
+    Args:
+        key (str): Key from get_cache_key.
+        value (dict): JSON-serialisable result.
+        ttl (float): Lifetime in seconds.
+    """
+    entry = {'expires_at': time.time() + ttl, 'value': value}
+    _remember(key, entry)
+
+    path = _disk_path(key)
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logging.warning(f"Could not write cached result: {str(e)}")
+
+def _remember(key, entry):
+    with _memory_lock:
+        _memory[key] = entry
+        _memory.move_to_end(key)
+        while len(_memory) > MAX_MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+def clear():
+    """
+    Drop every in-memory entry (the disk copy is left alone).
+    """
+    with _memory_lock:
+        _memory.clear()
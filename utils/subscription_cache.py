@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import threading
+import time
+from utils import azure
+from utils import config
+
+# Subscription metadata (names, states, tags) rarely changes, so it is cached
+# for subscription_cache_ttl seconds in memory and at subscription_cache_path,
+# per identity (tenant and client): another service principal may see other
+# subscriptions
+
+# Seconds a failed listing is not retried; lookups fall back to a direct GET meanwhile
+FAILURE_BACKOFF = 60
+
+_caches = {}
+_cache_lock = threading.Lock()
+
+def _get_identity():
+    settings = config.get_settings()
+    return settings.tenant_id or '', settings.client_id or ''
+
+def _get_cache(identity):
+    return _caches.setdefault(identity, {'loaded_at': 0.0, 'failed_at': 0.0, 'subscriptions': {}})
+
+def _is_fresh(loaded_at):
+    return time.time() - loaded_at < config.get_settings().subscription_cache_ttl
+
+def _read_disk_cache(identity):
+    subscription_cache_path = config.get_settings().subscription_cache_path
+    if not subscription_cache_path or not os.path.exists(subscription_cache_path):
+        return None
+    try:
+        with open(subscription_cache_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable subscription cache: {str(e)}")
+        return None
+    # Copies written for another identity (or before the identity was recorded) are listed again
+    if [data.get('tenant_id'), data.get('client_id')] != list(identity):
+        return None
+    return data if _is_fresh(data.get('loaded_at', 0)) else None
+
+def _write_disk_cache(data):
+    subscription_cache_path = config.get_settings().subscription_cache_path
+    if not subscription_cache_path:
+        return
+    try:
+        os.makedirs(os.path.dirname(subscription_cache_path) or '.', exist_ok=True)
+        tmp_path = f'{subscription_cache_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, subscription_cache_path)
+    except OSError as e:
+        logging.warning(f"Could not write subscription cache: {str(e)}")
+
+def get_subscriptions(access_token, refresh=False):
+    """
+    Return metadata for every visible subscription, refreshed in bulk when stale.
+
+    Looks in memory first, then in the on-disk copy under data/, and only then
+    issues a single GET /subscriptions listing call. The cache is kept per
+    tenant and client ID. After a failed listing the call is not repeated for
+    FAILURE_BACKOFF seconds.
+
+    Args:
+        access_token (str): The access token for Azure API authentication.
+        refresh (bool): Ignore cached data and list the subscriptions again.
+
+    Returns:
+        dict: Lower-cased subscription ID -> metadata dict (subscription IDs
+        are GUIDs, matched case-insensitively).
+
+    Raises:
+        ValueError: If the listing failed, now or within the last FAILURE_BACKOFF seconds.
+    """
+    identity = _get_identity()
+    with _cache_lock:
+        cache = _get_cache(identity)
+        if not refresh and _is_fresh(cache['loaded_at']):
+            return cache['subscriptions']
+
+        data = None if refresh else _read_disk_cache(identity)
+        if data is None:
+            if not refresh and time.time() - cache['failed_at'] < FAILURE_BACKOFF:
+                raise ValueError(f"Subscription listing failed less than {FAILURE_BACKOFF}s ago; not retrying yet.")
+            try:
+                subscriptions = azure.list_subscriptions(access_token)
+            except ValueError:
+                cache['failed_at'] = time.time()
+                raise
+            data = {
+                'tenant_id': identity[0],
+                'client_id': identity[1],
+                'loaded_at': time.time(),
+                'subscriptions': {item['subscriptionId'].lower(): item for item in subscriptions}
+            }
+            _write_disk_cache(data)
+        else:
+            # Copies written before the keys were lower-cased
+            data['subscriptions'] = {sub_id.lower(): item for sub_id, item in data.get('subscriptions', {}).items()}
+
+        cache.update(loaded_at=data['loaded_at'], failed_at=0.0, subscriptions=data['subscriptions'])
+        return cache['subscriptions']
+
+def get_subscription_name(subscription_id, access_token):
+    """
+    Return a subscription's display name from the metadata cache.
+
+    Falls back to a single GET for subscriptions missing from the listing.
+
+    Args:
+        subscription_id (str): The Azure subscription ID.
+        access_token (str): The access token for Azure API authentication.
+
+    Returns:
+        str: The Azure subscription display name.
+    """
+    try:
+        subscription = get_subscriptions(access_token).get(subscription_id.lower())
+    except ValueError as e:
+        # Names looked up directly since the failure stay in the cache
+        with _cache_lock:
+            subscription = _get_cache(_get_identity())['subscriptions'].get(subscription_id.lower())
+        if not subscription:
+            logging.warning(f"Subscription listing failed, looking up {subscription_id} directly: {str(e)}")
+    if subscription and subscription.get('displayName'):
+        return subscription['displayName']
+
+    display_name = azure.get_subscription_name(subscription_id, access_token)
+    with _cache_lock:
+        _get_cache(_get_identity())['subscriptions'][subscription_id.lower()] = {
+            'subscriptionId': subscription_id,
+            'displayName': display_name,
+            'state': None,
+            'tags': {}
+        }
+    return display_name
+
+def discover_subscription_ids(access_token, tag=None, state='Enabled'):
+    """
+    Pick the subscriptions to report on from the cached metadata.
+
+    Args:
+        access_token (str): The access token for Azure API authentication.
+        tag (str): Optional "name" or "name=value" tag filter.
+        state (str): Only return subscriptions in this state (None for any).
+
+    Returns:
+        list: Matching subscription IDs, sorted by display name.
+    """
+    tag_name, _, tag_value = (tag or '').partition('=')
+    matches = []
+    for subscription in get_subscriptions(access_token).values():
+        if state and subscription.get('state') != state:
+            continue
+        tags = subscription.get('tags') or {}
+        if tag_name and (tag_name not in tags or (tag_value and tags[tag_name] != tag_value)):
+            continue
+        matches.append(subscription)
+    matches.sort(key=lambda s: s.get('displayName') or '')
+    return [s['subscriptionId'] for s in matches]
+
+def clear():
+    """
+    Drop the in-memory metadata and failure back-off of every identity (the disk copy is left alone).
+    """
+    with _cache_lock:
+        _caches.clear()
@@ -0,0 +1,189 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from utils import config
+
+logger = logging.getLogger('cost_report.telemetry')
+
+# Stack of the spans open in the current thread/context, innermost last
+_active_spans = contextvars.ContextVar('active_spans', default=())
+_exporter_lock = threading.Lock()
+_exporter_configured = False
+_file_lock = threading.Lock()
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+def _configure_exporter():
+    """
+    Route telemetry to Application Insights when it is configured.
+
+    With APPLICATIONINSIGHTS_CONNECTION_STRING set and azure-monitor-opentelemetry
+    installed, log records are exported with their `extra` fields (prefixed
+    cost_report.) as custom dimensions. Otherwise spans are only written as
+    JSON log lines.
+    """
+    global _exporter_configured
+    with _exporter_lock:
+        if _exporter_configured:
+            return
+        _exporter_configured = True
+        if not config.get_settings().APPLICATIONINSIGHTS_CONNECTION_STRING:
+            return
+        try:
+            from azure.monitor.opentelemetry import configure_azure_monitor
+        except ImportError:
+            logger.info("azure-monitor-opentelemetry is not installed; telemetry is logged as JSON only")
+            return
+        configure_azure_monitor(logger_name=logger.name)
+
+def count(name, value=1):
+    """
+    Add to a counter (rows, bytes_received, retries, ...) of every open span.
+
+    Counters roll up, so a stage's bytes also show on the enclosing run span.
+    Does nothing outside a span.
+    """
+    for span_data in _active_spans.get():
+        span_data[name] = span_data.get(name, 0) + value
+
+def annotate(**dimensions):
+    """
+    Set dimensions (subscription_id, rows, ...) on the innermost open span.
+    """
+    spans = _active_spans.get()
+    if spans:
+        spans[-1].update(dimensions)
+
+def emit(span_data):
+    """
+    Write a finished span as a JSON log line with its fields as custom dimensions.
+    """
+    _configure_exporter()
+    line = json.dumps(span_data, default=str)
+    # Custom dimensions only take scalars: unset fields are left out, others serialised
+    logger.info(line, extra={
+        f'cost_report.{k}': v if isinstance(v, (str, int, float, bool)) else json.dumps(v, default=str)
+        for k, v in span_data.items() if v is not None
+    })
+    # Optional JSON-lines file receiving every span, in addition to the log
+    telemetry_log_path = config.get_settings().telemetry_log_path
+    if telemetry_log_path:
+        try:
+            with _file_lock, open(telemetry_log_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            logger.warning(f"Could not write telemetry log: {str(e)}")
+
+@contextmanager
+def span(name, **dimensions):
+    """
+    Time a stage and emit it as one structured record when it ends.
+
+    Args:
+        name (str): Stage name, e.g. 'authenticate' or 'cost_query'.
+        **dimensions: Fields carried by the record (subscription_id, ...).
+            Spans inherit the subscription_id of the enclosing span.
+
+    Yields:
+        dict: The span record; counters and dimensions can be added to it.
+    """
+    parents = _active_spans.get()
+    span_data = {'span': name}
+    if parents and 'subscription_id' in parents[-1]:
+        span_data['subscription_id'] = parents[-1]['subscription_id']
+    span_data.update(dimensions)
+    if not config.get_settings().telemetry_enabled:
+        yield span_data
+        return
+
+    token = _active_spans.set(parents + (span_data,))
+    start = time.perf_counter()
+    span_data['status'] = 'success'
+    try:
+        yield span_data
+    except Exception as e:
+        span_data['status'] = 'error'
+        span_data['error'] = type(e).__name__
+        raise
+    finally:
+        span_data['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        _active_spans.reset(token)
+        emit(span_data)
+
+def _start_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    import tracemalloc
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+def _stop_tracemalloc(file_prefix):
+    global _tracemalloc_users, _tracemalloc_owned
+    import tracemalloc
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        # Leave tracing running if someone else (e.g. the benchmarks) started it
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+    with open(f'{file_prefix}.tracemalloc.txt', 'w', encoding='utf-8') as f:
+        f.write(f"Peak traced memory: {peak / 1024 / 1024:.2f} MB\n\n")
+        for stat in snapshot.statistics('lineno')[:25]:
+            f.write(f"{stat}\n")
+
+@contextmanager
+def profiled(label):
+    """
+    Profile one invocation when the profile_mode setting asks for it.
+
+    cProfile stats (.prof, readable with pstats or snakeviz) and the top
+    tracemalloc allocation sites are written to profile_path, one file per
+    invocation named after the label and a timestamp. cProfile only covers
+    the calling thread. The profilers are only imported when enabled.
+
+    Args:
+        label (str): Identifies the invocation, e.g. the subscription ID.
+    """
+    settings = config.get_settings()
+    modes = {mode.strip().lower() for mode in settings.profile_mode.split(',') if mode.strip()}
+    if not modes:
+        yield
+        return
+
+    profile_path = settings.profile_path
+    os.makedirs(profile_path, exist_ok=True)
+    safe_label = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_') or 'run'
+    file_prefix = os.path.join(profile_path, f"{safe_label}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}")
+
+    profiler = None
+    if 'cprofile' in modes:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is already active in this interpreter
+            logger.warning(f"cProfile unavailable for {label}: {str(e)}")
+            profiler = None
+    if 'tracemalloc' in modes:
+        _start_tracemalloc()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(f'{file_prefix}.prof')
+        if 'tracemalloc' in modes:
+            _stop_tracemalloc(file_prefix)
+        logger.info(f"Profile written to {file_prefix}.*")
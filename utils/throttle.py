@@ -0,0 +1,176 @@
+import logging
+import random
+import re
+import threading
+import time
+from utils import config
+from utils import http_client
+from utils import telemetry
+
+# Cost Management advertises its quotas and back-off intervals with these headers
+RATELIMIT_HEADER_PREFIX = 'x-ms-ratelimit-microsoft.costmanagement-'
+THROTTLED_STATUS_CODES = (429, 503)
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter whose limit grows and shrinks with the remaining quota.
+
+    The limit is halved on every throttled response, reduced by one when the
+    remaining-quota headers run low and raised by one otherwise.
+    """
+
+    def __init__(self, initial=None, maximum=None):
+        settings = config.get_settings()
+        self.maximum = maximum or settings.throttle_max_concurrency
+        self.limit = min(initial or settings.throttle_initial_concurrency, self.maximum)
+        self.low_remaining = settings.throttle_low_remaining
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_throttled(self):
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+
+    def on_success(self, remaining):
+        with self._condition:
+            if remaining is not None and remaining <= self.low_remaining:
+                self.limit = max(1, self.limit - 1)
+            elif self.limit < self.maximum:
+                self.limit += 1
+                self._condition.notify_all()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(tenant_id):
+    """
+    Return the adaptive limiter shared by every Cost Management call of a tenant.
+    """
+    with _limiters_lock:
+        return _limiters.setdefault(tenant_id, AdaptiveLimiter())
+
+def get_retry_after(response):
+    """
+    Read the back-off interval advertised by a throttled response.
+
+    Args:
+        response (requests.Response): The throttled response.
+
+    Returns:
+        float: Seconds to wait, or None when no interval is advertised.
+    """
+    delays = []
+    for name, value in response.headers.items():
+        name = name.lower()
+        if name == 'retry-after' or (name.startswith(RATELIMIT_HEADER_PREFIX) and name.endswith('retry-after')):
+            try:
+                delays.append(float(value))
+            except ValueError:
+                # HTTP-date form; email.utils is only needed for this rare case
+                from email.utils import parsedate_to_datetime
+                try:
+                    delays.append(max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    continue
+    return max(delays) if delays else None
+
+def get_transfer_size(response):
+    """
+    Return the size of a response body as transferred, before decompression.
+
+    requests transparently decompresses gzip bodies, so len(response.content)
+    overstates what came over the wire.
+
+    Args:
+        response (requests.Response): A response whose body has been read.
+
+    Returns:
+        int: Content-Length when sent, else the bytes urllib3 read off the
+        socket, else (chunked responses, which urllib3 does not count) the
+        decoded body length.
+    """
+    length = (response.headers.get('Content-Length') or '').strip()
+    if length.isdigit():
+        return int(length)
+    try:
+        read = int(response.raw.tell())
+    except (AttributeError, TypeError, ValueError):
+        read = 0
+    return read or len(response.content)
+
+def get_remaining_quota(response):
+    """
+    Read the smallest remaining quota from the Cost Management rate-limit headers.
+
+    Args:
+        response (requests.Response): Any Cost Management response.
+
+    Returns:
+        int: The lowest remaining count across all quotas, or None if not reported.
+    """
+    remaining = []
+    for name, value in response.headers.items():
+        name = name.lower()
+        if name.startswith(RATELIMIT_HEADER_PREFIX) and 'remaining' in name:
+            # Values are either a plain count or "Name:count" pairs separated by ';' or ','
+            for part in re.split(r'[;,]', value):
+                count = part.rsplit(':', 1)[-1].strip()
+                if count.isdigit():
+                    remaining.append(int(count))
+    return min(remaining) if remaining else None
+
+def cost_management_request(method, url, tenant_id=None, **kwargs):
+    """
+    Send a Cost Management request under the tenant's adaptive concurrency limit.
+
+    Throttled responses (429/503) are retried after exactly the advertised
+    Retry-After interval plus a small random jitter, up to throttle_max_retries
+    times.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The request URL.
+        tenant_id (str): Tenant whose quota the request counts against.
+        **kwargs: Passed through to http_client.request.
+
+    Returns:
+        requests.Response: The final response (possibly still throttled once retries are exhausted).
+    """
+    settings = config.get_settings()
+    limiter = get_limiter(tenant_id)
+    for attempt in range(settings.throttle_max_retries + 1):
+        limiter.acquire()
+        try:
+            response = http_client.request(method, url, **kwargs)
+        finally:
+            limiter.release()
+
+        telemetry.count('requests')
+        telemetry.count('bytes_received', get_transfer_size(response))
+        if response.status_code not in THROTTLED_STATUS_CODES:
+            limiter.on_success(get_remaining_quota(response))
+            return response
+
+        limiter.on_throttled()
+        if attempt == settings.throttle_max_retries:
+            break
+        telemetry.count('retries')
+        retry_after = get_retry_after(response)
+        if retry_after is None:
+            retry_after = settings.throttle_default_backoff * (2 ** attempt)
+        delay = retry_after + random.uniform(0, settings.throttle_jitter)
+        logging.warning(f"Cost Management throttled the request (HTTP {response.status_code}), retrying in {delay:.1f}s (attempt {attempt + 1}/{settings.throttle_max_retries})")
+        time.sleep(delay)
+
+    return response
@@ -0,0 +1,166 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from utils import config
+
+# Storage queue carrying one message per subscription to report on. The
+# Functions host moves messages that fail maxDequeueCount times (host.json)
+# to the matching -poison queue.
+QUEUE_NAME = 'cost-report-requests'
+POISON_QUEUE_NAME = f'{QUEUE_NAME}-poison'
+
+# Attempts per message, keep in line with maxDequeueCount in host.json
+MAX_DEQUEUE_COUNT = 3
+
+# Blob container holding one marker per subscription and report day. The
+# marker is claimed (created only if absent) before the report runs, so
+# duplicate or redelivered messages are skipped while it is processing or sent
+MARKER_CONTAINER = 'cost-report-markers'
+
+# Every binding uses the Functions storage account (Azurite locally)
+STORAGE_CONNECTION = 'AzureWebJobsStorage'
+
+def get_report_day(today, report_days_ago=1):
+    """
+    Return the day being reported on as YYYYMMDD.
+    """
+    return (today - timedelta(days=report_days_ago)).strftime('%Y%m%d')
+
+def build_messages(subscription_ids, report_day, job_id=None, refresh=False):
+    """
+    Build one queue message per subscription.
+
+    Args:
+        subscription_ids (list): Subscriptions to report on; duplicates are dropped.
+        report_day (str): The report day as YYYYMMDD, part of the dedupe key.
+        job_id (str): Manual job the messages belong to (see jobs), if any.
+        refresh (bool): Bypass the result cache.
+
+    Returns:
+        list: JSON message bodies.
+    """
+    enqueued_at = datetime.now().isoformat(timespec='seconds')
+    extra = {'job_id': job_id, 'refresh': refresh} if job_id else {}
+    return [
+        json.dumps(dict({'subscription_id': sub_id, 'report_day': report_day, 'enqueued_at': enqueued_at}, **extra))
+        for sub_id in dict.fromkeys(subscription_ids)
+    ]
+
+def build_batch_message(subscription_ids, report_day, job_id, refresh=False):
+    """
+    Build one queue message running every subscription of a manual job together.
+
+    Used when the reports cannot be split per subscription: a cost_scope
+    query or an email digest covers all of them.
+    """
+    return json.dumps({
+        'subscription_ids': list(dict.fromkeys(subscription_ids)),
+        'report_day': report_day,
+        'job_id': job_id,
+        'refresh': refresh,
+        'enqueued_at': datetime.now().isoformat(timespec='seconds')
+    })
+
+def get_part(message):
+    """
+    Return the job part a message runs: its subscription ID, or 'all' for a batch message.
+    """
+    return message.get('subscription_id') or 'all'
+
+def parse_message(body):
+    """
+    Read a queue message built by build_messages or build_batch_message.
+
+    Args:
+        body (str or bytes): The message body.
+
+    Returns:
+        dict: The message with 'report_day' and 'subscription_id' (or 'subscription_ids' and 'job_id').
+
+    Raises:
+        ValueError: If the message is not valid JSON or lacks a field.
+    """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        raise ValueError(f"Queue message is not valid JSON: {body!r}")
+    if not isinstance(message, dict) or not message.get('report_day') or not (
+        message.get('subscription_id') or (message.get('job_id') and 'subscription_ids' in message)
+    ):
+        raise ValueError(f"Queue message lacks subscription_id or report_day: {body!r}")
+    return message
+
+def get_marker_name(message):
+    """
+    Return the marker blob name of a queue message.
+
+    Scheduled reports are deduplicated per subscription and report day; the
+    messages of a manual job per job, so a manual run is never skipped
+    because the scheduled report was already sent.
+    """
+    if message.get('job_id'):
+        return f"jobs/{message['job_id']}-{get_part(message)}.json"
+    return f"{message['subscription_id']}-{message['report_day']}.json"
+
+def claim_marker(marker_name, message_id, stale_after=None):
+    """
+    Claim a report before running it.
+
+    The marker is created with If-None-Match: *, so of two copies of a message
+    delivered at the same time only one runs the report. A 'processing'
+    marker older than stale_after seconds (default subscription_timeout) was
+    left by an instance that died mid-report and is taken over, guarded by
+    its ETag.
+
+    Args:
+        marker_name (str): See get_marker_name.
+        message_id (str): ID of the queue message claiming the report, for the logs.
+        stale_after (float): Age in seconds after which a processing marker is abandoned.
+
+    Returns:
+        bool: True when this message owns the report and must run it.
+    """
+    from utils import blob_store
+    stale_after = config.get_settings().subscription_timeout if stale_after is None else stale_after
+    now = datetime.now()
+    claim = json.dumps({'status': 'processing', 'message_id': message_id, 'started_at': now.isoformat(timespec='seconds')})
+    if blob_store.create_blob(MARKER_CONTAINER, marker_name, claim):
+        return True
+
+    data, etag = blob_store.read_blob(MARKER_CONTAINER, marker_name)
+    if data is None:
+        # Released by a failed attempt in the meantime
+        return blob_store.create_blob(MARKER_CONTAINER, marker_name, claim)
+    try:
+        marker = json.loads(data)
+        started_at = datetime.fromisoformat(marker.get('started_at') or '')
+    except ValueError:
+        marker, started_at = {}, None
+    if marker.get('status') == 'processing' and (started_at is None or (now - started_at).total_seconds() > stale_after):
+        logging.warning(f"Taking over abandoned cost report {marker_name} from message {marker.get('message_id')}")
+        return blob_store.write_blob(MARKER_CONTAINER, marker_name, claim, etag=etag)
+    return False
+
+def release_marker(marker_name):
+    """
+    Drop the claim of a failed report so the message's retry can run it again.
+    """
+    from utils import blob_store
+    try:
+        blob_store.delete_blob(MARKER_CONTAINER, marker_name)
+    except Exception as e:
+        # The claim then expires after stale_after, see claim_marker
+        logging.warning(f"Could not release cost report marker {marker_name}: {str(e)}")
+
+def complete_marker(marker_name, result):
+    """
+    Mark a claimed report as sent.
+    """
+    from utils import blob_store
+    blob_store.write_blob(MARKER_CONTAINER, marker_name, json.dumps({
+        'status': 'sent',
+        'subscription_id': result.get('subscription_id'),
+        'report_date': result.get('report_date'),
+        'comparison_dates': result.get('comparison_dates'),
+        'completed_at': datetime.now().isoformat(timespec='seconds')
+    }))